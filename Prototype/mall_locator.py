@@ -7,20 +7,42 @@ Floor plans sourced from: https://timessquare.com.hk/floor-plan/
 """
 
 import os
+import re
+import sys
 import json
 import math
+import io
 import base64
+import time
+import random
 import requests
 import heapq
+import hashlib
+import sqlite3
+import threading
+import functools
+import argparse
+import asyncio
+import tempfile
+import unicodedata
+import marshal
+import numpy as np
 from pathlib import Path
-from dataclasses import dataclass
+from datetime import datetime
+from collections import deque, OrderedDict
+from collections.abc import Mapping
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, asdict, field
 from typing import Optional, Tuple, List, Dict
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+OPENAI_API_URL = os.getenv("OPENAI_API_URL", "https://api.openai.com/v1/chat/completions")
 FLOOR_PLANS_DIR = Path("floor_plans")
 PHOTOS_DIR = Path("TimesSquarePhotos")
 OUTPUT_DIR = Path("output")
+CACHE_DIR = Path("cache")
 
 # Official Times Square Hong Kong floor plan reference
 TIMES_SQUARE_FLOOR_PLAN_URL = "https://timessquare.com.hk/floor-plan/"
@@ -158,6 +180,11 @@ TOILET_POSITIONS = {
     "wc_s": {"x": 0.45, "y": 0.75, "name": "South Toilets", "accessible": True},
 }
 
+# Facility kind -> its positions table, looked up at call time since
+# activate_mall() rebinds the tables
+FACILITY_TABLES = {"elevators": lambda: ELEVATOR_POSITIONS, "escalators": lambda: ESCALATOR_POSITIONS,
+                   "toilets": lambda: TOILET_POSITIONS}
+
 # Floor-specific facility availability
 FLOOR_FACILITIES = {
     "B2": {
@@ -197,6 +224,13 @@ FLOOR_DATA = {
 
 FLOOR_ORDER = ["B2", "B1", "GF", "1F", "2F", "3F", "4F", "5F", "6F", "7F", "8F"]
 
+# Cost of riding between two adjacent levels, in the same normalized units as
+# walking distance (0.01 = 1m). Used for vertical edges in the multi-floor graph.
+VERTICAL_COSTS = {
+    "elevator": 0.20,
+    "escalator": 0.15,
+}
+
 # =============================================================================
 # WAYPOINTS FOR A* PATHFINDING
 # Dense waypoint grid following the WHITE walkway corridors
@@ -477,44 +511,620 @@ class LocationEstimate:
     detected_shops: List[str]
     store_codes: List[str]
     reasoning: str
+    radius: Optional[float] = None  # 2-sigma position uncertainty from the bearing solver
+    modes: Optional[List[dict]] = None  # POSITION_BACKEND=grid: alternative positions
+    entropy: Optional[float] = None     # POSITION_BACKEND=grid: posterior entropy, bits
 
 
 # =============================================================================
-# AI PHOTO ANALYSIS
+# MALL DATA PACKAGES
 # =============================================================================
 
-def analyze_photo_with_ai(image_path: Path) -> dict:
+# The tables above are the built-in Times Square data. A mall can also come
+# from an on-disk package, malls/<mall_id>/:
+#   mall.json          manifest: schema version, data version, floor order,
+#                      vertical costs, facility positions, name aliases
+#   floors/<id>.json   one section per floor: stores, facility ids,
+#                      waypoints and connections
+#   plans/<id>.png     optional floor plan images
+# The first load validates everything and compiles mall.pack beside it
+# (marshal-encoded floor sections plus an offset table), which later starts
+# read instead of the JSON. marshal's format is only stable for one Python
+# version, so the pack records the interpreter that wrote it and is rebuilt
+# from the JSON when a different one reads it. Floors are decoded only when first used, and the
+# registry keeps at most MALL_RESIDENT_FLOORS floors resident across malls.
+# activate_mall() points the module tables at one mall's lazy views.
+MALLS_DIR = Path("malls")
+MALL_SCHEMA_VERSION = 1
+MALL_PACK_MAGIC = b"MALLPACK"
+MALL_RESIDENT_FLOORS = int(os.getenv("MALL_RESIDENT_FLOORS", "32"))
+FACILITY_KINDS = ("elevators", "escalators", "toilets")
+
+class MallDataError(ValueError):
+    """A mall data package that does not match the schema."""
+
+def _check(condition, where, message):
+    if not condition:
+        raise MallDataError(f"{where}: {message}")
+
+def _check_point(point, where):
+    _check(isinstance(point, dict), where, "expected an object with x and y")
+    for axis in ("x", "y"):
+        value = point.get(axis)
+        _check(isinstance(value, (int, float)) and not isinstance(value, bool) and 0 <= value <= 1,
+               where, f"{axis} must be a number in 0-1, got {value!r}")
+
+def validate_mall_manifest(doc, where="mall.json"):
+    _check(isinstance(doc, dict), where, "expected an object")
+    _check(doc.get("schema_version") == MALL_SCHEMA_VERSION, where,
+           f"schema_version must be {MALL_SCHEMA_VERSION}, got {doc.get('schema_version')!r}")
+    _check(isinstance(doc.get("version"), str), where, "version must be a string")
+    mall = doc.get("mall")
+    _check(isinstance(mall, dict) and isinstance(mall.get("id"), str) and isinstance(mall.get("name"), str),
+           where, "mall must be an object with string id and name")
+    for key in ("floors", "floor_order"):
+        _check(isinstance(doc.get(key), list) and all(isinstance(f, str) for f in doc[key]),
+               where, f"{key} must be a list of floor ids")
+    _check(set(doc["floors"]) <= set(doc["floor_order"]), where, "every floor must appear in floor_order")
+    costs = doc.get("vertical_costs", {})
+    _check(isinstance(costs, dict) and all(isinstance(v, (int, float)) and v > 0 for v in costs.values()),
+           where, "vertical_costs must map kinds to positive numbers")
+    facilities = doc.get("facilities", {})
+    _check(isinstance(facilities, dict), where, "facilities must be an object")
+    for kind in FACILITY_KINDS:
+        positions = facilities.get(kind, {})
+        _check(isinstance(positions, dict), f"{where} facilities.{kind}", "expected an object")
+        for fac_id, info in positions.items():
+            _check_point(info, f"{where} facilities.{kind}.{fac_id}")
+    aliases = doc.get("aliases", {})
+    _check(isinstance(aliases, dict) and all(isinstance(v, str) for v in aliases.values()),
+           where, "aliases must map names to store codes")
+
+def validate_floor_section(doc, manifest, where):
+    _check(isinstance(doc, dict), where, "expected an object")
+    _check(isinstance(doc.get("name"), str), where, "name must be a string")
+    stores = doc.get("stores", {})
+    _check(isinstance(stores, dict), where, "stores must be an object")
+    for code, info in stores.items():
+        _check_point(info, f"{where} stores.{code}")
+        _check(isinstance(info.get("name", ""), str), f"{where} stores.{code}", "name must be a string")
+    facilities = doc.get("facilities", {})
+    for kind in FACILITY_KINDS:
+        known = manifest.get("facilities", {}).get(kind, {})
+        for fac_id in facilities.get(kind, []):
+            _check(fac_id in known, f"{where} facilities.{kind}", f"unknown id {fac_id!r}")
+    waypoints = doc.get("waypoints", {})
+    _check(isinstance(waypoints, dict), where, "waypoints must be an object")
+    for name, point in waypoints.items():
+        _check(isinstance(point, list) and len(point) == 2 and all(isinstance(v, (int, float)) for v in point),
+               f"{where} waypoints.{name}", "expected [x, y]")
+    for pair in doc.get("connections", []):
+        _check(isinstance(pair, list) and len(pair) == 2 and all(p in waypoints for p in pair),
+               f"{where} connections", f"{pair!r} must join two known waypoints")
+
+def floor_section_from_json(doc) -> dict:
+    """JSON floor section -> the tuple-based shapes the routing code hashes."""
+    return {
+        "name": doc["name"],
+        "color": doc.get("color", "#e8d4a8"),
+        "shop_color": doc.get("shop_color", "#8b6914"),
+        "stores": doc.get("stores", {}),
+        "facilities": {kind: list(doc.get("facilities", {}).get(kind, [])) for kind in FACILITY_KINDS},
+        "waypoints": {name: tuple(point) for name, point in doc.get("waypoints", {}).items()},
+        "connections": [tuple(pair) for pair in doc.get("connections", [])],
+    }
+
+def export_mall_package(directory, mall_id="times_square", name="Times Square Hong Kong", version="1"):
+    """Write the built-in tables out as a mall data package."""
+    directory = Path(directory)
+    (directory / "floors").mkdir(parents=True, exist_ok=True)
+    floors = list(FLOOR_DATA)
+    manifest = {
+        "schema_version": MALL_SCHEMA_VERSION,
+        "version": version,
+        "mall": {"id": mall_id, "name": name},
+        "floors": floors,
+        "floor_order": list(FLOOR_ORDER),
+        "vertical_costs": dict(VERTICAL_COSTS),
+        "facilities": {"elevators": dict(ELEVATOR_POSITIONS), "escalators": dict(ESCALATOR_POSITIONS),
+                       "toilets": dict(TOILET_POSITIONS)},
+        "aliases": dict(STORE_NAME_TO_CODE),
+    }
+    (directory / "mall.json").write_text(json.dumps(manifest, indent=1, ensure_ascii=False), encoding="utf-8")
+    for floor in floors:
+        info = FLOOR_DATA[floor]
+        section = {
+            "name": info["name"], "color": info.get("color"), "shop_color": info.get("shop_color"),
+            "stores": info.get("stores", {}),
+            "facilities": FLOOR_FACILITIES.get(floor, {kind: [] for kind in FACILITY_KINDS}),
+            "waypoints": {wp: list(point) for wp, point in WALKWAY_WAYPOINTS.get(floor, {}).items()},
+            "connections": [list(pair) for pair in WALKWAY_CONNECTIONS.get(floor, [])],
+        }
+        (directory / "floors" / f"{floor}.json").write_text(
+            json.dumps(section, indent=1, ensure_ascii=False), encoding="utf-8")
+    return directory
+
+def _package_signature(directory) -> str:
+    """Cheap staleness check for mall.pack: names, sizes and mtimes of the JSON sources."""
+    files = [directory / "mall.json"] + sorted((directory / "floors").glob("*.json"))
+    return hashlib.sha1(repr([(f.name, f.stat().st_size, f.stat().st_mtime_ns) for f in files]).encode()).hexdigest()
+
+def _pack_interpreter() -> list:
+    """Python and marshal versions the pack's floor sections are written with."""
+    return [*sys.version_info[:2], marshal.version]
+
+def compile_mall_package(directory) -> Path:
+    """Validate the JSON package and write mall.pack. Returns its path."""
+    directory = Path(directory)
+    with open(directory / "mall.json", encoding="utf-8") as f:
+        manifest = json.load(f)
+    validate_mall_manifest(manifest, str(directory / "mall.json"))
+    sections = {}
+    for floor in manifest["floors"]:
+        path = directory / "floors" / f"{floor}.json"
+        _check(path.exists(), str(directory), f"missing floors/{floor}.json")
+        with open(path, encoding="utf-8") as f:
+            doc = json.load(f)
+        validate_floor_section(doc, manifest, str(path))
+        sections[floor] = marshal.dumps(floor_section_from_json(doc))
+    
+    offsets, position = {}, 0
+    for floor, blob in sections.items():
+        offsets[floor] = [position, len(blob)]
+        position += len(blob)
+    store_codes = {floor: list(marshal.loads(blob)["stores"]) for floor, blob in sections.items()}
+    floor_digests = {floor: hashlib.sha1(blob).hexdigest() for floor, blob in sections.items()}
+    header = json.dumps({"signature": _package_signature(directory), "interpreter": _pack_interpreter(),
+                         "manifest": manifest, "sections": offsets, "store_codes": store_codes,
+                         "floor_digests": floor_digests}).encode("utf-8")
+    pack_path = directory / "mall.pack"
+    tmp_path = pack_path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(MALL_PACK_MAGIC + MALL_SCHEMA_VERSION.to_bytes(4, "little") + len(header).to_bytes(8, "little"))
+        f.write(header)
+        for blob in sections.values():
+            f.write(blob)
+    os.replace(tmp_path, pack_path)
+    return pack_path
+
+class MallData:
+    """One mall package: manifest in memory, floor sections decoded on demand from mall.pack."""
+
+    def __init__(self, directory, registry=None):
+        self.directory = Path(directory)
+        self.registry = registry
+        pack_path = self.directory / "mall.pack"
+        header = self._read_header(pack_path) if pack_path.exists() else None
+        has_sources = (self.directory / "mall.json").exists()
+        stale = (header is None or "floor_digests" not in header
+                 or header.get("interpreter") != _pack_interpreter())
+        if stale:
+            _check(has_sources, str(pack_path), "missing or written by another schema/Python/marshal version, "
+                                                "and there is no mall.json to rebuild it from")
+        if stale or (has_sources and header["signature"] != _package_signature(self.directory)):
+            compile_mall_package(self.directory)
+            header = self._read_header(pack_path)
+        self.pack_path = pack_path
+        self.manifest = header["manifest"]
+        self.id = self.manifest["mall"]["id"]
+        self.floors = list(self.manifest["floors"])
+        self.signature = header["signature"]
+        self.floor_digests = header["floor_digests"]     # floor -> content hash of its section
+        self._sections = header["sections"]
+        self._data_start = header["data_start"]
+        # Store code -> floor from the header, so code lookups decode one floor
+        self.code_floors = {code: floor for floor in self.floors for code in header["store_codes"][floor]}
+
+    @staticmethod
+    def _read_header(pack_path):
+        with open(pack_path, "rb") as f:
+            prefix = f.read(len(MALL_PACK_MAGIC) + 12)
+            if prefix[:len(MALL_PACK_MAGIC)] != MALL_PACK_MAGIC:
+                return None
+            if int.from_bytes(prefix[len(MALL_PACK_MAGIC):-8], "little") != MALL_SCHEMA_VERSION:
+                return None
+            length = int.from_bytes(prefix[-8:], "little")
+            header = json.loads(f.read(length))
+        header["data_start"] = len(prefix) + length
+        return header
+
+    def load_floor(self, floor) -> dict:
+        """Decode one floor section from the pack (no caching; see floor())."""
+        if floor not in self._sections:
+            raise KeyError(floor)
+        offset, length = self._sections[floor]
+        with open(self.pack_path, "rb") as f:
+            f.seek(self._data_start + offset)
+            return marshal.loads(f.read(length))
+
+    def floor(self, floor) -> dict:
+        if self.registry is not None:
+            return self.registry.floor_section(self, floor)
+        return self.load_floor(floor)
+
+    @property
+    def plans_dir(self) -> Optional[Path]:
+        plans = self.directory / "plans"
+        return plans if plans.is_dir() else None
+
+class MallFloorTable(Mapping):
     """
-    Analyze photo using OpenAI GPT-4 Vision with Times Square floor plan reference.
-    Reference: https://timessquare.com.hk/floor-plan/
+    Read-only {floor: value} view over a mall, decoding a floor's section only
+    when that floor is looked up; iterating keys touches nothing.
     """
-    if not OPENAI_API_KEY:
-        return analyze_photo_fallback(image_path)
-    
-    with open(image_path, "rb") as f:
-        base64_image = base64.b64encode(f.read()).decode("utf-8")
-    
-    # Build store code reference from our database
-    store_ref = "STORE CODES FROM FLOOR PLAN:\n"
-    for floor_name, floor_info in FLOOR_DATA.items():
-        stores = floor_info.get("stores", {})
-        if stores:
-            store_ref += f"\n{floor_name}:\n"
-            for code, info in stores.items():
-                store_ref += f"  - {code}: {info.get('name', code)} (x={info['x']:.2f}, y={info['y']:.2f})\n"
+
+    def __init__(self, mall, extract):
+        self.mall = mall
+        self.extract = extract
+
+    def __getitem__(self, floor):
+        if floor not in self.mall.floors:
+            raise KeyError(floor)
+        return self.extract(self.mall.floor(floor))
+
+    def __iter__(self):
+        return iter(self.mall.floors)
+
+    def __len__(self):
+        return len(self.mall.floors)
+
+    def __contains__(self, floor):
+        return floor in self.mall.floors
+
+    def __repr__(self):
+        return f"MallFloorTable({self.mall.id!r}, floors={self.mall.floors!r})"
+
+class MallStoreTable(Mapping):
+    """ALL_STORES-style {code: {..., "floor": floor}} view; a lookup decodes only that store's floor."""
+
+    def __init__(self, mall):
+        self.mall = mall
+
+    def __getitem__(self, code):
+        floor = self.mall.code_floors[code]
+        return {**self.mall.floor(floor)["stores"][code], "floor": floor}
+
+    def __iter__(self):
+        return iter(self.mall.code_floors)
+
+    def __len__(self):
+        return len(self.mall.code_floors)
+
+def table_token(table, floor=None):
+    """
+    Cheap change token for a mall view (read-only, so the pack's content
+    hashes stand in for its contents: one floor's, or the whole package's),
+    or None for a plain dict that has to be compared by value.
+    """
+    if isinstance(table, MallFloorTable) and floor is not None:
+        return (table.mall.id, floor, table.mall.floor_digests.get(floor))
+    if isinstance(table, (MallFloorTable, MallStoreTable)):
+        return (table.mall.id, table.mall.signature)
+    return None
+
+class MallRegistry:
+    """Known malls by id, sharing one LRU budget of resident floor sections."""
+
+    def __init__(self, root=None, max_resident=MALL_RESIDENT_FLOORS):
+        self.root = Path(root or MALLS_DIR)
+        self.max_resident = max_resident
+        self._malls = {}
+        self._resident = OrderedDict()      # (mall id, floor) -> section
+        self._lock = threading.Lock()
+
+    def available(self) -> List[str]:
+        if not self.root.is_dir():
+            return []
+        return sorted(p.name for p in self.root.iterdir()
+                      if (p / "mall.json").exists() or (p / "mall.pack").exists())
+
+    def get(self, mall_id) -> MallData:
+        with self._lock:
+            mall = self._malls.get(mall_id)
+        if mall is None:
+            directory = self.root / mall_id
+            _check(directory.is_dir(), str(directory), f"no mall package {mall_id!r}")
+            mall = MallData(directory, self)
+            with self._lock:
+                mall = self._malls.setdefault(mall_id, mall)
+        return mall
+
+    def floor_section(self, mall, floor) -> dict:
+        key = (mall.id, floor)
+        with self._lock:
+            section = self._resident.get(key)
+            if section is not None:
+                self._resident.move_to_end(key)
+                return section
+        section = mall.load_floor(floor)
+        with self._lock:
+            self._resident[key] = section
+            while len(self._resident) > self.max_resident:
+                self._resident.popitem(last=False)
+        return section
+
+    def resident(self) -> List[Tuple[str, str]]:
+        with self._lock:
+            return list(self._resident)
+
+MALL_REGISTRY = MallRegistry()
+ACTIVE_MALL = None      # None = the built-in tables above
+
+def generated_plans_dir() -> Path:
+    """
+    Where main() writes generated floor plans. For a mall that is under
+    cache/, so malls sharing floor ids don't collide and a package's own
+    plans/ is never overwritten.
+    """
+    if ACTIVE_MALL is None:
+        return FLOOR_PLANS_DIR
+    return CACHE_DIR / "plans" / ACTIVE_MALL.id
+
+def activate_mall(mall_id, registry=None):
+    """
+    Point FLOOR_DATA, the facility and walkway tables, FLOOR_ORDER,
+    VERTICAL_COSTS and the alias table at a registered mall, and drop every
+    cache derived from them.
+    """
+    global FLOOR_DATA, FLOOR_FACILITIES, WALKWAY_WAYPOINTS, WALKWAY_CONNECTIONS, ALL_STORES
+    global ELEVATOR_POSITIONS, ESCALATOR_POSITIONS, TOILET_POSITIONS, FLOOR_ORDER, VERTICAL_COSTS
+    global STORE_NAME_TO_CODE, MALL_GRAPH, ACTIVE_MALL
+    mall = (registry or MALL_REGISTRY).get(mall_id)
+    manifest = mall.manifest
+    FLOOR_DATA = MallFloorTable(mall, lambda s: {"name": s["name"], "color": s["color"],
+                                                 "shop_color": s["shop_color"], "stores": s["stores"]})
+    FLOOR_FACILITIES = MallFloorTable(mall, lambda s: s["facilities"])
+    WALKWAY_WAYPOINTS = MallFloorTable(mall, lambda s: s["waypoints"])
+    WALKWAY_CONNECTIONS = MallFloorTable(mall, lambda s: s["connections"])
+    ALL_STORES = MallStoreTable(mall)
+    facilities = manifest.get("facilities", {})
+    ELEVATOR_POSITIONS = facilities.get("elevators", {})
+    ESCALATOR_POSITIONS = facilities.get("escalators", {})
+    TOILET_POSITIONS = facilities.get("toilets", {})
+    FLOOR_ORDER = list(manifest["floor_order"])
+    VERTICAL_COSTS = dict(manifest.get("vertical_costs", VERTICAL_COSTS))
+    STORE_NAME_TO_CODE = dict(manifest.get("aliases", {}))
+    ACTIVE_MALL = mall
     
-    prompt = f"""Analyze this photo taken inside Times Square mall in Hong Kong (Causeway Bay).
+    MALL_GRAPH = MallGraph()
+    for cache in (_TOILET_FIELDS, _SHOP_GEOMETRY, _WALKABLE_LATTICES, _OCCUPANCY_GRIDS, _LAYER_CACHE):
+        cache.clear()
+    _MULTI_FLOOR_GRAPH[:] = [None, None]
+    _GRID_LOCALIZER[0] = None
+    RESOURCES.plans_dir = mall.plans_dir or generated_plans_dir()
+    RESOURCES.invalidate_floor_plans()
+    invalidate_prompt_templates()
+    rebuild_store_index()
+    return mall
+
+
+# =============================================================================
+# AI PHOTO ANALYSIS
+# =============================================================================
+
+# Concurrent analysis settings
+ANALYSIS_CONCURRENCY = int(os.getenv("ANALYSIS_CONCURRENCY", "8"))
+ANALYSIS_TIMEOUT = 90
+ANALYSIS_RETRIES = 4
+ANALYSIS_BACKOFF = 1.0          # seconds, doubled on every retry
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_HTTP_SESSION = None
+_HTTP_SESSION_LOCK = threading.Lock()
+
+def get_http_session() -> requests.Session:
+    """Shared keep-alive session, with a connection pool sized for ANALYSIS_CONCURRENCY."""
+    global _HTTP_SESSION
+    with _HTTP_SESSION_LOCK:
+        if _HTTP_SESSION is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(ANALYSIS_CONCURRENCY, 1))
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _HTTP_SESSION = session
+    return _HTTP_SESSION
+
+def request_with_retry(method, url, retries=None, backoff=None, **kwargs) -> requests.Response:
+    """
+    Request through the shared session, retrying connection errors and
+    429/5xx responses with exponential backoff (honouring Retry-After).
+    """
+    retries = ANALYSIS_RETRIES if retries is None else retries
+    backoff = ANALYSIS_BACKOFF if backoff is None else backoff
+    session = get_http_session()
+    for attempt in range(retries + 1):
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                response.raise_for_status()
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.replace(".", "", 1).isdigit() else backoff * 2 ** attempt
+        time.sleep(delay + random.uniform(0, backoff / 4))
+
+def post_with_retry(url, retries=None, backoff=None, **kwargs) -> requests.Response:
+    return request_with_retry("POST", url, retries, backoff, **kwargs)
+
+# Vision result cache
+VISION_MODEL = "gpt-4o"
+ANALYSIS_CACHE_ENABLED = os.getenv("ANALYSIS_CACHE", "1") != "0"
+ANALYSIS_CACHE_PATH = CACHE_DIR / "analysis.sqlite3"
+ANALYSIS_CACHE_MAX_ENTRIES = 10000
+ANALYSIS_CACHE_TTL = 30 * 24 * 3600      # seconds
+
+def analysis_cache_key(image_hash: str, prompt: str, model: str) -> str:
+    """Content address: image hash + prompt hash + model name."""
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    return f"{image_hash}:{prompt_hash}:{model}"
+
+def file_sha256(path: Path, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class AnalysisCache:
+    """
+    On-disk SQLite cache of parsed vision results. Entries expire after ttl
+    seconds; beyond max_entries the least recently used ones are evicted.
+    Safe to share between the analysis worker threads.
+    """
+
+    def __init__(self, path=ANALYSIS_CACHE_PATH, max_entries=ANALYSIS_CACHE_MAX_ENTRIES, ttl=ANALYSIS_CACHE_TTL):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS analysis (
+            key TEXT PRIMARY KEY, result TEXT NOT NULL,
+            created_at REAL NOT NULL, accessed_at REAL NOT NULL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS analysis_accessed ON analysis (accessed_at)")
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT result, created_at FROM analysis WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE analysis SET accessed_at = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, result: dict):
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?)",
+                             (key, json.dumps(result), now, now))
+            self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now):
+        if self.ttl:
+            self._db.execute("DELETE FROM analysis WHERE created_at < ?", (now - self.ttl,))
+        if self.max_entries:
+            self._db.execute("""DELETE FROM analysis WHERE key IN (
+                SELECT key FROM analysis ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)""", (self.max_entries,))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM analysis")
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM analysis").fetchone()[0]
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self)}
+
+_ANALYSIS_CACHE = None
+_ANALYSIS_CACHE_LOCK = threading.Lock()
+
+def get_analysis_cache() -> AnalysisCache:
+    global _ANALYSIS_CACHE
+    with _ANALYSIS_CACHE_LOCK:
+        if _ANALYSIS_CACHE is None:
+            _ANALYSIS_CACHE = AnalysisCache()
+    return _ANALYSIS_CACHE
+
+# Upload preprocessing: trade payload size against detail per deployment
+UPLOAD_MAX_EDGE = int(os.getenv("UPLOAD_MAX_EDGE", "1600"))   # pixels, 0 = keep size
+UPLOAD_FORMAT = os.getenv("UPLOAD_FORMAT", "JPEG")            # JPEG, WEBP or ORIGINAL
+UPLOAD_QUALITY = int(os.getenv("UPLOAD_QUALITY", "85"))
+UPLOAD_DETAIL = os.getenv("UPLOAD_DETAIL", "high")            # OpenAI image detail level
+
+@dataclass
+class PreparedImage:
+    mime: str
+    base64_data: str
+    bytes_before: int
+    bytes_after: int
+
+    @property
+    def data_url(self) -> str:
+        return f"data:{self.mime};base64,{self.base64_data}"
+
+def stream_base64(stream, chunk_size: int = 3 * 64 * 1024) -> str:
+    """Base64-encode a binary stream chunk by chunk (chunk_size must be a multiple of 3)."""
+    parts = []
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        parts.append(base64.b64encode(chunk).decode("ascii"))
+    return "".join(parts)
+
+def upload_settings() -> str:
+    """Preprocessing settings that change what the model sees (part of the cache key)."""
+    if UPLOAD_FORMAT.upper() == "ORIGINAL":
+        return f"original:{UPLOAD_DETAIL}"
+    return f"{UPLOAD_FORMAT.lower()}:{UPLOAD_MAX_EDGE}:{UPLOAD_QUALITY}:{UPLOAD_DETAIL}"
+
+def prepare_image_for_upload(image_path: Path, max_edge: int = None, fmt: str = None,
+                             quality: int = None) -> PreparedImage:
+    """
+    Downscale to max_edge, re-encode as JPEG/WebP at quality with all
+    metadata dropped, and base64-encode without holding a second copy
+    of the raw file. fmt="ORIGINAL" streams the file unchanged.
+    """
+    max_edge = UPLOAD_MAX_EDGE if max_edge is None else max_edge
+    fmt = (fmt or UPLOAD_FORMAT).upper()
+    quality = UPLOAD_QUALITY if quality is None else quality
+    bytes_before = image_path.stat().st_size
+
+    if fmt == "ORIGINAL":
+        mime = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp"}.get(
+            image_path.suffix.lower(), "image/png")
+        with open(image_path, "rb") as f:
+            return PreparedImage(mime, stream_base64(f), bytes_before, bytes_before)
+
+    with Image.open(image_path) as img:
+        if max_edge:
+            img.draft("RGB", (max_edge, max_edge))  # JPEG sources decode at reduced scale
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        if max_edge and max(img.size) > max_edge:
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
 
-REFERENCE: Official floor plan at {TIMES_SQUARE_FLOOR_PLAN_URL}
+        # Re-encoding without exif/icc arguments strips all metadata
+        buffer = io.BytesIO()
+        img.save(buffer, format=fmt, quality=quality, optimize=fmt == "JPEG")
+    bytes_after = buffer.tell()
+    buffer.seek(0)
+    return PreparedImage(f"image/{fmt.lower()}", stream_base64(buffer), bytes_before, bytes_after)
 
+# Two-stage mode: a cheap floor classification call, then a prompt carrying
+# only that floor's stores and facilities
+ANALYSIS_TWO_STAGE = os.getenv("ANALYSIS_TWO_STAGE", "0") == "1"
+FLOOR_CLASSIFIER_MODEL = os.getenv("FLOOR_CLASSIFIER_MODEL", "gpt-4o-mini")
+TWO_STAGE_MIN_CONFIDENCE = 0.5
+
+# (shop name, hint, floors it is on)
+KEY_STORE_HINTS = [
+    ("The Body Shop", "b217-218 (B2 far left)", ("B2",)),
+    ("Shake Shack", "b243 (B2 center)", ("B2",)),
+    ("Fortress", "807-808 (8F center)", ("8F",)),
+    ("Lane Crawford", "GF/1F large store", ("GF", "1F")),
+    ("city'super", "b1(a) (B1)", ("B1",)),
+]
+
+ANALYSIS_PROMPT_TEMPLATE = """Analyze this photo taken inside Times Square mall in Hong Kong (Causeway Bay).
+
+REFERENCE: Official floor plan at {reference_url}
+{floor_note}
 {store_ref}
 
 KEY STORES TO IDENTIFY:
-- The Body Shop = b217-218 (B2 far left)
-- Shake Shack = b243 (B2 center)
-- Fortress = 807-808 (8F center)
-- Lane Crawford = GF/1F large store
-- city'super = b1(a) (B1)
+{key_stores}
 
 TASK: 
 1. Identify visible shop names/signs
@@ -540,38 +1150,329 @@ Return ONLY valid JSON:
     "position_reasoning": "Standing in B2 walkway between Body Shop (left) and Shake Shack (right), facing NE toward elevator"
 }}"""
 
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {OPENAI_API_KEY}"}
-    payload = {
-        "model": "gpt-4o",
+FLOOR_PROMPT_TEMPLATE = """Which floor of Times Square mall in Hong Kong (Causeway Bay) was this photo taken on?
+
+FLOORS AND THE SHOPS THAT IDENTIFY THEM:
+{floor_list}
+
+Return ONLY valid JSON:
+{{"floor_estimate": "B2", "floor_confidence": 0.9}}"""
+
+class PromptTemplates:
+    """
+    Vision prompts compiled once from FLOOR_DATA / FLOOR_FACILITIES:
+    the full single-call prompt, one floor-scoped prompt per floor and
+    the floor classification prompt.
+    """
+
+    def __init__(self):
+        self.full = ANALYSIS_PROMPT_TEMPLATE.format(
+            reference_url=TIMES_SQUARE_FLOOR_PLAN_URL,
+            floor_note="",
+            store_ref=self._store_ref(FLOOR_DATA),
+            key_stores=self._key_stores(None),
+        )
+        self.by_floor = {}
+        for floor, floor_info in FLOOR_DATA.items():
+            self.by_floor[floor] = ANALYSIS_PROMPT_TEMPLATE.format(
+                reference_url=TIMES_SQUARE_FLOOR_PLAN_URL,
+                floor_note=f"\nThis photo was taken on {floor} ({floor_info['name']}). "
+                           f"Only that floor's stores and facilities are listed.\n",
+                store_ref=self._store_ref({floor: floor_info}) + self._facility_ref(floor),
+                key_stores=self._key_stores(floor),
+            )
+
+        floor_lines = []
+        for floor, floor_info in FLOOR_DATA.items():
+            named = [info["name"] for code, info in floor_info.get("stores", {}).items()
+                     if info.get("name", code) != code]
+            named += [name for name, _, floors in KEY_STORE_HINTS if floor in floors and name not in named]
+            floor_lines.append(f"- {floor} ({floor_info['name']}): {', '.join(named) or 'no named stores'}")
+        self.floor_classifier = FLOOR_PROMPT_TEMPLATE.format(floor_list="\n".join(floor_lines))
+
+        digest = hashlib.sha256()
+        for text in [self.full, self.floor_classifier, *self.by_floor.values()]:
+            digest.update(text.encode("utf-8"))
+        self.fingerprint = digest.hexdigest()
+
+    @staticmethod
+    def _store_ref(floors):
+        # Build store code reference from our database
+        store_ref = "STORE CODES FROM FLOOR PLAN:\n"
+        for floor_name, floor_info in floors.items():
+            stores = floor_info.get("stores", {})
+            if stores:
+                store_ref += f"\n{floor_name}:\n"
+                for code, info in stores.items():
+                    store_ref += f"  - {code}: {info.get('name', code)} (x={info['x']:.2f}, y={info['y']:.2f})\n"
+        return store_ref
+
+    @staticmethod
+    def _facility_ref(floor):
+        facility_ref = f"\nFACILITIES ON {floor}:\n"
+        floor_fac = FLOOR_FACILITIES.get(floor, {})
+        for key, table in (("elevators", ELEVATOR_POSITIONS), ("escalators", ESCALATOR_POSITIONS),
+                           ("toilets", TOILET_POSITIONS)):
+            for fac_id in floor_fac.get(key, []):
+                if fac_id in table:
+                    fac = table[fac_id]
+                    facility_ref += f"  - {fac['name']} (x={fac['x']:.2f}, y={fac['y']:.2f})\n"
+        return facility_ref
+
+    @staticmethod
+    def _key_stores(floor):
+        return "\n".join(f"- {name} = {hint}" for name, hint, floors in KEY_STORE_HINTS
+                         if floor is None or floor in floors)
+
+_PROMPT_TEMPLATES = None
+
+def get_prompt_templates() -> PromptTemplates:
+    global _PROMPT_TEMPLATES
+    if _PROMPT_TEMPLATES is None:
+        _PROMPT_TEMPLATES = PromptTemplates()
+    return _PROMPT_TEMPLATES
+
+def invalidate_prompt_templates():
+    """Recompile the prompts on next use; call after editing the store or facility tables."""
+    global _PROMPT_TEMPLATES
+    _PROMPT_TEMPLATES = None
+
+def build_analysis_prompt(floor: Optional[str] = None) -> str:
+    """Vision prompt embedding the store code table; floor-scoped when floor is given."""
+    templates = get_prompt_templates()
+    if floor is None:
+        return templates.full
+    return templates.by_floor[floor]
+
+def vision_payload(prompt: str, upload: PreparedImage, model: str = None,
+                   detail: str = None, max_tokens: int = 1500) -> dict:
+    """Chat completions request body for one photo + prompt."""
+    return {
+        "model": model or VISION_MODEL,
         "messages": [{"role": "user", "content": [
             {"type": "text", "text": prompt},
-            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{base64_image}", "detail": "high"}}
+            {"type": "image_url", "image_url": {"url": upload.data_url, "detail": detail or UPLOAD_DETAIL}}
         ]}],
-        "max_tokens": 1500
+        "max_tokens": max_tokens
     }
+
+def api_headers() -> dict:
+    return {"Authorization": f"Bearer {OPENAI_API_KEY}"}
+
+def request_vision_json(prompt: str, upload: PreparedImage, model: str = None,
+                        detail: str = None, max_tokens: int = 1500) -> dict:
+    """One vision call; returns the JSON object from the model's reply."""
+    payload = vision_payload(prompt, upload, model, detail, max_tokens)
+    response = post_with_retry(OPENAI_API_URL, headers=api_headers(), json=payload, timeout=ANALYSIS_TIMEOUT)
+    return parse_vision_reply(response.json())
+
+def parse_vision_reply(completion: dict) -> dict:
+    """The JSON object in a chat completion's reply, with or without a code fence."""
+    content = completion["choices"][0]["message"]["content"]
+    
+    # Extract JSON
+    if "```json" in content:
+        json_str = content.split("```json")[1].split("```")[0]
+    elif "```" in content:
+        json_str = content.split("```")[1].split("```")[0]
+    else:
+        json_str = content
+    return json.loads(json_str.strip())
+
+def analyze_photos(image_paths: List[Path], concurrency: Optional[int] = None) -> List[dict]:
+    """Analyze many photos concurrently. Results are returned in input order."""
+    image_paths = list(image_paths)
+    workers = max(1, min(concurrency or ANALYSIS_CONCURRENCY, len(image_paths) or 1))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(analyze_photo_with_ai, image_paths))
+
+def analyze_photo_with_ai(image_path: Path, use_cache: bool = True, two_stage: Optional[bool] = None) -> dict:
+    """
+    Analyze photo using OpenAI GPT-4 Vision with Times Square floor plan reference.
+    Reference: https://timessquare.com.hk/floor-plan/
+    Results are served from the analysis cache when possible (use_cache=False bypasses it).
+    With two_stage (default ANALYSIS_TWO_STAGE) a cheap call picks the floor first,
+    so the main call only carries that floor's stores.
+    """
+    if not OPENAI_API_KEY:
+        return analyze_photo_fallback(image_path)
+    
+    templates = get_prompt_templates()
+    two_stage = ANALYSIS_TWO_STAGE if two_stage is None else two_stage
+    if two_stage:
+        prompt_id = f"two-stage:{templates.fingerprint}"
+        model_id = f"{VISION_MODEL}+{FLOOR_CLASSIFIER_MODEL}"
+    else:
+        prompt_id, model_id = templates.full, VISION_MODEL
+    
+    # Identical photo + prompt + model: reuse the stored answer
+    cache = get_analysis_cache() if use_cache and ANALYSIS_CACHE_ENABLED else None
+    cache_key = analysis_cache_key(file_sha256(image_path), prompt_id, f"{model_id}|{upload_settings()}")
+    if cache is not None:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
     
     try:
-        response = requests.post("https://api.openai.com/v1/chat/completions", 
-                                headers=headers, json=payload, timeout=90)
-        response.raise_for_status()
-        content = response.json()["choices"][0]["message"]["content"]
-        
-        # Extract JSON
-        if "```json" in content:
-            json_str = content.split("```json")[1].split("```")[0]
-        elif "```" in content:
-            json_str = content.split("```")[1].split("```")[0]
-        else:
-            json_str = content
+        # Inside the try: an undecodable photo falls back like a failed call
+        upload = prepare_image_for_upload(image_path)
+        print(f"Upload {image_path.name}: {upload.bytes_before / 1024:.0f} KB -> {upload.bytes_after / 1024:.0f} KB")
+        
+        prompt = templates.full
+        floor_guess = {}
+        if two_stage:
+            floor_guess = request_vision_json(templates.floor_classifier, upload,
+                                              model=FLOOR_CLASSIFIER_MODEL, detail="low", max_tokens=100)
+            floor = floor_guess.get("floor_estimate")
+            if floor in templates.by_floor and float(floor_guess.get("floor_confidence", 0)) >= TWO_STAGE_MIN_CONFIDENCE:
+                prompt = templates.by_floor[floor]
         
-        result = json.loads(json_str.strip())
+        result = request_vision_json(prompt, upload)
+        for key in ("floor_estimate", "floor_confidence"):
+            if key not in result and key in floor_guess:
+                result[key] = floor_guess[key]
         result["location_reasoning"] = result.get("position_reasoning", "AI analysis")
+        if cache is not None:
+            cache.put(cache_key, result)
         return result
         
     except Exception as e:
         print(f"AI Analysis Error: {e}")
-        return analyze_photo_fallback(image_path)
+        # Flagged so callers that persist results don't keep the stand-in
+        return dict(analyze_photo_fallback(image_path), analysis_error=str(e))
+
+
+# Offline batch mode (--batch): every analysis request goes into one JSONL
+# request file, submitted as a single job to the batch endpoint
+# (POST /files, POST /batches, GET /batches/{id}, GET /files/{id}/content).
+# Cheaper per photo than interactive calls, at the cost of latency. Always
+# uses the single-stage prompt, since a second stage would need a second job.
+OPENAI_BATCH_BASE = os.getenv("OPENAI_BATCH_BASE", OPENAI_API_URL.rsplit("/chat/completions", 1)[0])
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "30"))     # seconds
+BATCH_MAX_WAIT = float(os.getenv("BATCH_MAX_WAIT", str(24 * 3600)))     # seconds
+BATCH_DIR = CACHE_DIR / "batches"
+BATCH_FINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+
+def batch_api(method, path, **kwargs) -> dict:
+    response = request_with_retry(method, f"{OPENAI_BATCH_BASE}{path}", headers=api_headers(),
+                                  timeout=ANALYSIS_TIMEOUT, **kwargs)
+    return response.json()
 
+def write_batch_requests(photos: List[Path], path: Path) -> Dict[str, str]:
+    """
+    One chat completions request per photo, custom_id = photo name. Returns
+    photo name -> error for photos that could not be prepared (left out).
+    """
+    prompt = get_prompt_templates().full
+    path.parent.mkdir(parents=True, exist_ok=True)
+    skipped = {}
+    with open(path, "w", encoding="utf-8") as f:
+        for photo in photos:
+            try:
+                upload = prepare_image_for_upload(photo)
+            except Exception as e:
+                skipped[photo.name] = f"cannot prepare photo: {e}"
+                continue
+            f.write(json.dumps({"custom_id": photo.name, "method": "POST", "url": "/v1/chat/completions",
+                                "body": vision_payload(prompt, upload)}) + "\n")
+    return skipped
+
+def submit_batch(request_path: Path) -> dict:
+    with open(request_path, "rb") as f:
+        uploaded = batch_api("POST", "/files", data={"purpose": "batch"},
+                             files={"file": (request_path.name, f, "application/jsonl")})
+    return batch_api("POST", "/batches", json={"input_file_id": uploaded["id"],
+                                               "endpoint": "/v1/chat/completions",
+                                               "completion_window": "24h"})
+
+def wait_for_batch(batch: dict) -> dict:
+    """Poll until the job reaches a final state (or BATCH_MAX_WAIT runs out)."""
+    deadline = time.time() + BATCH_MAX_WAIT
+    while batch.get("status") not in BATCH_FINAL_STATES:
+        if time.time() > deadline:
+            raise TimeoutError(f"batch {batch['id']} still {batch.get('status')} after {BATCH_MAX_WAIT:.0f}s")
+        time.sleep(BATCH_POLL_INTERVAL)
+        batch = batch_api("GET", f"/batches/{batch['id']}")
+        counts = batch.get("request_counts") or {}
+        print(f"Batch {batch['id']}: {batch.get('status')} "
+              f"({counts.get('completed', 0)}/{counts.get('total', '?')} done)")
+    return batch
+
+def read_batch_output(file_id) -> Dict[str, dict]:
+    """custom_id -> parsed analysis, or {"error": ...} for failed requests."""
+    response = request_with_retry("GET", f"{OPENAI_BATCH_BASE}/files/{file_id}/content",
+                                  headers=api_headers(), timeout=ANALYSIS_TIMEOUT)
+    results = {}
+    for line in response.text.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        reply = record.get("response") or {}
+        try:
+            if record.get("error") or reply.get("status_code") != 200:
+                raise ValueError(record.get("error") or f"status {reply.get('status_code')}")
+            result = parse_vision_reply(reply["body"])
+            result["location_reasoning"] = result.get("position_reasoning", "AI analysis")
+        except (ValueError, KeyError, IndexError) as e:
+            result = {"error": str(e)}
+        results[record["custom_id"]] = result
+    return results
+
+def analyze_photos_batch(image_paths: List[Path]) -> List[dict]:
+    """
+    Batch counterpart of analyze_photos(). Photos already in the analysis
+    cache are not resubmitted, results are written back to it, and failed
+    requests fall back (flagged with analysis_error). The submitted job is
+    remembered in cache/batches/, so re-running the same set of photos after
+    an interruption resumes polling instead of paying for a second job.
+    """
+    image_paths = list(image_paths)
+    cache = get_analysis_cache() if ANALYSIS_CACHE_ENABLED else None
+    prompt_id, model_id = get_prompt_templates().full, f"{VISION_MODEL}|{upload_settings()}"
+    keys = {photo.name: analysis_cache_key(file_sha256(photo), prompt_id, model_id) for photo in image_paths}
+    results = {photo.name: cache.get(keys[photo.name]) if cache is not None else None for photo in image_paths}
+    pending = [photo for photo in image_paths if results[photo.name] is None]
+    
+    if pending:
+        job_id = hashlib.sha1("\n".join(sorted(keys[p.name] for p in pending)).encode()).hexdigest()[:16]
+        state_path = BATCH_DIR / f"{job_id}.json"
+        batch, output = None, {}
+        if state_path.exists():
+            state = json.loads(state_path.read_text())
+            output = {name: {"error": error} for name, error in state.get("skipped", {}).items()}
+            batch = batch_api("GET", f"/batches/{state['id']}")
+            if batch.get("status") in {"failed", "expired", "cancelled"}:
+                batch = None
+        if batch is None:
+            request_path = BATCH_DIR / f"{job_id}.requests.jsonl"
+            skipped = write_batch_requests(pending, request_path)
+            # Unreadable photos fall back on their own instead of sinking the job
+            output = {name: {"error": error} for name, error in skipped.items()}
+            if len(skipped) < len(pending):
+                print(f"Submitting batch of {len(pending) - len(skipped)} requests "
+                      f"({request_path.stat().st_size / 1024:.0f} KB)")
+                batch = submit_batch(request_path)
+                state_path.write_text(json.dumps({"id": batch["id"], "photos": [p.name for p in pending],
+                                                  "skipped": skipped}))
+        
+        if batch is not None:
+            batch = wait_for_batch(batch)
+            for file_id in (batch.get("error_file_id"), batch.get("output_file_id")):
+                if file_id:
+                    output.update(read_batch_output(file_id))
+        status = batch["status"] if batch is not None else "not submitted"
+        for photo in pending:
+            result = output.get(photo.name) or {"error": f"batch {status} without a result"}
+            if "error" in result:
+                print(f"Batch analysis failed for {photo.name}: {result['error']}")
+                results[photo.name] = dict(analyze_photo_fallback(photo), analysis_error=result["error"])
+                continue
+            if cache is not None:
+                cache.put(keys[photo.name], result)
+            results[photo.name] = result
+        state_path.unlink(missing_ok=True)
+        (BATCH_DIR / f"{job_id}.requests.jsonl").unlink(missing_ok=True)
+    return [results[photo.name] for photo in image_paths]
 
 def analyze_photo_fallback(image_path: Path) -> dict:
     """Enhanced fallback analysis with accurate store positions."""
@@ -645,106 +1546,391 @@ def distance(p1, p2):
     return math.sqrt((p1[0]-p2[0])**2 + (p1[1]-p2[1])**2)
 
 def find_nearest_waypoint(floor, x, y):
-    waypoints = WALKWAY_WAYPOINTS.get(floor, {})
-    if not waypoints:
+    graph = get_floor_graph(floor)
+    if not len(graph):
         return None, (x, y)
-    return min(waypoints.items(), key=lambda wp: distance((x, y), wp[1]))
+    node = graph.spatial.nearest(x, y)[0]
+    return graph.names[node], graph.coords[node]
+
+class WaypointIndex:
+    """
+    Uniform-grid spatial index over a floor's waypoints. Results are ordered
+    by (distance, node id), so ties resolve in waypoint table order.
+    """
+
+    def __init__(self, coords):
+        self.coords = coords
+        self.cells = {}
+        if not coords:
+            self.size, self.cell, self.min_x, self.min_y = 0, 1.0, 0.0, 0.0
+            return
+        xs = [p[0] for p in coords]
+        ys = [p[1] for p in coords]
+        self.min_x, self.min_y = min(xs), min(ys)
+        span = max(max(xs) - self.min_x, max(ys) - self.min_y, 1e-9)
+        self.size = max(1, int(math.sqrt(len(coords))))
+        self.cell = span / self.size * (1 + 1e-9)
+        for node, (px, py) in enumerate(coords):
+            self.cells.setdefault(self._cell_of(px, py), []).append(node)
+
+    def _cell_of(self, x, y):
+        cx = int((x - self.min_x) // self.cell)
+        cy = int((y - self.min_y) // self.cell)
+        return (min(max(cx, 0), self.size - 1), min(max(cy, 0), self.size - 1))
+
+    def nearest(self, x, y, k=1):
+        """Ids of the k nearest waypoints to (x, y), closest first."""
+        if not self.coords:
+            return []
+        k = min(k, len(self.coords))
+        cx, cy = self._cell_of(x, y)
+        found = []
+        ring = 0
+        while True:
+            for gx in range(cx - ring, cx + ring + 1):
+                for gy in range(cy - ring, cy + ring + 1):
+                    if max(abs(gx - cx), abs(gy - cy)) == ring:
+                        for node in self.cells.get((gx, gy), ()):
+                            found.append((distance((x, y), self.coords[node]), node))
+            if ring >= self.size:
+                break
+            # Anything outside the searched square is at least this far away
+            bound = min(x - (self.min_x + (cx - ring) * self.cell),
+                        self.min_x + (cx + ring + 1) * self.cell - x,
+                        y - (self.min_y + (cy - ring) * self.cell),
+                        self.min_y + (cy + ring + 1) * self.cell - y)
+            if len(found) >= k and sorted(found)[k - 1][0] < bound:
+                break
+            ring += 1
+        return [node for _, node in sorted(found)[:k]]
+
+    def within(self, x, y, radius):
+        """Ids of all waypoints within radius of (x, y), closest first."""
+        if not self.coords:
+            return []
+        lo_x, lo_y = self._cell_of(x - radius, y - radius)
+        hi_x, hi_y = self._cell_of(x + radius, y + radius)
+        found = []
+        for gx in range(lo_x, hi_x + 1):
+            for gy in range(lo_y, hi_y + 1):
+                for node in self.cells.get((gx, gy), ()):
+                    d = distance((x, y), self.coords[node])
+                    if d <= radius:
+                        found.append((d, node))
+        return [node for _, node in sorted(found)]
+
+class FloorGraph:
+    """
+    Walkway graph for a single floor, built once from the waypoint tables.
+    Nodes are integer ids; adjacency is stored as flat arrays (CSR layout)
+    with edge lengths precomputed.
+    """
+
+    def __init__(self, floor, waypoints, connections):
+        self.floor = floor
+        self.names = list(waypoints)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.coords = [waypoints[name] for name in self.names]
+
+        neighbors = [[] for _ in self.names]
+        for wp1, wp2 in connections:
+            if wp1 in self.index and wp2 in self.index:
+                i, j = self.index[wp1], self.index[wp2]
+                d = distance(self.coords[i], self.coords[j])
+                neighbors[i].append((j, d))
+                neighbors[j].append((i, d))
+
+        # offsets[i]:offsets[i+1] slices the targets/weights of node i
+        self.offsets = [0]
+        self.targets = []
+        self.weights = []
+        for edges in neighbors:
+            for j, d in edges:
+                self.targets.append(j)
+                self.weights.append(d)
+            self.offsets.append(len(self.targets))
+
+        self.spatial = WaypointIndex(self.coords)
+
+    def __len__(self):
+        return len(self.names)
+
+    def neighbors(self, node):
+        lo, hi = self.offsets[node], self.offsets[node + 1]
+        return zip(self.targets[lo:hi], self.weights[lo:hi])
+
+    def astar(self, start, goal):
+        """A* between two node ids. Returns the list of node ids, or None if unreachable."""
+        coords = self.coords
+        goal_pos = coords[goal]
+        g_score = [float('inf')] * len(self.names)
+        g_score[start] = 0
+        came_from = {}
+        open_set = [(0, start)]
+
+        while open_set:
+            _, current = heapq.heappop(open_set)
+            if current == goal:
+                path = [current]
+                while current in came_from:
+                    current = came_from[current]
+                    path.append(current)
+                return path[::-1]
+
+            for neighbor, cost in self.neighbors(current):
+                tentative = g_score[current] + cost
+                if tentative < g_score[neighbor]:
+                    came_from[neighbor] = current
+                    g_score[neighbor] = tentative
+                    h = distance(coords[neighbor], goal_pos)
+                    heapq.heappush(open_set, (tentative + h, neighbor))
+        return None
+
+    def to_dict(self):
+        """Adjacency as {name: [(neighbor_name, cost), ...]}."""
+        return {name: [(self.names[j], d) for j, d in self.neighbors(i)]
+                for i, name in enumerate(self.names)}
+
+
+class MallGraph:
+    """
+    Per-floor FloorGraph cache. Each floor's graph is rebuilt only when its
+    entries in WALKWAY_WAYPOINTS / WALKWAY_CONNECTIONS change.
+    """
+
+    def __init__(self, waypoints=None, connections=None):
+        self.waypoints = WALKWAY_WAYPOINTS if waypoints is None else waypoints
+        self.connections = WALKWAY_CONNECTIONS if connections is None else connections
+        self._graphs = {}
+
+    def _signature(self, floor):
+        token = table_token(self.waypoints, floor)
+        if token is not None:
+            return token
+        waypoints = self.waypoints.get(floor, {})
+        connections = self.connections.get(floor, [])
+        return hash((tuple(waypoints.items()), tuple(connections)))
+
+    def floor(self, floor):
+        signature = self._signature(floor)
+        cached = self._graphs.get(floor)
+        if cached is None or cached[0] != signature:
+            graph = FloorGraph(floor, self.waypoints.get(floor, {}), self.connections.get(floor, []))
+            cached = self._graphs[floor] = (signature, graph)
+        return cached[1]
+
+    def invalidate(self, floor=None):
+        if floor is None:
+            self._graphs.clear()
+        else:
+            self._graphs.pop(floor, None)
+
+
+MALL_GRAPH = MallGraph()
+
+def get_floor_graph(floor):
+    return MALL_GRAPH.floor(floor)
 
 def build_graph(floor):
-    waypoints = WALKWAY_WAYPOINTS.get(floor, {})
-    connections = WALKWAY_CONNECTIONS.get(floor, [])
-    graph = {wp: [] for wp in waypoints}
-    for wp1, wp2 in connections:
-        if wp1 in waypoints and wp2 in waypoints:
-            d = distance(waypoints[wp1], waypoints[wp2])
-            graph[wp1].append((wp2, d))
-            graph[wp2].append((wp1, d))
-    return graph
+    return get_floor_graph(floor).to_dict()
 
 def astar_path(floor, start_wp, end_wp):
-    waypoints = WALKWAY_WAYPOINTS.get(floor, {})
-    graph = build_graph(floor)
-    if start_wp not in graph or end_wp not in graph:
+    graph = get_floor_graph(floor)
+    if start_wp not in graph.index or end_wp not in graph.index:
         return [start_wp, end_wp]
-    
-    open_set = [(0, start_wp)]
-    came_from = {}
-    g_score = {wp: float('inf') for wp in waypoints}
-    g_score[start_wp] = 0
-    
-    while open_set:
-        _, current = heapq.heappop(open_set)
-        if current == end_wp:
-            path = [current]
-            while current in came_from:
-                current = came_from[current]
-                path.append(current)
-            return path[::-1]
-        
-        for neighbor, cost in graph.get(current, []):
-            tentative = g_score[current] + cost
-            if tentative < g_score[neighbor]:
-                came_from[neighbor] = current
-                g_score[neighbor] = tentative
-                h = distance(waypoints[neighbor], waypoints[end_wp])
-                heapq.heappush(open_set, (tentative + h, neighbor))
-    return [start_wp, end_wp]
+    path = graph.astar(graph.index[start_wp], graph.index[end_wp])
+    if path is None:
+        return [start_wp, end_wp]
+    return [graph.names[i] for i in path]
 
 def get_floor_toilets(floor):
     floor_wc = FLOOR_FACILITIES.get(floor, {}).get("toilets", [])
     return [dict(TOILET_POSITIONS[wc_id], id=wc_id) for wc_id in floor_wc if wc_id in TOILET_POSITIONS]
 
+class ToiletDistanceField:
+    """
+    Multi-source Dijkstra run outward from every toilet on a floor.
+    For each waypoint stores the walking distance to the closest toilet,
+    which toilet that is, and the next waypoint on the way there.
+    """
+
+    def __init__(self, graph, toilets):
+        self.graph = graph
+        self.toilets = toilets
+        n = len(graph)
+        self.dist = [float('inf')] * n
+        self.target = [-1] * n
+        self.next_hop = [-1] * n
+
+        # Each toilet is reached from the waypoint nearest to it, so seed that
+        # waypoint with the final straight hop to the toilet itself.
+        open_set = []
+        sources = []
+        for t, toilet in enumerate(toilets):
+            pos = (toilet["x"], toilet["y"])
+            node = graph.spatial.nearest(*pos)[0]
+            sources.append(node)
+            d = distance(graph.coords[node], pos)
+            if d < self.dist[node]:
+                self.dist[node] = d
+                self.target[node] = t
+                heapq.heappush(open_set, (d, node))
+
+        def hop_rank(node, hop):
+            # Equal-length detours are resolved the way A* toward the toilet
+            # would: prefer the hop that heads most directly at it.
+            goal = graph.coords[sources[self.target[hop]]]
+            return distance(graph.coords[node], graph.coords[hop]) + distance(graph.coords[hop], goal)
+
+        while open_set:
+            d, current = heapq.heappop(open_set)
+            if d > self.dist[current]:
+                continue
+            for neighbor, cost in graph.neighbors(current):
+                tentative = d + cost
+                if tentative < self.dist[neighbor] - 1e-12:
+                    self.dist[neighbor] = tentative
+                    self.target[neighbor] = self.target[current]
+                    self.next_hop[neighbor] = current
+                    heapq.heappush(open_set, (tentative, neighbor))
+                elif (cost > 1e-12 and tentative <= self.dist[neighbor] + 1e-12
+                      and self.target[neighbor] == self.target[current]
+                      and self.next_hop[neighbor] >= 0
+                      and hop_rank(neighbor, current) < hop_rank(neighbor, self.next_hop[neighbor])):
+                    self.next_hop[neighbor] = current
+
+    def route(self, start_wp):
+        """Return (toilet, [waypoint positions]) from start_wp, or None if no toilet is reachable."""
+        node = self.graph.index.get(start_wp)
+        if node is None or self.target[node] < 0:
+            return None
+        positions = [self.graph.coords[node]]
+        while self.next_hop[node] >= 0:
+            node = self.next_hop[node]
+            positions.append(self.graph.coords[node])
+        return self.toilets[self.target[node]], positions
+
+
+_TOILET_FIELDS = {}
+
+def get_toilet_field(floor):
+    """Cached ToiletDistanceField for a floor, rebuilt when the graph or toilet list changes."""
+    graph = get_floor_graph(floor)
+    if not len(graph):
+        return None
+    toilets = get_floor_toilets(floor)
+    signature = hash(tuple((t["id"], t["x"], t["y"]) for t in toilets))
+    cached = _TOILET_FIELDS.get(floor)
+    if cached is None or cached[0] is not graph or cached[1] != signature:
+        cached = _TOILET_FIELDS[floor] = (graph, signature, ToiletDistanceField(graph, toilets))
+    return cached[2]
+
+def path_length(path):
+    return sum(distance(path[i], path[i+1]) for i in range(len(path)-1))
+
+# Shops are approximated as boxes of this half-size around their position
+SHOP_HALF_WIDTH = 0.06
+SHOP_HALF_HEIGHT = 0.04
+
+class ShopGeometry:
+    """
+    Shop footprints for one floor as an (N, 4) array of boxes
+    (x1, y1, x2, y2), for exact batched segment-vs-shop tests.
+    """
+
+    def __init__(self, stores):
+        self.codes = list(stores)
+        centers = np.array([(info["x"], info["y"]) for info in stores.values()], dtype=float).reshape(-1, 2)
+        half = np.array([SHOP_HALF_WIDTH, SHOP_HALF_HEIGHT])
+        self.boxes = np.hstack([centers - half, centers + half])
+
+    def __len__(self):
+        return len(self.codes)
+
+    def contains(self, points):
+        """(M, N) mask: point m lies inside (or on the edge of) shop n."""
+        p = np.asarray(points, dtype=float).reshape(-1, 2)[:, None, :]
+        return ((p >= self.boxes[None, :, :2]) & (p <= self.boxes[None, :, 2:])).all(axis=2)
+
+    def segment_hits(self, starts, ends):
+        """
+        (M, N) mask: segment m (starts[m] -> ends[m]) touches shop n.
+        Exact slab (Liang-Barsky) clipping of every segment against every box.
+        """
+        p = np.asarray(starts, dtype=float).reshape(-1, 2)
+        d = np.asarray(ends, dtype=float).reshape(-1, 2) - p
+        p, d = p[:, None, :], d[:, None, :]
+        lo, hi = self.boxes[None, :, :2], self.boxes[None, :, 2:]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t1 = (lo - p) / d
+            t2 = (hi - p) / d
+        t_near = np.minimum(t1, t2)
+        t_far = np.maximum(t1, t2)
+
+        # Axis-parallel segments: that axis never limits t, unless the
+        # segment lies outside the box's slab entirely
+        flat = d == 0
+        inside = (p >= lo) & (p <= hi)
+        t_near = np.where(flat, np.where(inside, -np.inf, np.inf), t_near)
+        t_far = np.where(flat, np.where(inside, np.inf, -np.inf), t_far)
+
+        enter = np.maximum(t_near.max(axis=2), 0.0)
+        leave = np.minimum(t_far.min(axis=2), 1.0)
+        return enter <= leave
+
+    def blocked(self, starts, ends, ignore_endpoint_shops=True):
+        """
+        (M,) mask: segment m crosses at least one shop. Shops containing the
+        segment's start or end are ignored by default: the walker is leaving
+        or entering them, and many walkway waypoints sit inside a shop box.
+        """
+        hits = self.segment_hits(starts, ends)
+        if ignore_endpoint_shops:
+            hits &= ~(self.contains(starts) | self.contains(ends))
+        return hits.any(axis=1)
+
+
+_SHOP_GEOMETRY = {}
+
+def get_shop_geometry(floor, stores=None):
+    """Cached ShopGeometry for a floor, rebuilt when its store table changes."""
+    if stores is None:
+        stores = FLOOR_DATA.get(floor, {}).get("stores", {})
+    signature = hash(tuple((code, info["x"], info["y"]) for code, info in stores.items()))
+    cached = _SHOP_GEOMETRY.get(floor)
+    if cached is None or cached[0] != signature:
+        cached = _SHOP_GEOMETRY[floor] = (signature, ShopGeometry(stores))
+    return cached[1]
+
+def segments_cross_shops(floor, starts, ends):
+    """Batched obstruction test: which of the segments starts[i] -> ends[i] cross a shop on this floor."""
+    return get_shop_geometry(floor).blocked(starts, ends)
+
 def find_best_entry_waypoint(floor, x, y, stores):
     """Find the best waypoint to enter the path network without crossing shops."""
     waypoints = WALKWAY_WAYPOINTS.get(floor, {})
     if not waypoints:
         return None
     
-    # Get store bounding boxes to avoid
-    store_boxes = []
-    for code, info in stores.items():
-        sx, sy = info["x"], info["y"]
-        # Approximate shop as a box
-        half_w = 0.06  # Half width
-        half_h = 0.04  # Half height
-        store_boxes.append((sx - half_w, sy - half_h, sx + half_w, sy + half_h))
-    
-    def line_crosses_shop(p1, p2):
-        """Check if a line segment crosses any shop."""
-        for (x1, y1, x2, y2) in store_boxes:
-            # Simple check: if line's bounding box overlaps shop and line passes through
-            min_x, max_x = min(p1[0], p2[0]), max(p1[0], p2[0])
-            min_y, max_y = min(p1[1], p2[1]), max(p1[1], p2[1])
-            
-            # Check bounding box overlap
-            if max_x < x1 or min_x > x2 or max_y < y1 or min_y > y2:
-                continue
-            
-            # Line might cross this shop - check more carefully
-            # Use simple midpoint check
-            mid_x = (p1[0] + p2[0]) / 2
-            mid_y = (p1[1] + p2[1]) / 2
-            if x1 <= mid_x <= x2 and y1 <= mid_y <= y2:
-                return True
-        return False
-    
-    # Find waypoints sorted by distance, but prefer ones that don't cross shops
-    candidates = sorted(waypoints.items(), key=lambda wp: distance((x, y), wp[1]))
+    # Find nearest waypoints, but prefer ones that don't cross shops
+    graph = get_floor_graph(floor)
+    candidates = graph.spatial.nearest(x, y, 5)  # Check top 5 nearest
     
     # Try to find a waypoint that doesn't require crossing a shop
-    for wp_name, wp_pos in candidates[:5]:  # Check top 5 nearest
-        if not line_crosses_shop((x, y), wp_pos):
-            return wp_name
+    if candidates:
+        ends = [graph.coords[node] for node in candidates]
+        blocked = get_shop_geometry(floor, stores).blocked([(x, y)] * len(ends), ends)
+        for node, is_blocked in zip(candidates, blocked):
+            if not is_blocked:
+                return graph.names[node]
     
     # Fallback to nearest
-    return candidates[0][0] if candidates else None
+    return graph.names[candidates[0]] if candidates else None
 
 
-def find_path_to_toilet(floor, x, y, toilet):
-    waypoints = WALKWAY_WAYPOINTS.get(floor, {})
-    if not waypoints:
-        return [(x, y), (toilet["x"], toilet["y"])]
-    
+def find_entry_waypoint(floor, x, y):
+    """Waypoint where a walker at (x, y) joins the path network."""
     # Get floor stores to avoid crossing
     floor_stores = FLOOR_DATA.get(floor, {}).get("stores", {})
     
@@ -752,9 +1938,23 @@ def find_path_to_toilet(floor, x, y, toilet):
     start_wp = find_best_entry_waypoint(floor, x, y, floor_stores)
     if not start_wp:
         start_wp, _ = find_nearest_waypoint(floor, x, y)
+    return start_wp
+
+def find_path_to_toilet(floor, x, y, toilet, backend="waypoints"):
+    """Route from (x, y) to a toilet over the waypoint graph, or the occupancy grid with backend="grid"."""
+    if backend == "grid":
+        path = get_occupancy_grid(floor).find_path((x, y), (toilet["x"], toilet["y"]))
+        if path:
+            return path
+    
+    waypoints = WALKWAY_WAYPOINTS.get(floor, {})
+    if not waypoints:
+        return [(x, y), (toilet["x"], toilet["y"])]
+    
+    start_wp = find_entry_waypoint(floor, x, y)
     
     # Find waypoint nearest to toilet
-    toilet_wp = min(waypoints.items(), key=lambda wp: distance(wp[1], (toilet["x"], toilet["y"])))[0]
+    toilet_wp, _ = find_nearest_waypoint(floor, toilet["x"], toilet["y"])
     
     # Get A* path through waypoints
     wp_path = astar_path(floor, start_wp, toilet_wp)
@@ -768,35 +1968,253 @@ def find_path_to_toilet(floor, x, y, toilet):
     
     return path
 
-def find_nearest_toilet(floor, x, y):
-    toilets = get_floor_toilets(floor)
-    
-    nearest = None
-    nearest_path = []
-    nearest_dist = float('inf')
-    
-    for toilet in toilets:
-        path = find_path_to_toilet(floor, x, y, toilet)
-        walk_dist = sum(distance(path[i], path[i+1]) for i in range(len(path)-1))
-        if walk_dist < nearest_dist:
-            nearest_dist = walk_dist
-            nearest = toilet
-            nearest_path = path
-    
-    # Check other floors if no toilet on current floor
-    if nearest is None:
-        floor_idx = FLOOR_ORDER.index(floor) if floor in FLOOR_ORDER else 0
-        for offset in [1, -1, 2, -2]:
-            check_idx = floor_idx + offset
-            if 0 <= check_idx < len(FLOOR_ORDER):
-                check_floor = FLOOR_ORDER[check_idx]
-                for toilet in get_floor_toilets(check_floor):
-                    dist = distance((x, y), (toilet["x"], toilet["y"])) + abs(offset) * 0.15
-                    if dist < nearest_dist:
-                        nearest_dist = dist
-                        nearest = toilet
-                        nearest["floor"] = check_floor
-                        nearest_path = [(x, y), (0.47, 0.42), (toilet["x"], toilet["y"])]
+class MultiFloorGraph:
+    """
+    3-D routing graph: every floor's walkway graph, plus a node per
+    lift/escalator/toilet on each floor. Lifts and escalators listed on
+    consecutive mapped floors are linked by vertical edges whose cost is
+    VERTICAL_COSTS[kind] per level travelled.
+    """
+
+    FACILITY_KINDS = (("elevator", "elevators"), ("escalator", "escalators"), ("toilet", "toilets"))
+
+    def __init__(self, floor_graphs, vertical_costs):
+        # The current tables, not the ones at import: activate_mall() replaces them
+        facilities = [(kind, key, FACILITY_TABLES[key]()) for kind, key in self.FACILITY_KINDS]
+        self.vertical_costs = dict(vertical_costs)
+        self.min_level_cost = min(self.vertical_costs.values(), default=0.0)
+        self.floor = []    # floor name per node
+        self.level = []    # FLOOR_ORDER index per node
+        self.coords = []   # (x, y) per node
+        self.kind = []     # "waypoint" / "elevator" / "escalator" / "toilet"
+        self.ref = []      # waypoint name or facility id
+        self.index = {}    # (floor, ref) -> node id
+        edges = []
+
+        for floor, graph in floor_graphs.items():
+            base = len(self.coords)
+            for i, name in enumerate(graph.names):
+                self._add_node(floor, graph.coords[i], "waypoint", name)
+            for i in range(len(graph)):
+                for j, d in graph.neighbors(i):
+                    if i < j:
+                        edges.append((base + i, base + j, d))
+
+            # Facilities join the floor at their nearest waypoint
+            for kind, key, table in facilities:
+                for fac_id in FLOOR_FACILITIES.get(floor, {}).get(key, []):
+                    if fac_id not in table:
+                        continue
+                    pos = (table[fac_id]["x"], table[fac_id]["y"])
+                    node = self._add_node(floor, pos, kind, fac_id)
+                    if len(graph):
+                        wp = graph.spatial.nearest(*pos)[0]
+                        edges.append((node, base + wp, distance(graph.coords[wp], pos)))
+
+        # Vertical edges between consecutive mapped floors sharing a lift/escalator
+        by_level = sorted(floor_graphs, key=floor_level)
+        for kind, key, table in facilities:
+            if kind not in self.vertical_costs:
+                continue
+            for fac_id in table:
+                stops = [f for f in by_level if (f, fac_id) in self.index]
+                for lower, upper in zip(stops, stops[1:]):
+                    levels = floor_level(upper) - floor_level(lower)
+                    edges.append((self.index[(lower, fac_id)], self.index[(upper, fac_id)],
+                                  self.vertical_costs[kind] * levels))
+
+        neighbors = [[] for _ in self.coords]
+        for i, j, d in edges:
+            neighbors[i].append((j, d))
+            neighbors[j].append((i, d))
+        self.offsets = [0]
+        self.targets = []
+        self.weights = []
+        for node_edges in neighbors:
+            for j, d in node_edges:
+                self.targets.append(j)
+                self.weights.append(d)
+            self.offsets.append(len(self.targets))
+
+    def _add_node(self, floor, pos, kind, ref):
+        node = len(self.coords)
+        self.floor.append(floor)
+        self.level.append(floor_level(floor))
+        self.coords.append(pos)
+        self.kind.append(kind)
+        self.ref.append(ref)
+        self.index[(floor, ref)] = node
+        return node
+
+    def neighbors(self, node):
+        lo, hi = self.offsets[node], self.offsets[node + 1]
+        return zip(self.targets[lo:hi], self.weights[lo:hi])
+
+    def heuristic(self, node, goal):
+        # Planar distance never overestimates walking, and each level changed
+        # costs at least the cheapest vertical edge per level.
+        return (distance(self.coords[node], self.coords[goal])
+                + self.min_level_cost * abs(self.level[node] - self.level[goal]))
+
+    def astar(self, start, goals):
+        """A* from start to the closest of several goal nodes. Returns (node path, cost) or None."""
+        goals = set(goals)
+        if not goals:
+            return None
+        h = lambda node: min(self.heuristic(node, goal) for goal in goals)
+        g_score = {start: 0.0}
+        came_from = {}
+        open_set = [(h(start), start)]
+
+        while open_set:
+            f, current = heapq.heappop(open_set)
+            if current in goals:
+                path = [current]
+                while current in came_from:
+                    current = came_from[current]
+                    path.append(current)
+                return path[::-1], g_score[path[0]]
+            if f > g_score[current] + h(current) + 1e-12:
+                continue
+
+            for neighbor, cost in self.neighbors(current):
+                tentative = g_score[current] + cost
+                if tentative < g_score.get(neighbor, float('inf')):
+                    came_from[neighbor] = current
+                    g_score[neighbor] = tentative
+                    heapq.heappush(open_set, (tentative + h(neighbor), neighbor))
+        return None
+
+    def shortest_paths(self):
+        """
+        All-pairs walking costs as (distances, predecessors), both (N, N):
+        one Dijkstra per node, computed on first use. predecessors[s, n] is
+        the node before n on the cheapest path from s (-1 for s or unreachable).
+        """
+        if getattr(self, "_shortest", None) is None:
+            n = len(self.coords)
+            dist = np.full((n, n), np.inf)
+            pred = np.full((n, n), -1, dtype=int)
+            for source in range(n):
+                row, back = dist[source], pred[source]
+                row[source] = 0.0
+                heap = [(0.0, source)]
+                while heap:
+                    d, node = heapq.heappop(heap)
+                    if d > row[node]:
+                        continue
+                    for neighbor, cost in self.neighbors(node):
+                        if d + cost < row[neighbor]:
+                            row[neighbor] = d + cost
+                            back[neighbor] = node
+                            heapq.heappush(heap, (d + cost, neighbor))
+            self._shortest = (dist, pred)
+        return self._shortest
+
+    def path_between(self, start, goal):
+        """Node path start -> goal from shortest_paths(), or None if unreachable."""
+        _, pred = self.shortest_paths()
+        path = [goal]
+        while path[-1] != start:
+            if pred[start, path[-1]] < 0:
+                return None
+            path.append(int(pred[start, path[-1]]))
+        return path[::-1]
+
+    def legs(self, path):
+        """Split a node path into per-floor legs: [{"floor", "path", "via"}]."""
+        legs = []
+        for node in path:
+            floor = self.floor[node]
+            if not legs or legs[-1]["floor"] != floor:
+                via = None
+                if legs:
+                    via = self.ref[node]
+                    legs[-1]["via"] = via
+                legs.append({"floor": floor, "path": [], "via": None, "from": via})
+            legs[-1]["path"].append(self.coords[node])
+        return legs
+
+
+def floor_level(floor):
+    return FLOOR_ORDER.index(floor) if floor in FLOOR_ORDER else 0
+
+_MULTI_FLOOR_GRAPH = [None, None]
+
+def get_multi_floor_graph():
+    """Cached MultiFloorGraph, rebuilt when any floor graph, facility list or cost changes."""
+    floor_graphs = {floor: get_floor_graph(floor) for floor in FLOOR_FACILITIES}
+    signature = (tuple(map(id, floor_graphs.values())),
+                 table_token(FLOOR_FACILITIES) or repr(FLOOR_FACILITIES),
+                 repr((ELEVATOR_POSITIONS, ESCALATOR_POSITIONS, TOILET_POSITIONS)),
+                 repr(sorted(VERTICAL_COSTS.items())))
+    if _MULTI_FLOOR_GRAPH[0] != signature:
+        _MULTI_FLOOR_GRAPH[:] = [signature, MultiFloorGraph(floor_graphs, VERTICAL_COSTS)]
+    return _MULTI_FLOOR_GRAPH[1]
+
+def find_cross_floor_toilet(floor, x, y):
+    """One A* over the multi-floor graph from (x, y) to the closest toilet on any floor."""
+    graph = get_multi_floor_graph()
+    start_wp = find_entry_waypoint(floor, x, y)
+    start = graph.index.get((floor, start_wp))
+    if start is None:
+        return None
+    goals = [n for n, kind in enumerate(graph.kind) if kind == "toilet" and graph.floor[n] != floor]
+    found = graph.astar(start, goals)
+    if found is None:
+        return None
+
+    path, cost = found
+    legs = graph.legs(path)
+    legs[0]["path"].insert(0, (x, y))
+    goal = path[-1]
+    toilet = dict(TOILET_POSITIONS[graph.ref[goal]], id=graph.ref[goal], floor=graph.floor[goal])
+    return {
+        "toilet": toilet,
+        "legs": legs,
+        "distance": cost + distance((x, y), graph.coords[start]),
+    }
+
+def find_nearest_toilet(floor, x, y, backend=None):
+    backend = backend or NAVIGATION_BACKEND
+    toilets = get_floor_toilets(floor)
+    
+    nearest = None
+    nearest_path = []
+    nearest_dist = float('inf')
+    
+    # Precomputed distance field: one entry snap plus a table lookup
+    field = get_toilet_field(floor) if toilets and backend == "waypoints" else None
+    route = field.route(find_entry_waypoint(floor, x, y)) if field else None
+    if route:
+        nearest, positions = route
+        nearest_path = [(x, y)] + positions + [(nearest["x"], nearest["y"])]
+        nearest_dist = path_length(nearest_path)
+    
+    # Grid backend, or entry point cut off from every toilet: search each one individually
+    for toilet in (toilets if nearest is None else []):
+        path = find_path_to_toilet(floor, x, y, toilet, backend)
+        walk_dist = path_length(path)
+        if walk_dist < nearest_dist:
+            nearest_dist = walk_dist
+            nearest = toilet
+            nearest_path = path
+    
+    legs = None
+    instructions = None
+    
+    # Check other floors if no toilet on current floor
+    if nearest is None:
+        route = find_cross_floor_toilet(floor, x, y)
+        if route:
+            nearest = route["toilet"]
+            legs = route["legs"]
+            nearest_path = legs[0]["path"]
+            nearest_dist = route["distance"]
+            via = legs[0]["via"]
+            via_name = (ELEVATOR_POSITIONS.get(via) or ESCALATOR_POSITIONS.get(via) or {}).get("name", via)
+            instructions = (f"Take {via_name} to {nearest['floor']}, "
+                            f"{nearest_dist * 100:.0f}m to {nearest.get('name', 'Toilet')}")
     
     if nearest is None:
         nearest = {"x": 0.08, "y": 0.22, "name": "Toilets", "accessible": True}
@@ -806,37 +2224,784 @@ def find_nearest_toilet(floor, x, y):
     return {
         "toilet": nearest,
         "path": nearest_path,
+        "legs": legs or [{"floor": floor, "path": nearest_path, "via": None, "from": None}],
         "distance_m": nearest_dist * 100,
         "same_floor": nearest.get("floor") is None or nearest.get("floor") == floor,
-        "instructions": f"Walk {nearest_dist * 100:.0f}m to {nearest.get('name', 'Toilet')}",
+        "instructions": instructions or f"Walk {nearest_dist * 100:.0f}m to {nearest.get('name', 'Toilet')}",
     }
 
 
+# =============================================================================
+# OCCUPANCY GRID NAVIGATION
+# Alternate routing backend: each floor rasterized from floor_plans/*.png
+# plus the shop boxes into a bitmap, searched with Jump Point Search
+# =============================================================================
+
+# Routing backend used by find_nearest_toilet(): "waypoints" or "grid"
+NAVIGATION_BACKEND = "waypoints"
+
+GRID_CELLS = 200          # cells per normalized unit (0.005 = 0.5m per cell)
+PLAN_MARGIN = 60          # pixel margin used when the floor plans were rendered
+WALKABLE_COLORS = ["#2d3142", "#3d4157", "#ffffff"]  # floor, floor accent, white walkways
+WALKABLE_TOLERANCE = 24
+
+SQRT2 = math.sqrt(2)
+
+class OccupancyGrid:
+    """
+    Walkability bitmap for one floor over the normalized (0-1) square.
+    Stored packed (1 bit per cell) on disk. Searched with Jump Point Search
+    using JPS+ style tables: for every cell and straight direction, the
+    next cell where a straight jump must stop (wall or forced neighbour),
+    so straight jumps are a single lookup.
+    """
+
+    STRAIGHT = ((1, 0), (-1, 0), (0, 1), (0, -1))
+    DIAGONAL = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+
+    def __init__(self, floor, free):
+        self.floor = floor
+        self.height, self.width = free.shape
+        self.free = free
+
+        # Search tables use a one-cell blocked border, so no bounds checks
+        padded = np.zeros((self.height + 2, self.width + 2), dtype=bool)
+        padded[1:-1, 1:-1] = free
+        self._open = padded.tolist()
+        self._stops = {d: self._stop_table(padded, *d).tolist() for d in self.STRAIGHT}
+
+    @staticmethod
+    def _stop_table(padded, dx, dy):
+        """For each cell, the coordinate along (dx, dy) of the first wall or forced neighbour."""
+        def at(ox, oy):
+            # padded shifted so that at(ox, oy)[y, x] == padded[y + oy, x + ox]
+            shifted = np.zeros_like(padded)
+            h, w = padded.shape
+            ys = slice(max(oy, 0), h + min(oy, 0))
+            xs = slice(max(ox, 0), w + min(ox, 0))
+            yd = slice(max(-oy, 0), h + min(-oy, 0))
+            xd = slice(max(-ox, 0), w + min(-ox, 0))
+            shifted[yd, xd] = padded[ys, xs]
+            return shifted
+
+        if dx:
+            forced = ((at(0, -1) & ~at(-dx, -1)) | (at(0, 1) & ~at(-dx, 1)))
+        else:
+            forced = ((at(-1, 0) & ~at(-1, -dy)) | (at(1, 0) & ~at(1, -dy)))
+        stop = ~padded | forced
+
+        axis = 1 if dx else 0
+        n = padded.shape[axis]
+        coords = np.arange(n).reshape((1, n) if axis else (n, 1))
+        if (dx or dy) > 0:
+            marks = np.where(stop, coords, n)
+            return np.flip(np.minimum.accumulate(np.flip(marks, axis), axis=axis), axis)
+        marks = np.where(stop, coords, -1)
+        return np.maximum.accumulate(marks, axis=axis)
+
+    @classmethod
+    def rasterize(cls, floor, plan, stores, cells=GRID_CELLS):
+        """Build from a floor plan image and the floor's store table."""
+        # Sample the plan at each cell centre
+        w, h = plan.size
+        centers = (np.arange(cells) + 0.5) / cells
+        px = np.clip((PLAN_MARGIN + (w - 2*PLAN_MARGIN) * centers).astype(int), 0, w - 1)
+        py = np.clip((PLAN_MARGIN + (h - 2*PLAN_MARGIN) * centers).astype(int), 0, h - 1)
+        rgb = np.asarray(plan.convert("RGB"), dtype=np.int16)[py][:, px]
+
+        free = np.zeros((cells, cells), dtype=bool)
+        for color in WALKABLE_COLORS:
+            diff = np.abs(rgb - np.array(hex_to_rgb(color))).max(axis=2)
+            free |= diff <= WALKABLE_TOLERANCE
+
+        # Only inside the floor outline (the background grid lines are floor-coloured too)
+        outline = Image.new("L", (w, h), 0)
+        ImageDraw.Draw(outline).polygon(floor_shape_points(w, h, PLAN_MARGIN), fill=1)
+        free &= np.asarray(outline, dtype=bool)[py][:, px]
+
+        # Shop boxes are always obstacles
+        for x1, y1, x2, y2 in get_shop_geometry(floor, stores).boxes:
+            c1, c2 = int(x1 * cells), int(math.ceil(x2 * cells))
+            r1, r2 = int(y1 * cells), int(math.ceil(y2 * cells))
+            free[max(r1, 0):max(r2, 0), max(c1, 0):max(c2, 0)] = False
+        return cls(floor, free)
+
+    def save(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(path, bits=np.packbits(self.free), shape=np.array(self.free.shape))
+
+    @classmethod
+    def load(cls, floor, path):
+        data = np.load(path)
+        shape = tuple(data["shape"])
+        free = np.unpackbits(data["bits"], count=shape[0] * shape[1]).reshape(shape).astype(bool)
+        return cls(floor, free)
+
+    def to_cell(self, x, y):
+        return (min(max(int(x * self.width), 0), self.width - 1),
+                min(max(int(y * self.height), 0), self.height - 1))
+
+    def to_point(self, cell):
+        return ((cell[0] + 0.5) / self.width, (cell[1] + 0.5) / self.height)
+
+    def nearest_free(self, cell):
+        """The free cell closest to cell (itself if free), or None on an empty grid."""
+        if self.free[cell[1], cell[0]]:
+            return cell
+        ys, xs = np.nonzero(self.free)
+        if not len(xs):
+            return None
+        i = int(np.argmin((xs - cell[0])**2 + (ys - cell[1])**2))
+        return (int(xs[i]), int(ys[i]))
+
+    # The search below works in padded coordinates (cell + 1)
+
+    def _successors(self, x, y, parent):
+        """Pruned JPS directions from (x, y); diagonals only when both sides are open."""
+        open_ = self._open
+        if parent is None:
+            dirs = [d for d in self.STRAIGHT if open_[y + d[1]][x + d[0]]]
+            dirs += [(dx, dy) for dx, dy in self.DIAGONAL
+                     if open_[y][x + dx] and open_[y + dy][x] and open_[y + dy][x + dx]]
+            return dirs
+
+        dx = (x > parent[0]) - (x < parent[0])
+        dy = (y > parent[1]) - (y < parent[1])
+        if dx and dy:
+            dirs = [(0, dy), (dx, 0), (dx, dy)]
+        elif dx:
+            dirs = [(dx, 0), (dx, -1), (dx, 1), (0, -1), (0, 1)]
+        else:
+            dirs = [(0, dy), (-1, dy), (1, dy), (-1, 0), (1, 0)]
+        return [(ddx, ddy) for ddx, ddy in dirs
+                if open_[y + ddy][x + ddx] and (not (ddx and ddy) or (open_[y][x + ddx] and open_[y + ddy][x]))]
+
+    def _jump_straight(self, x, y, dx, dy, goal):
+        if not self._open[y][x]:
+            return None
+        stop = self._stops[(dx, dy)][y][x]
+        if dx:
+            if goal[1] == y and (goal[0] - x) * dx >= 0 and (stop - goal[0]) * dx >= 0:
+                return goal
+            return (stop, y) if self._open[y][stop] else None
+        if goal[0] == x and (goal[1] - y) * dy >= 0 and (stop - goal[1]) * dy >= 0:
+            return goal
+        return (x, stop) if self._open[stop][x] else None
+
+    def _jump(self, x, y, dx, dy, goal):
+        """Follow (dx, dy) from (x, y) until a jump point, the goal, or a wall."""
+        if not (dx and dy):
+            return self._jump_straight(x, y, dx, dy, goal)
+        open_ = self._open
+        while open_[y][x]:
+            if (x, y) == goal:
+                return goal
+            if self._jump_straight(x + dx, y, dx, 0, goal) or self._jump_straight(x, y + dy, 0, dy, goal):
+                return (x, y)
+            if not (open_[y][x + dx] and open_[y + dy][x]):
+                return None
+            x += dx
+            y += dy
+        return None
+
+    def jps(self, start, goal):
+        """Jump Point Search between two free cells. Returns the jump point cells or None."""
+        def octile(a, b):
+            ddx, ddy = abs(a[0] - b[0]), abs(a[1] - b[1])
+            return max(ddx, ddy) + (SQRT2 - 1) * min(ddx, ddy)
+
+        start = (int(start[0]) + 1, int(start[1]) + 1)
+        goal = (int(goal[0]) + 1, int(goal[1]) + 1)
+        g_score = {start: 0.0}
+        came_from = {}
+        open_set = [(octile(start, goal), start)]
+        closed = set()
+
+        while open_set:
+            _, current = heapq.heappop(open_set)
+            if current == goal:
+                path = [current]
+                while current in came_from:
+                    current = came_from[current]
+                    path.append(current)
+                return [(cx - 1, cy - 1) for cx, cy in reversed(path)]
+            if current in closed:
+                continue
+            closed.add(current)
+
+            for dx, dy in self._successors(*current, came_from.get(current)):
+                jump = self._jump(current[0] + dx, current[1] + dy, dx, dy, goal)
+                if jump is None or jump in closed:
+                    continue
+                tentative = g_score[current] + octile(current, jump)
+                if tentative < g_score.get(jump, float('inf')):
+                    g_score[jump] = tentative
+                    came_from[jump] = current
+                    heapq.heappush(open_set, (tentative + octile(jump, goal), jump))
+        return None
+
+    def find_path(self, start, end):
+        """Route between two normalized points. Returns [(x, y), ...] or None if unreachable."""
+        start_cell = self.nearest_free(self.to_cell(*start))
+        end_cell = self.nearest_free(self.to_cell(*end))
+        if start_cell is None or end_cell is None:
+            return None
+        cells = self.jps(start_cell, end_cell)
+        if cells is None:
+            return None
+        return [start] + [self.to_point(c) for c in cells] + [end]
+
+
+_OCCUPANCY_GRIDS = {}
+
+def get_occupancy_grid(floor):
+    """
+    Occupancy grid for a floor: from memory, else from the on-disk cache,
+    else rasterized. Keyed by the plan image bytes, shop table and resolution.
+    """
+    plan = RESOURCES.floor_plan(floor)
+    stores = FLOOR_DATA.get(floor, {}).get("stores", {})
+    key = hashlib.sha1()
+    key.update(plan.digest.encode() if plan else b"rendered")
+    key.update(get_shop_geometry(floor, stores).boxes.tobytes())
+    key.update(f"{GRID_CELLS}:{PLAN_MARGIN}:{WALKABLE_COLORS}:{WALKABLE_TOLERANCE}:outline".encode())
+    signature = key.hexdigest()[:16]
+
+    cached = _OCCUPANCY_GRIDS.get(floor)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    cache_path = CACHE_DIR / "occupancy" / f"{floor}_{signature}.npz"
+    if cache_path.exists():
+        grid = OccupancyGrid.load(floor, cache_path)
+    else:
+        image = plan.image if plan else create_floor_plan_image(floor)
+        grid = OccupancyGrid.rasterize(floor, image, stores)
+        grid.save(cache_path)
+    _OCCUPANCY_GRIDS[floor] = (signature, grid)
+    return grid
+
+
 # =============================================================================
 # POSITION ESTIMATION
 # =============================================================================
 
+@dataclass(frozen=True)
+class StoreEntry:
+    code: str
+    floor: str
+    x: float
+    y: float
+    name: str
+
+def normalize_store_name(name) -> str:
+    """'The Body Shop' / 'BODYSHOP' / 'Body-Shop' -> 'bodyshop'; accents, case and punctuation dropped."""
+    text = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode("ascii").lower()
+    text = text.replace("&", " and ")
+    words = "".join(c if c.isalnum() else " " for c in text).split()
+    if len(words) > 1 and words[0] == "the":
+        words = words[1:]
+    return "".join(words)
+
+def name_trigrams(key) -> set:
+    padded = f"#{key}#"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class StoreIndex:
+    """
+    Detected shop name -> StoreEntry. Names, codes and aliases are normalized
+    into one exact-match table per floor; misses fall back to a trigram index
+    (Dice similarity) scoped to the same floor, so the cost of a lookup
+    depends on the name's trigrams rather than on the number of stores.
+    Scope None covers every floor. Built from tables, a floor is indexed on
+    its first lookup, so a lazily loaded mall decodes only the floors in use.
+    """
+
+    def __init__(self, min_similarity=0.6):
+        self.min_similarity = min_similarity
+        self._exact = {}        # scope -> normalized key -> [StoreEntry]
+        self._grams = {}        # scope -> trigram -> [normalized key]
+        self._sizes = {}        # normalized key -> trigram count
+        self._floor_data = {}
+        self._aliases = {}
+        self._pending = []      # floors of _floor_data not indexed yet, in table order
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_tables(cls, floor_data, aliases=None, **kwargs):
+        """Index each floor's stores by code and name, plus alias -> code names, on first use."""
+        index = cls(**kwargs)
+        index._floor_data = floor_data
+        index._aliases = dict(aliases or {})
+        index._pending = list(floor_data)
+        return index
+
+    def _index_floor(self, floor):
+        by_code = {}
+        for code, store in self._floor_data[floor].get("stores", {}).items():
+            entry = by_code[code] = StoreEntry(code, floor, store["x"], store["y"], store.get("name", code))
+            self.add(entry, code, entry.name)
+        for alias, code in self._aliases.items():
+            if code in by_code:
+                self.add(by_code[code], alias)
+        # Only now visible to the unlocked check in _ensure()
+        self._pending.remove(floor)
+
+    def _ensure(self, floor):
+        if not self._pending or (floor is not None and floor not in self._pending):
+            return
+        with self._lock:
+            for pending in list(self._pending):
+                if floor is None or pending == floor:
+                    self._index_floor(pending)
+
+    def add(self, entry, *names):
+        for name in names:
+            key = normalize_store_name(name)
+            if not key:
+                continue
+            for scope in (entry.floor, None):
+                entries = self._exact.setdefault(scope, {}).setdefault(key, [])
+                if entry in entries:
+                    continue
+                if not entries:
+                    grams = name_trigrams(key)
+                    self._sizes[key] = len(grams)
+                    postings = self._grams.setdefault(scope, {})
+                    for gram in grams:
+                        postings.setdefault(gram, []).append(key)
+                entries.append(entry)
+
+    def resolve(self, name, floor=None) -> Optional[StoreEntry]:
+        """Best entry for a detected name on floor (any floor if None), or None."""
+        self._ensure(floor)
+        key = normalize_store_name(name)
+        exact = self._exact.get(floor, {})
+        if not key:
+            return None
+        if key in exact:
+            return exact[key][0]
+        
+        grams = name_trigrams(key)
+        postings = self._grams.get(floor, {})
+        shared = {}
+        for gram in grams:
+            for candidate in postings.get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        best, best_score = None, self.min_similarity
+        for candidate, count in shared.items():
+            score = 2 * count / (len(grams) + self._sizes[candidate])
+            if score >= best_score:
+                best, best_score = candidate, score
+        return exact[best][0] if best else None
+
+STORE_INDEX = StoreIndex.from_tables(FLOOR_DATA, STORE_NAME_TO_CODE)
+
+def rebuild_store_index():
+    """Re-index after FLOOR_DATA stores or STORE_NAME_TO_CODE were edited."""
+    global STORE_INDEX
+    STORE_INDEX = StoreIndex.from_tables(FLOOR_DATA, STORE_NAME_TO_CODE)
+    return STORE_INDEX
+
+# Bearing solver: used when the analysis gives landmarks but no estimated_x/y.
+# Each landmark is observed at a bearing relative to the camera heading
+# (directly ahead 0, left -90, right +90); candidate positions on the walkable
+# lattice are scored by the squared, sigma-scaled angular residuals.
+POSITION_BOUNDS = (0.08, 0.92, 0.15, 0.85)     # x min, x max, y min, y max
+SOLVER_STEP = float(os.getenv("SOLVER_STEP", "0.01"))
+BEARING_SIGMAS = {"directly_ahead": 20.0, "left_side": 35.0, "right_side": 35.0, "detected": 60.0}
+RELATIVE_BEARINGS = {"directly_ahead": 0.0, "left_side": -90.0, "right_side": 90.0, "detected": 0.0}
+HEADING_SIGMA = 15.0        # trust in estimated_direction_degrees
+HEADING_STEP = 5.0
+LANDMARK_RANGE = (0.12, 0.15)   # typical distance to a named landmark and its spread
+# Confidence falls off with the 2-sigma radius: a 10m radius halves it
+SOLVER_RADIUS_SCALE = 0.10 / math.log(2)
+
+FACILITY_KEYWORDS = {
+    "escalators": ("escalator",),
+    "elevators": ("elevator", "lift"),
+    "toilets": ("toilet", "restroom", "washroom", "wc"),
+}
+
+@dataclass
+class BearingSolution:
+    x: float
+    y: float
+    heading: float
+    radius: float           # 2-sigma position radius, normalized units (0.01 = 1m)
+    confidence: float       # geometry-only, 0-1
+    covariance: List[List[float]]
+    landmarks: int
+
+_WALKABLE_LATTICES = {}
+
+def walkable_lattice(floor, step=SOLVER_STEP):
+    """
+    (xs, ys, mask) over POSITION_BOUNDS: lattice axes and a (len(ys), len(xs))
+    mask of cells outside every shop box. Cached per floor and shop geometry.
+    """
+    geometry = get_shop_geometry(floor)
+    cached = _WALKABLE_LATTICES.get((floor, step))
+    if cached is None or cached[0] is not geometry:
+        x0, x1, y0, y1 = POSITION_BOUNDS
+        xs = np.round(np.arange(x0, x1 + step / 2, step), 6)
+        ys = np.round(np.arange(y0, y1 + step / 2, step), 6)
+        gx, gy = np.meshgrid(xs, ys)
+        points = np.column_stack([gx.ravel(), gy.ravel()])
+        mask = np.ones(len(points), dtype=bool)
+        if len(geometry):
+            mask = ~geometry.contains(points).any(axis=1)
+        cached = _WALKABLE_LATTICES[(floor, step)] = (geometry, xs, ys, mask.reshape(gy.shape))
+    return cached[1:]
+
+def landmark_points(text, floor) -> List[np.ndarray]:
+    """
+    Free-text landmark field -> one (K, 2) array of candidate positions per
+    landmark it names. 'Central spiral escalators and Chanel' gives the
+    floor's spiral escalator and Chanel's store position.
+    """
+    text = str(text or "")
+    for sep in ("(", ")", ",", ";", "/", " and "):
+        text = text.replace(sep, "|")
+    facilities = FLOOR_FACILITIES.get(floor, {})
+    landmarks = []
+    for token in (t.strip() for t in text.split("|")):
+        if not token:
+            continue
+        words = token.lower().split()
+        kind = next((k for k, keys in FACILITY_KEYWORDS.items()
+                     if any(w.startswith(key) for w in words for key in keys)), None)
+        if kind is not None:
+            table = FACILITY_TABLES[kind]()
+            items = [table[fid] for fid in facilities.get(kind, []) if fid in table]
+            spiral = [item for item in items if item.get("type") == "spiral"]
+            if "spiral" in words and spiral:
+                items = spiral
+            if items:
+                landmarks.append(np.array([(item["x"], item["y"]) for item in items], dtype=float))
+            continue
+        entry = STORE_INDEX.resolve(token, floor)
+        if entry is not None:
+            landmarks.append(np.array([(entry.x, entry.y)]))
+    return landmarks
+
+def bearing_observations(analysis, floor):
+    """[(relative bearing, sigma, (K, 2) candidates)] from an analysis dict, one per landmark."""
+    observations, sided = [], []
+    
+    def add(field, points, skip):
+        # Duplicates only within a field: a landmark seen both ahead and to the left counts twice
+        seen = list(skip)
+        for p in points:
+            if any(p.shape == q.shape and np.allclose(p, q) for q in seen):
+                continue
+            seen.append(p)
+            observations.append((RELATIVE_BEARINGS[field], BEARING_SIGMAS[field], p))
+        return seen
+    
+    for field in ("directly_ahead", "left_side", "right_side"):
+        sided += add(field, landmark_points(analysis.get(field), floor), [])
+    # Shops seen without a side are somewhere in the field of view
+    codes, detected = analysis.get("store_codes", []), []
+    for i, shop in enumerate(analysis.get("detected_shops", [])):
+        entry = STORE_INDEX.resolve(shop, floor)
+        if entry is None and i < len(codes):
+            entry = STORE_INDEX.resolve(codes[i], floor)
+        if entry is not None:
+            detected.append(np.array([(entry.x, entry.y)]))
+    # ...unless a side field already placed them
+    add("detected", detected, sided)
+    return observations
+
+def heading_grid(heading=None):
+    """(headings, prior cost): HEADING_STEP apart around heading, or the full circle if it is None."""
+    if heading is None:
+        headings = np.arange(0.0, 360.0, HEADING_STEP)
+        return headings, np.zeros(len(headings))
+    offsets = np.arange(-2 * HEADING_SIGMA, 2 * HEADING_SIGMA + HEADING_STEP / 2, HEADING_STEP)
+    return (float(heading) + offsets) % 360.0, (offsets / HEADING_SIGMA) ** 2
+
+def bearing_costs(points, headings, observations) -> np.ndarray:
+    """(headings, points) sum of squared, sigma-scaled bearing and range residuals."""
+    cost = np.zeros((len(headings), len(points)))
+    for relative, sigma, candidates in observations:
+        delta = candidates[None, :, :] - points[:, None, :]                  # (N, K, 2)
+        compass = np.degrees(np.arctan2(delta[..., 0], -delta[..., 1]))      # 0 = up, 90 = +x
+        residual = (compass[None] - headings[:, None, None] - relative + 180.0) % 360.0 - 180.0
+        ranged = (np.hypot(delta[..., 0], delta[..., 1]) - LANDMARK_RANGE[0]) / LANDMARK_RANGE[1]
+        # A facility kind matches whichever of its instances fits best
+        cost += ((residual / sigma) ** 2 + ranged[None] ** 2).min(axis=2)
+    return cost
+
+def solve_bearings(analysis, floor=None) -> Optional[BearingSolution]:
+    """
+    Least-squares position from landmark bearings, or None without landmarks.
+    Costs are evaluated for every walkable lattice point and every heading
+    near estimated_direction_degrees (all headings if it is missing) in one
+    (headings, points) array; the covariance comes from the cost surface
+    read as a Gaussian likelihood.
+    """
+    floor = floor or analysis.get("floor_estimate", "GF")
+    observations = bearing_observations(analysis, floor)
+    if not observations:
+        return None
+    xs, ys, mask = walkable_lattice(floor)
+    gx, gy = np.meshgrid(xs, ys)
+    points = np.column_stack([gx[mask], gy[mask]])
+    if not len(points):
+        return None
+    
+    headings, cost = heading_grid(analysis.get("estimated_direction_degrees"))
+    cost = cost[:, None] + bearing_costs(points, headings, observations)
+    
+    h, best = np.unravel_index(np.argmin(cost), cost.shape)
+    weights = np.exp(-0.5 * (cost - cost[h, best])).sum(axis=0)
+    weights /= weights.sum()
+    mean = weights @ points
+    centered = points - mean
+    covariance = (centered * weights[:, None]).T @ centered
+    radius = 2.0 * math.sqrt(max(np.linalg.eigvalsh(covariance)[-1], 0.0))
+    return BearingSolution(
+        x=float(points[best, 0]),
+        y=float(points[best, 1]),
+        heading=float(headings[h]),
+        radius=radius,
+        confidence=math.exp(-radius / SOLVER_RADIUS_SCALE),
+        covariance=covariance.tolist(),
+        landmarks=len(observations),
+    )
+
+# Optional grid localizer (POSITION_BACKEND=grid): a posterior over the
+# walkable lattice of every floor at once, so a photo that fits two corridors
+# or two floors keeps both instead of collapsing to one point.
+POSITION_BACKEND = os.getenv("POSITION_BACKEND", "bearings")   # "bearings" or "grid"
+LANDMARK_MISS = 0.05        # chance a named landmark is misread onto a floor that lacks it
+LANDMARK_OCCLUDED = 0.2     # likelihood of seeing a shop through another shop's box
+ESTIMATE_SIGMA = 0.05       # spread around the AI's own estimated_x/y
+MODE_RADIUS = 0.03          # modes closer than this merge; their mass is summed within it
+POSITION_MODES = 3
+
+@dataclass
+class PositionPosterior:
+    floor: str
+    x: float
+    y: float
+    radius: float           # 2-sigma spread on the MAP floor, normalized units
+    mass: float             # posterior mass within MODE_RADIUS of the MAP cell
+    modes: List[dict]       # [{"floor", "x", "y", "mass"}], strongest first
+    entropy: float          # bits, over every floor's cells
+    floor_probabilities: Dict[str, float]
+    grid: np.ndarray = field(default=None, repr=False)    # (floors, rows, cols) posterior
+
+class GridLocalizer:
+    """
+    Log-probability grid of shape (floors, rows, cols) over POSITION_BOUNDS,
+    -inf off the walkable lattice. update() adds one photo's floor, landmark
+    visibility and bearing log-likelihoods to the running posterior;
+    locate() scores one photo from the uniform prior without touching it,
+    so a shared localizer is safe across threads.
+    """
+
+    def __init__(self, floors=None, step=SOLVER_STEP):
+        self.floors = list(floors or FLOOR_DATA)
+        lattices = [walkable_lattice(floor, step) for floor in self.floors]
+        self.xs, self.ys = lattices[0][0], lattices[0][1]
+        self.walkable = np.stack([lattice[2] for lattice in lattices])
+        self.geometries = [get_shop_geometry(floor) for floor in self.floors]
+        self._visibility_cache = {}
+        gx, gy = np.meshgrid(self.xs, self.ys)
+        self.points = np.column_stack([gx.ravel(), gy.ravel()])
+        self.log_prior = self._normalized(np.where(self.walkable, 0.0, -np.inf))
+        self.reset()
+
+    def reset(self):
+        self.log_posterior = self.log_prior.copy()
+
+    @staticmethod
+    def _normalized(log_p) -> np.ndarray:
+        peak = log_p.max()
+        if not np.isfinite(peak):
+            return log_p
+        return log_p - (peak + math.log(np.exp(log_p - peak).sum()))
+
+    @property
+    def posterior(self) -> np.ndarray:
+        return np.exp(self.log_posterior)
+
+    def log_likelihood(self, analysis) -> np.ndarray:
+        """(floors, rows, cols) log-likelihood of one analysis dict."""
+        shape = self.walkable.shape[1:]
+        # Same defaults as estimate_position()
+        floor_estimate = analysis.get("floor_estimate", "GF")
+        confidence = min(max(float(analysis.get("floor_confidence", 0.5)), 0.01), 0.99)
+        headings, heading_cost = heading_grid(analysis.get("estimated_direction_degrees"))
+        
+        per_floor = [bearing_observations(analysis, floor) for floor in self.floors]
+        named = max(len(observations) for observations in per_floor)
+        result = np.empty(self.walkable.shape)
+        for f, (floor, observations) in enumerate(zip(self.floors, per_floor)):
+            if floor_estimate in self.floors:
+                prior = confidence if floor == floor_estimate else (1 - confidence) / max(len(self.floors) - 1, 1)
+            else:
+                prior = 1.0 / len(self.floors)
+            # Landmarks the photo shows but this floor doesn't have
+            ll = np.full(len(self.points), math.log(prior) + (named - len(observations)) * math.log(LANDMARK_MISS))
+            if observations:
+                cost = heading_cost[:, None] + bearing_costs(self.points, headings, observations)
+                low = cost.min(axis=0)
+                ll += -0.5 * low + np.log(np.exp(-0.5 * (cost - low)).sum(axis=0) / len(headings))
+                ll += self._occlusion(floor, observations)
+            if "estimated_x" in analysis and "estimated_y" in analysis:
+                d2 = ((self.points - (analysis["estimated_x"], analysis["estimated_y"])) ** 2).sum(axis=1)
+                ll += -0.5 * d2 / ESTIMATE_SIGMA ** 2
+            result[f] = ll.reshape(shape)
+        return result
+
+    def _occlusion(self, floor, observations) -> np.ndarray:
+        """log LANDMARK_OCCLUDED per single-position landmark hidden behind another shop box."""
+        ll = np.zeros(len(self.points))
+        for _, _, candidates in observations:
+            if len(candidates) == 1:
+                ll += self._visibility(floor, float(candidates[0, 0]), float(candidates[0, 1]))
+        return ll
+
+    def _visibility(self, floor, x, y) -> np.ndarray:
+        """Occlusion log-likelihoods for a landmark at (x, y); static, so computed once per landmark."""
+        key = (floor, x, y)
+        if key not in self._visibility_cache:
+            geometry = self.geometries[self.floors.index(floor)]
+            ll = np.zeros(len(self.points))
+            if len(geometry):
+                target = np.array([[x, y]])
+                ends = np.repeat(target, len(self.points), axis=0)
+                hits = geometry.segment_hits(self.points, ends) & ~geometry.contains(target)
+                ll[hits.any(axis=1)] = math.log(LANDMARK_OCCLUDED)
+            self._visibility_cache[key] = ll
+        return self._visibility_cache[key]
+
+    def update(self, analysis) -> PositionPosterior:
+        self.log_posterior = self._normalized(self.log_posterior + self.log_likelihood(analysis))
+        return self.estimate()
+
+    def locate(self, analysis) -> PositionPosterior:
+        return self.estimate(self._normalized(self.log_prior + self.log_likelihood(analysis)))
+
+    def estimate(self, log_posterior=None, k=POSITION_MODES) -> PositionPosterior:
+        """
+        MAP cell, the top-k separated modes by the mass within MODE_RADIUS,
+        and entropy, for log_posterior (default: the running posterior).
+        Ties, as in a flat posterior, go to the cell nearest its floor's mean.
+        """
+        p = np.exp(self.log_posterior if log_posterior is None else log_posterior)
+        floor_mass = p.sum(axis=(1, 2))
+        flat = p.reshape(len(self.floors), -1)
+        means = (flat @ self.points) / np.maximum(floor_mass, 1e-300)[:, None]     # (floors, 2)
+        spread = np.hypot(self.points[None, :, 0] - means[:, None, 0],
+                          self.points[None, :, 1] - means[:, None, 1]).reshape(p.shape)
+        
+        top = np.argwhere(p >= p.max() * (1 - 1e-9))
+        f, row, col = top[np.argmin(spread[tuple(top.T)])]
+        
+        # Mass within MODE_RADIUS of every cell: a disk kernel slid over the lattice
+        step = self.xs[1] - self.xs[0]
+        r = int(MODE_RADIUS / step + 1e-9)
+        oy, ox = np.mgrid[-r:r + 1, -r:r + 1]
+        disk = ((ox * step) ** 2 + (oy * step) ** 2 <= MODE_RADIUS ** 2 + 1e-12).astype(float)
+        windows = np.lib.stride_tricks.sliding_window_view(np.pad(p, ((0, 0), (r, r), (r, r))), disk.shape, axis=(1, 2))
+        mass = np.einsum("fhwij,ij->fhw", windows, disk)
+        
+        # Modes: walkable local maxima of that mass, strongest first
+        padded = np.pad(mass, ((0, 0), (1, 1), (1, 1)), constant_values=-1.0)
+        neighbours = np.lib.stride_tricks.sliding_window_view(padded, (3, 3), axis=(1, 2)).max(axis=(-2, -1))
+        peaks = np.argwhere((mass >= neighbours) & (mass > 0) & self.walkable)
+        keys = tuple(peaks.T)
+        peaks = peaks[np.lexsort((spread[keys], -mass[keys]))]
+        modes = []
+        for pf, pr, pc in peaks:
+            x, y = float(self.xs[pc]), float(self.ys[pr])
+            if any(m["floor"] == self.floors[pf] and math.hypot(m["x"] - x, m["y"] - y) < MODE_RADIUS for m in modes):
+                continue
+            modes.append({"floor": self.floors[pf], "x": x, "y": y, "mass": float(mass[pf, pr, pc])})
+            if len(modes) == k:
+                break
+        
+        weights = flat[f] / floor_mass[f]
+        centered = self.points - means[f]
+        covariance = (centered * weights[:, None]).T @ centered
+        nonzero = p[p > 0]
+        return PositionPosterior(
+            floor=self.floors[f],
+            x=float(self.xs[col]),
+            y=float(self.ys[row]),
+            radius=2.0 * math.sqrt(max(np.linalg.eigvalsh(covariance)[-1], 0.0)),
+            mass=float(mass[f, row, col]),
+            modes=modes,
+            entropy=float(-(nonzero * np.log2(nonzero)).sum()),
+            floor_probabilities={floor: float(m) for floor, m in zip(self.floors, floor_mass)},
+            grid=p,
+        )
+
+_GRID_LOCALIZER = [None]
+
+def get_grid_localizer() -> GridLocalizer:
+    """Shared GridLocalizer, rebuilt when the floors or their shop geometry change."""
+    localizer = _GRID_LOCALIZER[0]
+    if localizer is None or localizer.floors != list(FLOOR_DATA) or any(
+            get_shop_geometry(floor) is not geometry for floor, geometry in zip(localizer.floors, localizer.geometries)):
+        localizer = _GRID_LOCALIZER[0] = GridLocalizer()
+    return localizer
+
+def locate_on_grid(analysis: dict) -> Tuple[LocationEstimate, PositionPosterior]:
+    """Grid-backend estimate, along with the posterior it was read from."""
+    posterior = get_grid_localizer().locate(analysis)
+    location = LocationEstimate(
+        floor=posterior.floor,
+        x=posterior.x,
+        y=posterior.y,
+        direction=analysis.get("estimated_direction_degrees", 0),
+        # Chance of being on this floor within MODE_RADIUS of the reported spot
+        confidence=posterior.mass,
+        detected_shops=analysis.get("detected_shops", []),
+        store_codes=analysis.get("store_codes", []),
+        reasoning=analysis.get("location_reasoning", ""),
+        radius=posterior.radius,
+        modes=posterior.modes,
+        entropy=posterior.entropy
+    )
+    return location, posterior
+
 def estimate_position(analysis: dict) -> LocationEstimate:
     """Estimate position using analysis data and store database."""
     floor = analysis.get("floor_estimate", "GF")
     shops = analysis.get("detected_shops", [])
     codes = analysis.get("store_codes", [])
+    confidence = analysis.get("floor_confidence", 0.5)
+    radius = None
+    
+    if POSITION_BACKEND == "grid":
+        return locate_on_grid(analysis)[0]
     
-    # Use AI-estimated position if available
-    if "estimated_x" in analysis and "estimated_y" in analysis:
+    # Use AI-estimated position if available, else solve from landmark bearings
+    has_estimate = "estimated_x" in analysis and "estimated_y" in analysis
+    solution = None if has_estimate else solve_bearings(analysis, floor)
+    if has_estimate:
         x = analysis["estimated_x"]
         y = analysis["estimated_y"]
+    elif solution is not None:
+        # Landmark bearings; confidence is the floor's scaled by how well they pin the spot
+        x, y = solution.x, solution.y
+        radius = solution.radius
+        confidence = confidence * solution.confidence
     else:
         # Fallback: calculate centroid of detected stores
         positions = []
-        for shop in shops:
-            # Try direct match
-            if shop in ALL_STORES and ALL_STORES[shop]["floor"] == floor:
-                positions.append((ALL_STORES[shop]["x"], ALL_STORES[shop]["y"]))
-            # Try code lookup
-            code = STORE_NAME_TO_CODE.get(shop)
-            if code and code in ALL_STORES and ALL_STORES[code]["floor"] == floor:
-                positions.append((ALL_STORES[code]["x"], ALL_STORES[code]["y"]))
+        for i, shop in enumerate(shops):
+            # Name (or alias, or close spelling) first, then the store code read alongside it
+            entry = STORE_INDEX.resolve(shop, floor)
+            if entry is None and i < len(codes):
+                entry = STORE_INDEX.resolve(codes[i], floor)
+            if entry is not None:
+                positions.append((entry.x, entry.y))
         
         if positions:
             x = sum(p[0] for p in positions) / len(positions)
@@ -844,17 +3009,22 @@ def estimate_position(analysis: dict) -> LocationEstimate:
         else:
             x, y = 0.5, 0.5
     
-    direction = analysis.get("estimated_direction_degrees", 0)
+    direction = analysis.get("estimated_direction_degrees")
+    if direction is None:
+        # The solver searched every heading; report the one that fit
+        direction = solution.heading if solution is not None else 0
+    x0, x1, y0, y1 = POSITION_BOUNDS
     
     return LocationEstimate(
         floor=floor,
-        x=max(0.08, min(0.92, x)),
-        y=max(0.15, min(0.85, y)),
+        x=max(x0, min(x1, x)),
+        y=max(y0, min(y1, y)),
         direction=direction,
-        confidence=analysis.get("floor_confidence", 0.5),
+        confidence=confidence,
         detected_shops=shops,
         store_codes=codes,
-        reasoning=analysis.get("location_reasoning", "")
+        reasoning=analysis.get("location_reasoning", ""),
+        radius=radius
     )
 
 
@@ -902,11 +3072,13 @@ COLORS = {
     "text_secondary": "#b2bec3",
 }
 
+@functools.lru_cache(maxsize=None)
 def hex_to_rgb(hex_color):
     """Convert hex color to RGB tuple."""
     hex_color = hex_color.lstrip('#')
     return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
 
+@functools.lru_cache(maxsize=None)
 def blend_colors(color1, color2, factor=0.5):
     """Blend two colors together."""
     r1, g1, b1 = hex_to_rgb(color1)
@@ -916,6 +3088,112 @@ def blend_colors(color1, color2, factor=0.5):
     b = int(b1 + (b2 - b1) * factor)
     return f"#{r:02x}{g:02x}{b:02x}"
 
+# COLORS resolved once to RGB tuples for the drawing helpers
+PALETTE = {name: hex_to_rgb(value) for name, value in COLORS.items() if value.startswith("#")}
+
+# =============================================================================
+# SHARED RESOURCES - FONTS AND FLOOR PLAN IMAGES
+# =============================================================================
+
+# Tried in order; FONT_PATH overrides. Falls back to PIL's built-in font.
+FONT_CANDIDATES = [
+    "/System/Library/Fonts/Helvetica.ttc",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu-sans-fonts/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+    "/usr/share/fonts/liberation-sans/LiberationSans-Regular.ttf",
+    "C:/Windows/Fonts/arial.ttf",
+]
+FONT_SEARCH_DIRS = ["/usr/share/fonts", "/usr/local/share/fonts", str(Path.home() / ".fonts")]
+FONT_SEARCH_NAMES = ["DejaVuSans.ttf", "LiberationSans-Regular.ttf", "Arial.ttf", "arial.ttf"]
+
+@dataclass
+class FloorPlanAsset:
+    path: Path
+    image: Image.Image
+    digest: str       # sha1 of the file bytes
+
+class ResourceRegistry:
+    """
+    Process-wide, lazily populated cache of fonts (discovered once, one
+    instance per size) and decoded floor plan images from FLOOR_PLANS_DIR.
+    After first use nothing touches the file system again until invalidated.
+    """
+
+    def __init__(self, plans_dir=None):
+        self.plans_dir = plans_dir
+        self._lock = threading.Lock()
+        self._font_path = None
+        self._font_probed = False
+        self._fonts = {}
+        self._plans = {}
+
+    def font_path(self) -> Optional[str]:
+        with self._lock:
+            if not self._font_probed:
+                self._font_path = self._discover_font()
+                self._font_probed = True
+            return self._font_path
+
+    @staticmethod
+    def _discover_font() -> Optional[str]:
+        candidates = [os.getenv("FONT_PATH", "")] + FONT_CANDIDATES
+        for candidate in candidates:
+            if candidate and os.path.isfile(candidate):
+                return candidate
+        for name in FONT_SEARCH_NAMES:
+            for root in FONT_SEARCH_DIRS:
+                matches = sorted(Path(root).rglob(name)) if os.path.isdir(root) else []
+                if matches:
+                    return str(matches[0])
+        return None
+
+    def font(self, size: int):
+        size = int(size)
+        font = self._fonts.get(size)
+        if font is None:
+            path = self.font_path()
+            try:
+                font = ImageFont.truetype(path, size) if path else ImageFont.load_default()
+            except OSError:
+                font = ImageFont.load_default()
+            with self._lock:
+                font = self._fonts.setdefault(size, font)
+        return font
+
+    def floor_plan(self, floor) -> Optional[FloorPlanAsset]:
+        """Decoded floor_plans/<floor>.png, or None if there is no such file."""
+        if floor in self._plans:
+            return self._plans[floor]
+        path = Path(self.plans_dir or FLOOR_PLANS_DIR) / f"{floor}.png"
+        asset = None
+        if path.is_file():
+            data = path.read_bytes()
+            image = Image.open(io.BytesIO(data))
+            image.load()
+            asset = FloorPlanAsset(path, image, hashlib.sha1(data).hexdigest())
+        with self._lock:
+            return self._plans.setdefault(floor, asset)
+
+    def invalidate_floor_plans(self, floor=None):
+        with self._lock:
+            if floor is None:
+                self._plans.clear()
+            else:
+                self._plans.pop(floor, None)
+
+    def invalidate_fonts(self):
+        with self._lock:
+            self._fonts.clear()
+            self._font_probed = False
+
+RESOURCES = ResourceRegistry()
+
+def get_font(size):
+    return RESOURCES.font(size)
+
 def draw_rounded_rect(draw, box, radius, fill, outline=None, outline_width=1):
     """Draw a rounded rectangle."""
     x1, y1, x2, y2 = box
@@ -938,25 +3216,39 @@ def draw_rounded_rect(draw, box, radius, fill, outline=None, outline_width=1):
         draw.line([(x1, y1 + radius), (x1, y2 - radius)], fill=outline, width=outline_width)
         draw.line([(x2, y1 + radius), (x2, y2 - radius)], fill=outline, width=outline_width)
 
-def draw_gradient_background(img, width, height):
-    """Draw a subtle gradient background."""
-    draw = ImageDraw.Draw(img)
-    for y in range(height):
-        # Gradient from dark blue to slightly lighter
-        factor = y / height
-        color = blend_colors(COLORS["bg_dark"], COLORS["bg_medium"], factor * 0.6)
-        draw.line([(0, y), (width, y)], fill=color)
+GRID_SPACING = 30
+GRID_COLOR = "#2a2f42"
+
+def pack_rgbx(rgb):
+    """(..., 3) uint8 colours -> (...) uint32 RGBX pixels (little-endian byte order)."""
+    rgb = np.asarray(rgb, dtype=np.uint32)
+    return rgb[..., 0] | (rgb[..., 1] << 8) | (rgb[..., 2] << 16)
+
+def gradient_background_image(width, height):
+    """Gradient rows plus grid lines, built as one array instead of per-row draw calls."""
+    # Same arithmetic as blend_colors(bg_dark, bg_medium, y / height * 0.6), per row
+    start = np.array(PALETTE["bg_dark"], dtype=float)
+    end = np.array(PALETTE["bg_medium"], dtype=float)
+    factor = (np.arange(height) / height * 0.6)[:, None]
+    rows = pack_rgbx((start + (end - start) * factor).astype(np.uint8))
+    
+    # Whole pixels as uint32 so each row fill is a single word copy
+    arr = np.empty((height, width), dtype="<u4")
+    arr[:] = rows[:, None]
     
     # Add subtle grid pattern
-    grid_color = "#2a2f42"
-    for x in range(0, width, 30):
-        draw.line([(x, 0), (x, height)], fill=grid_color, width=1)
-    for y in range(0, height, 30):
-        draw.line([(0, y), (width, y)], fill=grid_color, width=1)
+    grid = pack_rgbx(hex_to_rgb(GRID_COLOR))
+    arr[:, ::GRID_SPACING] = grid
+    arr[::GRID_SPACING, :] = grid
+    return Image.frombuffer("RGB", (width, height), arr, "raw", "RGBX", 0, 1)
 
-def draw_floor_shape(draw, width, height, margin, color):
-    """Draw the angular Times Square floor shape with modern styling."""
-    points = [
+def draw_gradient_background(img, width, height):
+    """Draw a subtle gradient background."""
+    img.paste(gradient_background_image(width, height))
+
+def floor_shape_points(width, height, margin):
+    """Outline of the angular Times Square floor shape in pixels."""
+    return [
         (margin, margin + 50),
         (width - margin - 100, margin + 10),
         (width - margin, margin + 60),
@@ -965,6 +3257,10 @@ def draw_floor_shape(draw, width, height, margin, color):
         (margin + 60, height - margin - 10),
         (margin, height - margin - 60)
     ]
+
+def draw_floor_shape(draw, width, height, margin, color):
+    """Draw the angular Times Square floor shape with modern styling."""
+    points = floor_shape_points(width, height, margin)
     
     # Shadow
     shadow_offset = 8
@@ -972,7 +3268,7 @@ def draw_floor_shape(draw, width, height, margin, color):
     draw.polygon(shadow_points, fill="#0a0c14")
     
     # Main floor
-    draw.polygon(points, fill=COLORS["floor_base"], outline=COLORS["primary"], width=3)
+    draw.polygon(points, fill=PALETTE["floor_base"], outline=PALETTE["primary"], width=3)
     
     # Inner accent border
     inner_points = [
@@ -995,7 +3291,7 @@ def draw_escalator_icon(draw, x, y, size=18, is_spiral=False):
             draw.ellipse([x-alpha_size, y-alpha_size, x+alpha_size, y+alpha_size], 
                         fill=blend_colors(COLORS["escalator"], COLORS["bg_dark"], 0.7))
         
-        draw.ellipse([x-size, y-size, x+size, y+size], fill=COLORS["escalator"], outline="#fff", width=2)
+        draw.ellipse([x-size, y-size, x+size, y+size], fill=PALETTE["escalator"], outline="#fff", width=2)
         
         # Spiral pattern
         for angle in range(0, 360, 30):
@@ -1007,7 +3303,7 @@ def draw_escalator_icon(draw, x, y, size=18, is_spiral=False):
     else:
         # Modern escalator icon
         draw.rounded_rectangle([x-size, y-size*0.5, x+size, y+size*0.5], 
-                               radius=4, fill=COLORS["escalator"], outline="#fff", width=2)
+                               radius=4, fill=PALETTE["escalator"], outline="#fff", width=2)
         # Steps
         for i in range(-2, 3):
             lx = x + i * size * 0.35
@@ -1023,7 +3319,7 @@ def draw_elevator_icon(draw, x, y, size=16):
     
     # Main icon - rounded square
     draw.rounded_rectangle([x-size, y-size, x+size, y+size], 
-                          radius=4, fill=COLORS["elevator"], outline="#fff", width=2)
+                          radius=4, fill=PALETTE["elevator"], outline="#fff", width=2)
     
     # Up/down arrows
     arrow_color = "#fff"
@@ -1034,7 +3330,7 @@ def draw_elevator_icon(draw, x, y, size=16):
 
 def draw_toilet_icon(draw, x, y, size=14, highlight=False):
     """Draw modern toilet icon."""
-    main_color = COLORS["toilet_target"] if highlight else COLORS["toilet"]
+    main_color = PALETTE["toilet_target"] if highlight else PALETTE["toilet"]
     
     # Glow effect for highlighted
     if highlight:
@@ -1048,10 +3344,7 @@ def draw_toilet_icon(draw, x, y, size=14, highlight=False):
                 fill=main_color, outline="#fff", width=2 if not highlight else 3)
     
     # WC text
-    try:
-        font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", int(size * 0.9))
-    except:
-        font = ImageFont.load_default()
+    font = get_font(size * 0.9)
     draw.text((x, y), "WC", fill="#1a1d29", font=font, anchor="mm")
 
 def draw_navigation_path(draw, path, width, height, margin):
@@ -1084,13 +3377,13 @@ def draw_navigation_path(draw, path, width, height, margin):
             dot_y = p1[1] + dy * t
             dot_size = 4
             draw.ellipse([dot_x-dot_size, dot_y-dot_size, dot_x+dot_size, dot_y+dot_size], 
-                        fill=COLORS["path_main"])
+                        fill=PALETTE["path_main"])
     
     # Waypoint markers (small circles at turns)
     for i in range(1, len(pixels)-1):
         p = pixels[i]
         draw.ellipse([p[0]-6, p[1]-6, p[0]+6, p[1]+6], 
-                    fill=COLORS["path_main"], outline="#fff", width=2)
+                    fill=PALETTE["path_main"], outline="#fff", width=2)
     
     # Destination marker - pulsing target
     end = pixels[-1]
@@ -1100,11 +3393,29 @@ def draw_navigation_path(draw, path, width, height, margin):
         draw.ellipse([end[0]-ring_size, end[1]-ring_size, end[0]+ring_size, end[1]+ring_size], 
                     outline=ring_color, width=2)
 
-def create_floor_plan_image(floor, width=800, height=600, location=None, toilet_nav=None):
-    """Create modern floor plan visualization."""
-    img = Image.new("RGB", (width, height), COLORS["bg_dark"])
+MAJOR_STORES = ["Lane Crawford", "Fortress", "The Body Shop", "Shake Shack", "city'super"]
+
+def shop_style(code, info):
+    """Box size, major-store flag and fill colour of a shop: (sw, sh, is_major, color)."""
+    name = info.get("name", code)
+    # Determine size based on store importance
+    if name in MAJOR_STORES:
+        sw, sh, is_major = 90, 44, True
+    elif "G124" in code or "b1(a)" in code:
+        sw, sh, is_major = 85, 48, True
+    else:
+        sw, sh, is_major = 60, 32, False
+    
+    # Shop color
+    base_color = info.get("color", COLORS["shop_default"])
+    if not (base_color.startswith("#") and len(base_color) == 7):
+        base_color = COLORS["shop_default"]
+    return sw, sh, is_major, base_color
+
+def render_floor_layer(floor, width, height, margin=60):
+    """Static floor layer: background, floor shape, title and shops."""
+    img = Image.new("RGB", (width, height), PALETTE["bg_dark"])
     draw = ImageDraw.Draw(img)
-    margin = 60
     
     # Draw gradient background
     draw_gradient_background(img, width, height)
@@ -1113,21 +3424,17 @@ def create_floor_plan_image(floor, width=800, height=600, location=None, toilet_
     floor_info = FLOOR_DATA.get(floor, FLOOR_DATA["GF"])
     draw_floor_shape(draw, width, height, margin, floor_info["color"])
     
-    try:
-        font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 12)
-        title_font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 24)
-        small_font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 10)
-        bold_font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 14)
-    except:
-        font = title_font = small_font = bold_font = ImageFont.load_default()
+    font = get_font(12)
+    title_font = get_font(24)
+    small_font = get_font(10)
     
     # Title with shadow
     title_text = f"TIMES SQUARE · {floor_info['name'].upper()}"
     draw.text((width//2 + 2, 28), title_text, fill="#0a0c14", font=title_font, anchor="mm")
-    draw.text((width//2, 26), title_text, fill=COLORS["text_primary"], font=title_font, anchor="mm")
+    draw.text((width//2, 26), title_text, fill=PALETTE["text_primary"], font=title_font, anchor="mm")
     
     # Subtitle
-    draw.text((width//2, 48), "Hong Kong · Floor Plan", fill=COLORS["text_secondary"], font=small_font, anchor="mm")
+    draw.text((width//2, 48), "Hong Kong · Floor Plan", fill=PALETTE["text_secondary"], font=small_font, anchor="mm")
     
     # Draw stores with modern styling
     stores = floor_info.get("stores", {})
@@ -1136,42 +3443,27 @@ def create_floor_plan_image(floor, width=800, height=600, location=None, toilet_
         sy = margin + (height - 2*margin) * info["y"]
         
         name = info.get("name", code)
-        
-        # Determine size based on store importance
-        if name in ["Lane Crawford", "Fortress", "The Body Shop", "Shake Shack", "city'super"]:
-            sw, sh = 90, 44
-            is_major = True
-        elif "G124" in code or "b1(a)" in code:
-            sw, sh = 85, 48
-            is_major = True
-        else:
-            sw, sh = 60, 32
-            is_major = False
-        
-        # Shop color
-        base_color = info.get("color", COLORS["shop_default"])
-        if base_color.startswith("#") and len(base_color) == 7:
-            shop_color = base_color
-        else:
-            shop_color = COLORS["shop_default"]
+        sw, sh, is_major, shop_color = shop_style(code, info)
         
         # Shadow
         draw.rounded_rectangle([sx-sw//2+3, sy-sh//2+3, sx+sw//2+3, sy+sh//2+3], 
                                radius=6, fill="#0a0c14")
         
         # Main shop box
-        outline_color = COLORS["primary"] if is_major else "#555"
+        outline_color = PALETTE["primary"] if is_major else "#555"
         draw.rounded_rectangle([sx-sw//2, sy-sh//2, sx+sw//2, sy+sh//2], 
                                radius=6, fill=shop_color, outline=outline_color, width=2 if is_major else 1)
         
         # Label with better contrast
         label = name[:14] if len(name) > 14 else name
-        text_color = "#fff" if is_major else COLORS["shop_text"]
+        text_color = "#fff" if is_major else PALETTE["shop_text"]
         draw.text((sx, sy), label, fill=text_color, font=small_font if not is_major else font, anchor="mm")
     
-    # Draw navigation path BEFORE facilities (so path goes under icons)
-    if toilet_nav and location:
-        draw_navigation_path(draw, toilet_nav["path"], width, height, margin)
+    return img
+
+def draw_facility_layer(draw, floor, width, height, margin=60, highlight=None):
+    """Facility icons and legend; the toilet named highlight is drawn as the target."""
+    small_font = get_font(10)
     
     # Draw facilities
     floor_fac = FLOOR_FACILITIES.get(floor, {})
@@ -1198,31 +3490,109 @@ def create_floor_plan_image(floor, width=800, height=600, location=None, toilet_
             wc = TOILET_POSITIONS[wc_id]
             wx = margin + (width - 2*margin) * wc["x"]
             wy = margin + (height - 2*margin) * wc["y"]
-            is_target = toilet_nav and wc.get("name") == toilet_nav.get("toilet", {}).get("name")
+            is_target = highlight is not None and wc.get("name") == highlight
             draw_toilet_icon(draw, wx, wy, highlight=is_target)
     
     # Modern legend bar
     legend_y = height - 38
     draw.rounded_rectangle([margin - 10, legend_y - 12, width - margin + 10, legend_y + 20], 
-                           radius=8, fill="#252836", outline=COLORS["primary"], width=1)
+                           radius=8, fill="#252836", outline=PALETTE["primary"], width=1)
     
     legend_items = [
-        ("●", COLORS["marker"], "You"),
-        ("→", COLORS["marker"], "Facing"),
+        ("●", PALETTE["marker"], "You"),
+        ("→", PALETTE["marker"], "Facing"),
         ("■", "#6c5ce7", "Shops"),
-        ("◎", COLORS["escalator"], "Escalator"),
-        ("◆", COLORS["elevator"], "Elevator"),
-        ("◉", COLORS["toilet"], "Toilet"),
-        ("···", COLORS["path_main"], "Route"),
+        ("◎", PALETTE["escalator"], "Escalator"),
+        ("◆", PALETTE["elevator"], "Elevator"),
+        ("◉", PALETTE["toilet"], "Toilet"),
+        ("···", PALETTE["path_main"], "Route"),
     ]
     
     lx = margin + 15
     spacing = (width - 2*margin - 30) // len(legend_items)
     for symbol, color, label in legend_items:
         draw.text((lx, legend_y + 4), symbol, fill=color, font=small_font, anchor="lm")
-        draw.text((lx + 15, legend_y + 4), label, fill=COLORS["text_secondary"], font=small_font, anchor="lm")
+        draw.text((lx + 15, legend_y + 4), label, fill=PALETTE["text_secondary"], font=small_font, anchor="lm")
         lx += spacing
+
+# Static layers are cached per (floor, size, floor data); RENDER_CACHE_DISK=1
+# also keeps them under cache/layers/ across runs
+RENDER_CACHE_DISK = os.getenv("RENDER_CACHE_DISK", "0") == "1"
+RENDER_CACHE_SIZE = 64
+
+_LAYER_CACHE = {}
+_LAYER_CACHE_LOCK = threading.Lock()    # the service renders on executor threads
+
+def floor_layer_digest(floor) -> str:
+    """Hash of everything the static layers of a floor are drawn from."""
+    floor_fac = FLOOR_FACILITIES.get(floor, {})
+    data = {
+        "floor": FLOOR_DATA[floor] if floor in FLOOR_DATA else FLOOR_DATA["GF"],
+        "facilities": floor_fac,
+        "positions": [table.get(fac_id) for key, table in (("escalators", ESCALATOR_POSITIONS),
+                                                           ("elevators", ELEVATOR_POSITIONS),
+                                                           ("toilets", TOILET_POSITIONS))
+                      for fac_id in floor_fac.get(key, [])],
+        "colors": COLORS,
+        "font": RESOURCES.font_path(),
+    }
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def get_static_layer(floor, width, height, kind, highlight=None, margin=60):
+    """
+    Cached static layer:
+      "floor"      - RGB floor layer (background, shape, title, shops)
+      "full"       - RGB floor layer with facility icons and legend on top
+      "facilities" - RGBA facility icons and legend, transparent elsewhere
+    Callers must copy() before drawing on a layer.
+    """
+    key = (floor, width, height, margin, kind, highlight, floor_layer_digest(floor))
+    with _LAYER_CACHE_LOCK:
+        layer = _LAYER_CACHE.get(key)
+    if layer is not None:
+        return layer
+
+    disk_path = None
+    if RENDER_CACHE_DISK:
+        tag = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+        disk_path = CACHE_DIR / "layers" / f"{floor}_{width}x{height}_{kind}_{tag}.png"
+        if disk_path.exists():
+            layer = Image.open(disk_path)
+            layer.load()
+
+    if layer is None:
+        if kind == "floor":
+            layer = render_floor_layer(floor, width, height, margin)
+        elif kind == "full":
+            layer = get_static_layer(floor, width, height, "floor", margin=margin).copy()
+            draw_facility_layer(ImageDraw.Draw(layer), floor, width, height, margin, highlight)
+        else:
+            layer = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+            draw_facility_layer(ImageDraw.Draw(layer), floor, width, height, margin, highlight)
+        if disk_path is not None:
+            disk_path.parent.mkdir(parents=True, exist_ok=True)
+            layer.save(disk_path)
+
+    # Two threads may render the same layer; the second simply replaces it
+    with _LAYER_CACHE_LOCK:
+        while _LAYER_CACHE and len(_LAYER_CACHE) >= RENDER_CACHE_SIZE:
+            _LAYER_CACHE.pop(next(iter(_LAYER_CACHE)))
+        _LAYER_CACHE[key] = layer
+    return layer
+
+def create_floor_plan_image(floor, width=800, height=600, location=None, toilet_nav=None):
+    """Create modern floor plan visualization from the cached static layers."""
+    margin = 60
+    highlight = toilet_nav.get("toilet", {}).get("name") if toilet_nav else None
     
+    if not (toilet_nav and location):
+        return get_static_layer(floor, width, height, "full", highlight, margin).copy()
+    
+    # Navigation path goes between the floor layer and the facility icons
+    img = get_static_layer(floor, width, height, "floor", margin=margin).copy()
+    draw_navigation_path(ImageDraw.Draw(img), toilet_nav["path"], width, height, margin)
+    facilities = get_static_layer(floor, width, height, "facilities", highlight, margin)
+    img.paste(facilities, mask=facilities)
     return img
 
 def draw_position_marker(img, location, margin=60):
@@ -1239,23 +3609,23 @@ def draw_position_marker(img, location, margin=60):
     tip = (px + arrow_len * math.cos(angle), py - arrow_len * math.sin(angle))
     
     # Arrow shadow/glow (outline only, transparent)
-    draw.line([(px, py), tip], fill=COLORS["marker_glow"], width=8)
+    draw.line([(px, py), tip], fill=PALETTE["marker_glow"], width=8)
     
     # Arrow body
-    draw.line([(px, py), tip], fill=COLORS["marker"], width=4)
+    draw.line([(px, py), tip], fill=PALETTE["marker"], width=4)
     
     # Arrow head
     head_size = 12
     head_angle = 0.5
     h1 = (tip[0] - head_size * math.cos(angle - head_angle), tip[1] + head_size * math.sin(angle - head_angle))
     h2 = (tip[0] - head_size * math.cos(angle + head_angle), tip[1] + head_size * math.sin(angle + head_angle))
-    draw.polygon([tip, h1, h2], fill=COLORS["marker"], outline="#fff", width=2)
+    draw.polygon([tip, h1, h2], fill=PALETTE["marker"], outline="#fff", width=2)
     
     # Transparent pulsing rings (outlines only - don't block elements)
     ring_colors = [
-        (COLORS["marker_glow"], 1),
+        (PALETTE["marker_glow"], 1),
         (blend_colors(COLORS["marker"], COLORS["marker_glow"], 0.5), 2),
-        (COLORS["marker"], 2),
+        (PALETTE["marker"], 2),
     ]
     for i, (color, width) in enumerate(ring_colors):
         ring_radius = 20 + i * 8
@@ -1263,7 +3633,7 @@ def draw_position_marker(img, location, margin=60):
                     outline=color, width=width)
     
     # Main position dot (solid center)
-    draw.ellipse([px-10, py-10, px+10, py+10], fill=COLORS["marker"], outline="#fff", width=3)
+    draw.ellipse([px-10, py-10, px+10, py+10], fill=PALETTE["marker"], outline="#fff", width=3)
     
     # Inner highlight
     draw.ellipse([px-4, py-4, px+4, py+4], fill="#fff")
@@ -1271,7 +3641,7 @@ def draw_position_marker(img, location, margin=60):
     # Confidence ring (outermost)
     conf_radius = 40 + (1 - location.confidence) * 15
     draw.ellipse([px-conf_radius, py-conf_radius, px+conf_radius, py+conf_radius], 
-                outline=COLORS["marker_glow"], width=1)
+                outline=PALETTE["marker_glow"], width=1)
     
     return img
 
@@ -1280,13 +3650,9 @@ def draw_info_boxes(img, location, toilet_nav, margin=60):
     draw = ImageDraw.Draw(img)
     w, h = img.size
     
-    try:
-        font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 12)
-        bold_font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 14)
-        small_font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 11)
-        title_font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 13)
-    except:
-        font = bold_font = small_font = title_font = ImageFont.load_default()
+    bold_font = get_font(14)
+    small_font = get_font(11)
+    title_font = get_font(13)
     
     # Location info card (top right)
     card_w = 210
@@ -1300,12 +3666,12 @@ def draw_info_boxes(img, location, toilet_nav, margin=60):
     
     # Card background
     draw.rounded_rectangle([card_x - card_w, card_y, card_x, card_y + card_h], 
-                           radius=12, fill="#252836", outline=COLORS["primary"], width=2)
+                           radius=12, fill="#252836", outline=PALETTE["primary"], width=2)
     
     # Card header
     draw.rounded_rectangle([card_x - card_w, card_y, card_x, card_y + 32], 
-                           radius=12, fill=COLORS["primary"])
-    draw.rectangle([card_x - card_w, card_y + 20, card_x, card_y + 32], fill=COLORS["primary"])
+                           radius=12, fill=PALETTE["primary"])
+    draw.rectangle([card_x - card_w, card_y + 20, card_x, card_y + 32], fill=PALETTE["primary"])
     draw.text((card_x - card_w//2, card_y + 16), "📍 LOCATION", 
              fill="#fff", font=title_font, anchor="mm")
     
@@ -1320,14 +3686,14 @@ def draw_info_boxes(img, location, toilet_nav, margin=60):
     shops_text = ", ".join(shop_display) if shop_display else "—"
     
     info_lines = [
-        ("Floor", location.floor, COLORS["secondary"]),
-        ("Direction", f"{location.direction:.0f}°", COLORS["text_primary"]),
-        ("Confidence", f"{location.confidence:.0%}", COLORS["success"] if location.confidence > 0.7 else COLORS["warning"]),
+        ("Floor", location.floor, PALETTE["secondary"]),
+        ("Direction", f"{location.direction:.0f}°", PALETTE["text_primary"]),
+        ("Confidence", f"{location.confidence:.0%}", PALETTE["success"] if location.confidence > 0.7 else PALETTE["warning"]),
     ]
     
     for i, (label, value, color) in enumerate(info_lines):
         y_pos = card_y + 42 + i * 20
-        draw.text((card_x - card_w + 12, y_pos), f"{label}:", fill=COLORS["text_secondary"], font=small_font, anchor="lm")
+        draw.text((card_x - card_w + 12, y_pos), f"{label}:", fill=PALETTE["text_secondary"], font=small_font, anchor="lm")
         draw.text((card_x - 12, y_pos), value, fill=color, font=small_font, anchor="rm")
     
     # Nearby shops on separate line with truncation
@@ -1335,8 +3701,8 @@ def draw_info_boxes(img, location, toilet_nav, margin=60):
         nearby_display = shops_text if len(shops_text) <= 22 else shops_text[:19] + "..."
     else:
         nearby_display = "—"
-    draw.text((card_x - card_w + 12, card_y + 102), "Nearby:", fill=COLORS["text_secondary"], font=small_font, anchor="lm")
-    draw.text((card_x - 12, card_y + 102), nearby_display, fill=COLORS["text_secondary"], font=small_font, anchor="rm")
+    draw.text((card_x - card_w + 12, card_y + 102), "Nearby:", fill=PALETTE["text_secondary"], font=small_font, anchor="lm")
+    draw.text((card_x - 12, card_y + 102), nearby_display, fill=PALETTE["text_secondary"], font=small_font, anchor="rm")
     
     # Toilet navigation card (bottom left)
     nav_w = 280
@@ -1350,12 +3716,12 @@ def draw_info_boxes(img, location, toilet_nav, margin=60):
     
     # Card background
     draw.rounded_rectangle([nav_x, nav_y, nav_x + nav_w, nav_y + nav_h], 
-                           radius=12, fill="#252836", outline=COLORS["toilet_target"], width=2)
+                           radius=12, fill="#252836", outline=PALETTE["toilet_target"], width=2)
     
     # Card header
     draw.rounded_rectangle([nav_x, nav_y, nav_x + nav_w, nav_y + 32], 
-                           radius=12, fill=COLORS["toilet_target"])
-    draw.rectangle([nav_x, nav_y + 20, nav_x + nav_w, nav_y + 32], fill=COLORS["toilet_target"])
+                           radius=12, fill=PALETTE["toilet_target"])
+    draw.rectangle([nav_x, nav_y + 20, nav_x + nav_w, nav_y + 32], fill=PALETTE["toilet_target"])
     draw.text((nav_x + nav_w//2, nav_y + 16), "🚻 NEAREST TOILET", 
              fill="#1a1d29", font=title_font, anchor="mm")
     
@@ -1364,12 +3730,12 @@ def draw_info_boxes(img, location, toilet_nav, margin=60):
     
     # Distance with visual indicator
     draw.text((nav_x + 15, nav_y + 48), toilet.get('name', 'Unknown'), 
-             fill=COLORS["text_primary"], font=bold_font, anchor="lm")
+             fill=PALETTE["text_primary"], font=bold_font, anchor="lm")
     
     # Distance pill
     dist_text = f"~{distance:.0f}m"
     draw.rounded_rectangle([nav_x + nav_w - 70, nav_y + 42, nav_x + nav_w - 12, nav_y + 58], 
-                           radius=8, fill=COLORS["secondary"])
+                           radius=8, fill=PALETTE["secondary"])
     draw.text((nav_x + nav_w - 41, nav_y + 50), dist_text, fill="#1a1d29", font=small_font, anchor="mm")
     
     # Instructions
@@ -1377,28 +3743,1306 @@ def draw_info_boxes(img, location, toilet_nav, margin=60):
     if len(instructions) > 35:
         instructions = instructions[:35] + "..."
     draw.text((nav_x + 15, nav_y + 72), instructions, 
-             fill=COLORS["text_secondary"], font=small_font, anchor="lm")
+             fill=PALETTE["text_secondary"], font=small_font, anchor="lm")
     
     # Accessible indicator
     if toilet.get("accessible"):
-        draw.text((nav_x + 15, nav_y + 88), "♿ Accessible", fill=COLORS["secondary"], font=small_font, anchor="lm")
+        draw.text((nav_x + 15, nav_y + 88), "♿ Accessible", fill=PALETTE["secondary"], font=small_font, anchor="lm")
     
     return img
 
 
 # =============================================================================
-# MAIN PROCESSING
+# SVG OUTPUT
 # =============================================================================
 
-def process_photo(photo_path):
-    """Process a single photo and generate output."""
-    print(f"\n{'='*60}")
-    print(f"Processing: {photo_path.name}")
-    print(f"{'='*60}")
-    print(f"Reference: {TIMES_SQUARE_FLOOR_PLAN_URL}")
+# Vector twin of the PNG renderer. The static floor layer is written once per
+# floor/size with two groups, #floor and #facilities, that per-photo SVGs pull
+# in with <use href="...#floor">, so each result file carries only its overlay.
+SVG_LAYER_FORMAT = 2        # bump when the layer markup changes, so old layer files aren't reused
+SVG_FONT_FAMILY = "Helvetica, 'DejaVu Sans', Arial, sans-serif"
+SVG_ANCHORS = {
+    "mm": 'text-anchor="middle" dominant-baseline="central"',
+    "lm": 'text-anchor="start" dominant-baseline="central"',
+    "rm": 'text-anchor="end" dominant-baseline="central"',
+}
+
+def svg_num(value) -> str:
+    """Compact coordinate: one decimal, no trailing zeros."""
+    text = f"{value:.1f}"
+    return text[:-2] if text.endswith(".0") else text
+
+def svg_escape(text) -> str:
+    return str(text).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+def svg_points(points) -> str:
+    return " ".join(f"{svg_num(x)},{svg_num(y)}" for x, y in points)
+
+def svg_rect(box, fill="none", radius=0, outline=None, width=1):
+    x1, y1, x2, y2 = box
+    attrs = f'x="{svg_num(x1)}" y="{svg_num(y1)}" width="{svg_num(x2 - x1)}" height="{svg_num(y2 - y1)}"'
+    if radius:
+        attrs += f' rx="{svg_num(radius)}"'
+    stroke = f' stroke="{outline}" stroke-width="{svg_num(width)}"' if outline else ""
+    return f'<rect {attrs} fill="{fill}"{stroke}/>'
+
+def svg_circle(x, y, r, fill="none", outline=None, width=1):
+    stroke = f' stroke="{outline}" stroke-width="{svg_num(width)}"' if outline else ""
+    return f'<circle cx="{svg_num(x)}" cy="{svg_num(y)}" r="{svg_num(r)}" fill="{fill}"{stroke}/>'
+
+def svg_polygon(points, fill="none", outline=None, width=1):
+    stroke = f' stroke="{outline}" stroke-width="{svg_num(width)}"' if outline else ""
+    return f'<polygon points="{svg_points(points)}" fill="{fill}"{stroke}/>'
+
+def svg_line(points, color, width, extra=""):
+    return (f'<polyline points="{svg_points(points)}" fill="none" stroke="{color}" '
+            f'stroke-width="{svg_num(width)}" stroke-linecap="round" stroke-linejoin="round"{extra}/>')
+
+def svg_text(x, y, text, fill, size, anchor="mm", bold=False):
+    weight = ' font-weight="bold"' if bold else ""
+    return (f'<text x="{svg_num(x)}" y="{svg_num(y)}" fill="{fill}" font-size="{size}"{weight} '
+            f'{SVG_ANCHORS[anchor]}>{svg_escape(text)}</text>')
+
+def svg_document(width, height, body) -> str:
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+            f'viewBox="0 0 {width} {height}" width="{width}" height="{height}" '
+            f'font-family="{SVG_FONT_FAMILY}">{"".join(body)}</svg>\n')
+
+def svg_floor_layer(floor, width, height, margin=60) -> List[str]:
+    """Background, floor shape, title and shops as the #floor group."""
+    floor_info = FLOOR_DATA.get(floor, FLOOR_DATA["GF"])
+    # Same gradient end point as gradient_background_image (0.6 of the way)
+    bottom = blend_colors(COLORS["bg_dark"], COLORS["bg_medium"], 0.6)
+    # The defs sit inside #floor so <use href="...#floor"> clones them along
+    # with the rects that point at them
+    out = [
+        '<g id="floor">',
+        '<defs>'
+        f'<linearGradient id="bg" x1="0" y1="0" x2="0" y2="1">'
+        f'<stop offset="0" stop-color="{COLORS["bg_dark"]}"/><stop offset="1" stop-color="{bottom}"/>'
+        '</linearGradient>'
+        f'<pattern id="grid" width="{GRID_SPACING}" height="{GRID_SPACING}" patternUnits="userSpaceOnUse">'
+        f'<path d="M0 0H{GRID_SPACING}M0 0V{GRID_SPACING}" stroke="{GRID_COLOR}" stroke-width="2"/>'
+        '</pattern></defs>',
+        svg_rect((0, 0, width, height), 'url(#bg)'),
+        svg_rect((0, 0, width, height), 'url(#grid)'),
+    ]
+    
+    points = floor_shape_points(width, height, margin)
+    out.append(svg_polygon([(x + 8, y + 8) for x, y in points], "#0a0c14"))
+    out.append(svg_polygon(points, COLORS["floor_base"], COLORS["primary"], 3))
+    inner_points = [
+        (margin + 15, margin + 55),
+        (width - margin - 105, margin + 22),
+        (width - margin - 12, margin + 68),
+        (width - margin - 12, height - margin - 55),
+        (width - margin - 105, height - margin - 22),
+        (margin + 68, height - margin - 22),
+        (margin + 12, height - margin - 65)
+    ]
+    out.append(svg_polygon(inner_points, outline="#3d4157"))
+    
+    title_text = f"TIMES SQUARE · {floor_info['name'].upper()}"
+    out.append(svg_text(width // 2 + 2, 28, title_text, "#0a0c14", 24))
+    out.append(svg_text(width // 2, 26, title_text, COLORS["text_primary"], 24))
+    out.append(svg_text(width // 2, 48, "Hong Kong · Floor Plan", COLORS["text_secondary"], 10))
+    
+    for code, info in floor_info.get("stores", {}).items():
+        sx = margin + (width - 2*margin) * info["x"]
+        sy = margin + (height - 2*margin) * info["y"]
+        name = info.get("name", code)
+        sw, sh, is_major, shop_color = shop_style(code, info)
+        out.append(svg_rect([sx-sw//2+3, sy-sh//2+3, sx+sw//2+3, sy+sh//2+3], "#0a0c14", 6))
+        out.append(svg_rect([sx-sw//2, sy-sh//2, sx+sw//2, sy+sh//2], shop_color, 6,
+                            COLORS["primary"] if is_major else "#555", 2 if is_major else 1))
+        out.append(svg_text(sx, sy, name[:14], "#fff" if is_major else COLORS["shop_text"],
+                            12 if is_major else 10))
+    out.append('</g>')
+    return out
+
+def svg_toilet_icon(x, y, size=14, highlight=False) -> List[str]:
+    out = []
+    if highlight:
+        for i in range(4, 0, -1):
+            out.append(svg_circle(x, y, size + i * 4,
+                                  blend_colors(COLORS["toilet_target"], COLORS["bg_dark"], 0.6 + i*0.1)))
+    main_color = COLORS["toilet_target"] if highlight else COLORS["toilet"]
+    out.append(svg_circle(x, y, size + 2, main_color, "#fff", 3 if highlight else 2))
+    out.append(svg_text(x, y, "WC", "#1a1d29", int(size * 0.9)))
+    return out
+
+def svg_facility_layer(floor, width, height, margin=60) -> List[str]:
+    """Facility icons and legend as the #facilities group (no toilet highlighted)."""
+    out = ['<g id="facilities">']
+    floor_fac = FLOOR_FACILITIES.get(floor, {})
+    
+    for esc_id in floor_fac.get("escalators", []):
+        if esc_id not in ESCALATOR_POSITIONS:
+            continue
+        e = ESCALATOR_POSITIONS[esc_id]
+        x = margin + (width - 2*margin) * e["x"]
+        y = margin + (height - 2*margin) * e["y"]
+        size = 18
+        if e.get("type") == "spiral":
+            for i in range(3, 0, -1):
+                out.append(svg_circle(x, y, size + i * 3, blend_colors(COLORS["escalator"], COLORS["bg_dark"], 0.7)))
+            out.append(svg_circle(x, y, size, COLORS["escalator"], "#fff", 2))
+            for angle in range(0, 360, 30):
+                rad = math.radians(angle)
+                out.append(svg_line([(x + size*0.25*math.cos(rad), y + size*0.25*math.sin(rad)),
+                                     (x + size*0.7*math.cos(rad), y + size*0.7*math.sin(rad))], "#fff", 2))
+        else:
+            out.append(svg_rect([x-size, y-size*0.5, x+size, y+size*0.5], COLORS["escalator"], 4, "#fff", 2))
+            for i in range(-2, 3):
+                lx = x + i * size * 0.35
+                out.append(svg_line([(lx, y-size*0.35), (lx+3, y+size*0.35)], "#fff", 2))
+    
+    for lift_id in floor_fac.get("elevators", []):
+        if lift_id not in ELEVATOR_POSITIONS:
+            continue
+        l = ELEVATOR_POSITIONS[lift_id]
+        x = margin + (width - 2*margin) * l["x"]
+        y = margin + (height - 2*margin) * l["y"]
+        size = 16
+        for i in range(3, 0, -1):
+            out.append(svg_circle(x, y, size + i * 2, blend_colors(COLORS["elevator"], COLORS["bg_dark"], 0.7)))
+        out.append(svg_rect([x-size, y-size, x+size, y+size], COLORS["elevator"], 4, "#fff", 2))
+        out.append(svg_polygon([(x, y-size*0.55), (x-5, y-size*0.15), (x+5, y-size*0.15)], "#fff"))
+        out.append(svg_polygon([(x, y+size*0.55), (x-5, y+size*0.15), (x+5, y+size*0.15)], "#fff"))
+    
+    for wc_id in floor_fac.get("toilets", []):
+        if wc_id in TOILET_POSITIONS:
+            wc = TOILET_POSITIONS[wc_id]
+            out.extend(svg_toilet_icon(margin + (width - 2*margin) * wc["x"],
+                                       margin + (height - 2*margin) * wc["y"]))
+    
+    legend_y = height - 38
+    out.append(svg_rect([margin - 10, legend_y - 12, width - margin + 10, legend_y + 20],
+                        "#252836", 8, COLORS["primary"], 1))
+    legend_items = [
+        ("●", COLORS["marker"], "You"),
+        ("→", COLORS["marker"], "Facing"),
+        ("■", "#6c5ce7", "Shops"),
+        ("◎", COLORS["escalator"], "Escalator"),
+        ("◆", COLORS["elevator"], "Elevator"),
+        ("◉", COLORS["toilet"], "Toilet"),
+        ("···", COLORS["path_main"], "Route"),
+    ]
+    lx = margin + 15
+    spacing = (width - 2*margin - 30) // len(legend_items)
+    for symbol, color, label in legend_items:
+        out.append(svg_text(lx, legend_y + 4, symbol, color, 10, "lm"))
+        out.append(svg_text(lx + 15, legend_y + 4, label, COLORS["text_secondary"], 10, "lm"))
+        lx += spacing
+    out.append('</g>')
+    return out
+
+def svg_static_layer(floor, width=800, height=600, margin=60) -> str:
+    """Standalone SVG of the static floor; per-photo SVGs reference its groups."""
+    return svg_document(width, height, svg_floor_layer(floor, width, height, margin)
+                        + svg_facility_layer(floor, width, height, margin))
+
+def svg_static_layer_name(floor, width=800, height=600) -> str:
+    """File name of a static layer; includes the layer digest so stale copies never match."""
+    return f"floor_{floor}_{width}x{height}_{floor_layer_digest(floor)}_v{SVG_LAYER_FORMAT}.svg"
+
+def svg_navigation_path(path, width, height, margin=60) -> List[str]:
+    if len(path) < 2:
+        return []
+    pixels = [(margin + (width-2*margin)*x, margin + (height-2*margin)*y) for x, y in path]
+    out = ['<g id="route">']
+    for glow_pass in range(3, 0, -1):
+        glow_color = blend_colors(COLORS["path_main"], COLORS["bg_dark"], 0.5 + glow_pass * 0.15)
+        out.append(svg_line(pixels, glow_color, 8 + glow_pass * 3))
+    # Zero-length dashes with round caps give the dotted line, one dot every 15px
+    out.append(svg_line(pixels, COLORS["path_main"], 8, ' stroke-dasharray="0 15"'))
+    for p in pixels[1:-1]:
+        out.append(svg_circle(p[0], p[1], 6, COLORS["path_main"], "#fff", 2))
+    end = pixels[-1]
+    for ring in range(3, 0, -1):
+        ring_color = blend_colors(COLORS["toilet_target"], COLORS["bg_dark"], 0.4 + ring * 0.15)
+        out.append(svg_circle(end[0], end[1], 10 + ring * 6, outline=ring_color, width=2))
+    out.append('</g>')
+    return out
+
+def svg_position_marker(location, width, height, margin=60) -> List[str]:
+    px = margin + (width - 2*margin) * location.x
+    py = margin + (height - 2*margin) * location.y
+    angle = math.radians(-location.direction + 90)
+    tip = (px + 50 * math.cos(angle), py - 50 * math.sin(angle))
+    h1 = (tip[0] - 12 * math.cos(angle - 0.5), tip[1] + 12 * math.sin(angle - 0.5))
+    h2 = (tip[0] - 12 * math.cos(angle + 0.5), tip[1] + 12 * math.sin(angle + 0.5))
+    out = [
+        '<g id="marker">',
+        svg_line([(px, py), tip], COLORS["marker_glow"], 8),
+        svg_line([(px, py), tip], COLORS["marker"], 4),
+        svg_polygon([tip, h1, h2], COLORS["marker"], "#fff", 2),
+    ]
+    ring_colors = [
+        (COLORS["marker_glow"], 1),
+        (blend_colors(COLORS["marker"], COLORS["marker_glow"], 0.5), 2),
+        (COLORS["marker"], 2),
+    ]
+    for i, (color, ring_width) in enumerate(ring_colors):
+        out.append(svg_circle(px, py, 20 + i * 8, outline=color, width=ring_width))
+    out.append(svg_circle(px, py, 10, COLORS["marker"], "#fff", 3))
+    out.append(svg_circle(px, py, 4, "#fff"))
+    out.append(svg_circle(px, py, 40 + (1 - location.confidence) * 15, outline=COLORS["marker_glow"]))
+    out.append('</g>')
+    return out
+
+def svg_info_cards(location, toilet_nav, width, height, margin=60) -> List[str]:
+    """Location and nearest-toilet cards, same layout and text as draw_info_boxes."""
+    out = ['<g id="cards">']
+    card_w, card_h = 210, 130
+    card_x, card_y = width - margin - 5, margin + 10
+    out.append(svg_rect([card_x - card_w + 4, card_y + 4, card_x + 4, card_y + card_h + 4], "#0a0c14", 12))
+    out.append(svg_rect([card_x - card_w, card_y, card_x, card_y + card_h], "#252836", 12, COLORS["primary"], 2))
+    out.append(svg_rect([card_x - card_w, card_y, card_x, card_y + 32], COLORS["primary"], 12))
+    out.append(svg_rect([card_x - card_w, card_y + 20, card_x, card_y + 32], COLORS["primary"]))
+    out.append(svg_text(card_x - card_w//2, card_y + 16, "📍 LOCATION", "#fff", 13))
+    
+    shops_text = ", ".join(shop[:12] for shop in location.detected_shops[:2]) or "—"
+    info_lines = [
+        ("Floor", location.floor, COLORS["secondary"]),
+        ("Direction", f"{location.direction:.0f}°", COLORS["text_primary"]),
+        ("Confidence", f"{location.confidence:.0%}", COLORS["success"] if location.confidence > 0.7 else COLORS["warning"]),
+    ]
+    for i, (label, value, color) in enumerate(info_lines):
+        y_pos = card_y + 42 + i * 20
+        out.append(svg_text(card_x - card_w + 12, y_pos, f"{label}:", COLORS["text_secondary"], 11, "lm"))
+        out.append(svg_text(card_x - 12, y_pos, value, color, 11, "rm"))
+    nearby_display = shops_text if len(shops_text) <= 22 else shops_text[:19] + "..."
+    out.append(svg_text(card_x - card_w + 12, card_y + 102, "Nearby:", COLORS["text_secondary"], 11, "lm"))
+    out.append(svg_text(card_x - 12, card_y + 102, nearby_display, COLORS["text_secondary"], 11, "rm"))
+    
+    nav_w, nav_h = 280, 100
+    nav_x, nav_y = margin, height - margin - nav_h - 45
+    out.append(svg_rect([nav_x + 4, nav_y + 4, nav_x + nav_w + 4, nav_y + nav_h + 4], "#0a0c14", 12))
+    out.append(svg_rect([nav_x, nav_y, nav_x + nav_w, nav_y + nav_h], "#252836", 12, COLORS["toilet_target"], 2))
+    out.append(svg_rect([nav_x, nav_y, nav_x + nav_w, nav_y + 32], COLORS["toilet_target"], 12))
+    out.append(svg_rect([nav_x, nav_y + 20, nav_x + nav_w, nav_y + 32], COLORS["toilet_target"]))
+    out.append(svg_text(nav_x + nav_w//2, nav_y + 16, "🚻 NEAREST TOILET", "#1a1d29", 13))
+    
+    toilet = toilet_nav.get("toilet", {})
+    out.append(svg_text(nav_x + 15, nav_y + 48, toilet.get("name", "Unknown"), COLORS["text_primary"], 14, "lm", bold=True))
+    out.append(svg_rect([nav_x + nav_w - 70, nav_y + 42, nav_x + nav_w - 12, nav_y + 58], COLORS["secondary"], 8))
+    out.append(svg_text(nav_x + nav_w - 41, nav_y + 50, f"~{toilet_nav.get('distance_m', 0):.0f}m", "#1a1d29", 11))
+    instructions = toilet_nav.get("instructions", "")
+    if len(instructions) > 35:
+        instructions = instructions[:35] + "..."
+    out.append(svg_text(nav_x + 15, nav_y + 72, instructions, COLORS["text_secondary"], 11, "lm"))
+    if toilet.get("accessible"):
+        out.append(svg_text(nav_x + 15, nav_y + 88, "♿ Accessible", COLORS["secondary"], 11, "lm"))
+    out.append('</g>')
+    return out
+
+def render_location_svg(location, toilet_nav, width=800, height=600, static_href=None, margin=60) -> str:
+    """
+    Per-photo SVG. With static_href (path of the svg_static_layer() file,
+    relative to this one) the floor and facility groups are referenced rather
+    than inlined, leaving only the route, marker and cards in the file.
+    """
+    floor = location.floor
+    if static_href:
+        base = f'<use href="{static_href}#floor" xlink:href="{static_href}#floor"/>'
+        icons = f'<use href="{static_href}#facilities" xlink:href="{static_href}#facilities"/>'
+        body = [base]
+    else:
+        body = svg_floor_layer(floor, width, height, margin)
+        icons = "".join(svg_facility_layer(floor, width, height, margin))
+    body += svg_navigation_path(toilet_nav.get("path", []), width, height, margin)
+    body.append(icons)
+    
+    # Redraw the target toilet highlighted on top of its plain icon
+    highlight = toilet_nav.get("toilet", {}).get("name")
+    for wc_id in FLOOR_FACILITIES.get(floor, {}).get("toilets", []):
+        wc = TOILET_POSITIONS.get(wc_id)
+        if wc and highlight is not None and wc.get("name") == highlight:
+            body += svg_toilet_icon(margin + (width - 2*margin) * wc["x"],
+                                    margin + (height - 2*margin) * wc["y"], highlight=True)
+    body += svg_position_marker(location, width, height, margin)
+    body += svg_info_cards(location, toilet_nav, width, height, margin)
+    return svg_document(width, height, body)
+
+def render_combined_svg(floor, locations, width=1000, height=800, static_href=None, marker_margin=50) -> str:
+    """All photo positions on one floor as SVG."""
+    if static_href:
+        body = [f'<use href="{static_href}#floor" xlink:href="{static_href}#floor"/>',
+                f'<use href="{static_href}#facilities" xlink:href="{static_href}#facilities"/>']
+    else:
+        body = svg_floor_layer(floor, width, height) + svg_facility_layer(floor, width, height)
+    for loc in locations:
+        body += svg_position_marker(loc, width, height, marker_margin)
+    return svg_document(width, height, body)
+
+
+# =============================================================================
+# TILE PYRAMID EXPORT
+# =============================================================================
+
+# z/x/y PNG tiles per floor under output/tiles/<floor>/, plus manifest.json.
+# The deepest zoom is the source image at 1:1; every level above halves it
+# down to zoom 0, where the whole floor fits in one tile.
+TILE_SIZE = 256
+TILES_DIR = OUTPUT_DIR / "tiles"
+TILE_RENDER_SIZE = (2048, 1536)   # used when a floor has no floor_plans/*.png
+EXPORT_TILES = os.getenv("EXPORT_TILES", "0") == "1"
+
+def tile_level_transform(floor_manifest, zoom) -> List[float]:
+    """[sx, ox, sy, oy] so that level pixel = (sx * x + ox, sy * y + oy) for 0-1 coords."""
+    scale = 2.0 ** (zoom - floor_manifest["max_zoom"])
+    x0, y0, x1, y1 = floor_manifest["content_box"]
+    return [(x1 - x0) * scale, x0 * scale, (y1 - y0) * scale, y0 * scale]
+
+def normalized_to_tile(floor_manifest, x, y, zoom):
+    """
+    Tile holding the normalized point (x, y) at a zoom level, plus the pixel
+    offset inside that tile: ((tx, ty), (px, py)).
+    """
+    sx, ox, sy, oy = tile_level_transform(floor_manifest, zoom)
+    gx, gy = sx * x + ox, sy * y + oy
+    size = floor_manifest["tile_size"]
+    tx, ty = int(gx // size), int(gy // size)
+    return (tx, ty), (gx - tx * size, gy - ty * size)
+
+def tile_source_digest(floor) -> str:
+    """Identity of a floor's tile source, available without decoding or rendering it."""
+    plan = RESOURCES.floor_plan(floor)
+    if plan is not None:
+        return plan.digest
+    width, height = TILE_RENDER_SIZE
+    return f"rendered:{floor_layer_digest(floor)}:{width}x{height}"
+
+def tile_source_image(floor):
+    """The floor's plan from floor_plans/ if present, else a high-resolution render."""
+    plan = RESOURCES.floor_plan(floor)
+    if plan is not None:
+        return plan.image.convert("RGBA"), str(plan.path)
+    return create_floor_plan_image(floor, *TILE_RENDER_SIZE).convert("RGBA"), "rendered"
+
+def export_floor_tiles(floor, out_dir=None, previous=None, tile_size=TILE_SIZE):
+    """
+    Cut one floor into a tile pyramid. previous is this floor's entry from
+    the last manifest: deepest-level tiles whose content digest is unchanged
+    (and whose file still exists) are not rewritten, and an overview tile,
+    built from its four children, is only rebuilt when one of them was.
+    Returns (manifest entry, tiles written).
+    """
+    out_dir = Path(out_dir or TILES_DIR) / floor
+    previous = previous or {}
+    old_tiles = previous.get("tiles", {}) if previous.get("tile_size") == tile_size else {}
+    source, source_name = tile_source_image(floor)
+    width, height = source.size
+    max_zoom = max(0, math.ceil(math.log2(max(width, height) / tile_size)))
+    
+    def tile_path(zoom, tx, ty):
+        return out_dir / str(zoom) / str(tx) / f"{ty}.png"
+    
+    tiles = {}
+    levels = {}
+    written = 0
+    below = {}          # (tx, ty) -> tile image of the level below, when already in memory
+    dirty = None        # tiles rewritten at the level below; None at the deepest level
+    for zoom in range(max_zoom, -1, -1):
+        shrink = 2 ** (max_zoom - zoom)
+        level_w, level_h = math.ceil(width / shrink), math.ceil(height / shrink)
+        cols, rows = math.ceil(level_w / tile_size), math.ceil(level_h / tile_size)
+        levels[str(zoom)] = {"width": level_w, "height": level_h, "cols": cols, "rows": rows}
+        
+        current, changed = {}, set()
+        for ty in range(rows):
+            for tx in range(cols):
+                key = f"{zoom}/{tx}/{ty}"
+                path = tile_path(zoom, tx, ty)
+                children = [(2*tx + dx, 2*ty + dy) for dy in (0, 1) for dx in (0, 1)]
+                if (dirty is not None and key in old_tiles and path.exists()
+                        and not any(child in dirty for child in children)):
+                    tiles[key] = old_tiles[key]
+                    continue
+                
+                tile = Image.new("RGBA", (tile_size, tile_size), (0, 0, 0, 0))
+                if dirty is None:
+                    x0, y0 = tx * tile_size, ty * tile_size
+                    tile.paste(source.crop((x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height))))
+                else:
+                    # Overview: 2x2 children mosaic scaled down by half
+                    mosaic = Image.new("RGBA", (2 * tile_size, 2 * tile_size), (0, 0, 0, 0))
+                    for cx, cy in children:
+                        child = below.get((cx, cy))
+                        if child is None and tile_path(zoom + 1, cx, cy).exists():
+                            child = Image.open(tile_path(zoom + 1, cx, cy))
+                        if child is not None:
+                            mosaic.paste(child, ((cx - 2*tx) * tile_size, (cy - 2*ty) * tile_size))
+                    tile = mosaic.resize((tile_size, tile_size), Image.LANCZOS)
+                
+                tile_digest = hashlib.sha1(tile.tobytes()).hexdigest()
+                tiles[key] = tile_digest
+                current[(tx, ty)] = tile
+                if old_tiles.get(key) == tile_digest and path.exists():
+                    continue
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tile.save(path, optimize=True)
+                changed.add((tx, ty))
+                written += 1
+        below, dirty = current, changed
+    
+    # Drop tiles of levels, columns or rows that no longer exist
+    for key in set(old_tiles) - set(tiles):
+        stale = out_dir / f"{key}.png"
+        if stale.exists():
+            stale.unlink()
+    
+    entry = {
+        "source": source_name,
+        "source_digest": tile_source_digest(floor),
+        "width": width,
+        "height": height,
+        "tile_size": tile_size,
+        "min_zoom": 0,
+        "max_zoom": max_zoom,
+        # Pixel box the normalized 0-1 coordinates span at the deepest zoom
+        "content_box": [PLAN_MARGIN, PLAN_MARGIN, width - PLAN_MARGIN, height - PLAN_MARGIN],
+        "url_template": f"{floor}/{{z}}/{{x}}/{{y}}.png",
+    }
+    for zoom, level in levels.items():
+        level["transform"] = tile_level_transform(entry, int(zoom))
+    entry["levels"] = levels
+    entry["tiles"] = tiles
+    return entry, written
+
+def export_tile_pyramids(floors=None, out_dir=None, tile_size=TILE_SIZE):
+    """Export or incrementally refresh tile pyramids and manifest.json. Returns the manifest."""
+    out_dir = Path(out_dir or TILES_DIR)
+    manifest_path = out_dir / "manifest.json"
+    manifest = {"version": 1, "tile_size": tile_size, "floors": {}}
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            manifest["floors"] = json.load(f).get("floors", {})
+    
+    for floor in floors or list(FLOOR_DATA):
+        previous = manifest["floors"].get(floor)
+        if (previous and previous.get("tile_size") == tile_size
+                and previous.get("source_digest") == tile_source_digest(floor)
+                and all((out_dir / floor / f"{key}.png").exists() for key in previous["tiles"])):
+            continue
+        entry, written = export_floor_tiles(floor, out_dir, previous, tile_size)
+        manifest["floors"][floor] = entry
+        print(f"✓ Tiles {floor}: zoom 0-{entry['max_zoom']}, {written}/{len(entry['tiles'])} written")
+    
+    out_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+
+# =============================================================================
+# PARALLEL RENDERING
+# =============================================================================
+
+# Process pool size for PNG rendering; 0 or 1 renders serially in-process
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(os.cpu_count() or 1)))
+
+def render_payload(toilet_nav) -> dict:
+    """The parts of a find_nearest_toilet() result the renderer reads."""
+    return {
+        "toilet": toilet_nav.get("toilet", {}),
+        "path": toilet_nav.get("path", []),
+        "distance_m": toilet_nav.get("distance_m", 0),
+        "instructions": toilet_nav.get("instructions", ""),
+    }
+
+def render_location_image(location, toilet_nav):
+    """Per-photo image: floor plan with route, position marker and info cards."""
+    img = create_floor_plan_image(location.floor, location=location, toilet_nav=toilet_nav)
+    img = draw_position_marker(img, location)
+    return draw_info_boxes(img, location, toilet_nav)
+
+def render_combined_image(floor, locations):
+    """All photo positions on one floor."""
+    img = create_floor_plan_image(floor, 1000, 800)
+    for loc in locations:
+        img = draw_position_marker(img, loc, 50)
+    return img
+
+def render_posterior_heatmap(floor, grid, xs, ys, width=1000, height=800, margin=60):
+    """Floor plan with a GridLocalizer posterior (rows ys, cols xs) shaded over it."""
+    img = create_floor_plan_image(floor, width, height).convert("RGBA")
+    peak = grid.max()
+    layer = np.zeros(grid.shape + (4,), dtype=np.uint8)
+    layer[..., :3] = PALETTE["marker"]
+    if peak > 0:
+        layer[..., 3] = np.sqrt(grid / peak) * 200
+    # Each cell is centred on its lattice point
+    half_x, half_y = (xs[1] - xs[0]) / 2, (ys[1] - ys[0]) / 2
+    left, right = margin + (width - 2*margin) * (xs[0] - half_x), margin + (width - 2*margin) * (xs[-1] + half_x)
+    top, bottom = margin + (height - 2*margin) * (ys[0] - half_y), margin + (height - 2*margin) * (ys[-1] + half_y)
+    size = (max(int(round(right - left)), 1), max(int(round(bottom - top)), 1))
+    heat = Image.new("RGBA", img.size, (0, 0, 0, 0))
+    heat.paste(Image.fromarray(layer, "RGBA").resize(size, Image.BILINEAR), (int(round(left)), int(round(top))))
+    return Image.alpha_composite(img, heat).convert("RGB")
+
+# "png", "svg" or "both"
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "png").lower()
+
+def _render_job(job):
+    """Worker entry point: render one job and write its file. Returns the path."""
+    kind, output_path, args = job
+    if kind == "photo_svg":
+        output_path.write_text(render_location_svg(*args), encoding="utf-8")
+        return output_path
+    if kind == "combined_svg":
+        output_path.write_text(render_combined_svg(*args), encoding="utf-8")
+        return output_path
+    if kind == "photo":
+        img = render_location_image(*args)
+    elif kind == "heatmap":
+        img = render_posterior_heatmap(*args)
+    else:
+        img = render_combined_image(*args)
+    img.save(output_path)
+    return output_path
+
+def write_static_svg(floor, width, height, directory) -> str:
+    """Write a floor's static SVG layer into directory once; returns its file name."""
+    name = svg_static_layer_name(floor, width, height)
+    path = Path(directory) / name
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(svg_static_layer(floor, width, height), encoding="utf-8")
+    return name
+
+def _init_render_worker(mall_dir):
+    if mall_dir and (ACTIVE_MALL is None or str(ACTIVE_MALL.directory) != mall_dir):
+        activate_mall(Path(mall_dir).name, MallRegistry(Path(mall_dir).parent))
+
+def render_jobs(jobs, workers=None, pool=None):
+    """
+    Render ("photo", path, (location, toilet_nav)) and
+    ("combined", path, (floor, locations)) jobs (plus their "_svg"
+    variants), writing the files from a
+    process pool. Workers warm their own static layer caches, so only the
+    small location/route data crosses the process boundary. Pass a
+    render_pool() as pool to keep the workers across calls. Yields
+    (job, error) as jobs finish; error is None on success.
+    """
+    if pool is None:
+        workers = RENDER_WORKERS if workers is None else workers
+        workers = min(workers, len(jobs))
+        if workers <= 1:
+            for job in jobs:
+                try:
+                    _render_job(job)
+                    yield job, None
+                except Exception as e:
+                    yield job, e
+            return
+        with render_pool(workers) as pool:
+            yield from render_jobs(jobs, pool=pool)
+        return
+
+    futures = {pool.submit(_render_job, job): job for job in jobs}
+    for future in as_completed(futures):
+        yield futures[future], future.exception()
+
+def render_pool(workers=None) -> Optional[ProcessPoolExecutor]:
+    """A render process pool to reuse across render_jobs() calls, or None for in-process rendering."""
+    workers = RENDER_WORKERS if workers is None else workers
+    if workers <= 1:
+        return None
+    # Spawned workers re-import the module, so hand them the active mall too
+    mall_dir = str(ACTIVE_MALL.directory) if ACTIVE_MALL is not None else None
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker, initargs=(mall_dir,))
+
+
+# =============================================================================
+# RESULTS OUTPUT
+# =============================================================================
+
+# main() analyzes, records and renders this many photos at a time
+PIPELINE_CHUNK = max(1, int(os.getenv("PIPELINE_CHUNK", "32")))
+
+def chunked(items, size):
+    """Consecutive slices of at most size items."""
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+RESULTS_JSONL = "location_results.jsonl"
+RESULTS_JSON = "location_results.json"
+
+class ResultsWriter:
+    """
+    Append-only JSONL log of results, one record per line, flushed and
+    fsynced as each is written so a crash loses at most the record in
+    flight. With resume=True an existing log is kept (minus a torn last
+    line) and its photos are listed in .done.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = Path(path)
+        self.done = set()
+        if resume and self.path.exists():
+            self._recover()
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_bytes(b"")
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _recover(self):
+        """Collect finished photos and cut off a partially written trailing record."""
+        good = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                self.done.add(record.get("photo"))
+                good += len(line)
+        if good < self.path.stat().st_size:
+            with open(self.path, "r+b") as f:
+                f.truncate(good)
+
+    def write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.done.add(record.get("photo"))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_results(path):
+    """Yield records from a results JSONL file, stopping at a torn last line."""
+    path = Path(path)
+    if not path.exists():
+        return
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                return
+
+def latest_results(path) -> List[dict]:
+    """Results in stream order, keeping only the last record of a re-processed photo."""
+    latest = {}
+    for record in read_results(path):
+        latest.pop(record.get("photo"), None)
+        latest[record.get("photo")] = record
+    return list(latest.values())
+
+def write_results_json(jsonl_path, json_path):
+    """Build the compact single-document JSON from the stream."""
+    tmp_path = Path(json_path).with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(latest_results(jsonl_path), f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, json_path)
+
+def location_fields(location) -> dict:
+    """The LocationEstimate part of a results record / API reply."""
+    fields = {
+        "floor": location.floor,
+        "position": {"x": round(location.x, 3), "y": round(location.y, 3)},
+        "direction": location.direction,
+        "confidence": location.confidence,
+        "radius_m": None if location.radius is None else round(location.radius * 100, 1),
+    }
+    if location.modes is not None:
+        fields["modes"] = [{"floor": m["floor"], "x": round(m["x"], 3), "y": round(m["y"], 3),
+                            "mass": round(m["mass"], 4)} for m in location.modes]
+        fields["entropy_bits"] = round(location.entropy, 2)
+    fields["detected_shops"] = location.detected_shops
+    fields["store_codes"] = location.store_codes
+    return fields
+
+def photo_outputs(photo) -> List[Path]:
+    """Image files main() writes for one photo under the current OUTPUT_FORMAT."""
+    formats = {"png": ["png"], "svg": ["svg"], "both": ["png", "svg"]}.get(OUTPUT_FORMAT, ["png"])
+    outputs = [OUTPUT_DIR / f"location_{photo.stem}.{ext}" for ext in formats]
+    if POSITION_BACKEND == "grid":
+        outputs.append(heatmap_path(photo))
+    return outputs
+
+def heatmap_path(photo) -> Path:
+    """Posterior heatmap main() writes for one photo under the grid backend."""
+    return OUTPUT_DIR / f"heatmap_{photo.stem}.png"
+
+
+# =============================================================================
+# STAGED PIPELINE
+# =============================================================================
+
+# process_photo() split into persisted stages. Each stage's output is stored
+# in cache/stages/<photo>.json next to a fingerprint of its inputs (upstream
+# output plus the tables it reads), so a re-run only recomputes stages whose
+# inputs changed: editing a waypoint re-routes and re-renders, but never
+# re-analyzes.
+STAGES = ("analysis", "position", "route", "render")
+STAGES_DIR = CACHE_DIR / "stages"
+
+def data_digest(*parts) -> str:
+    """Stable digest of JSON-like data."""
+    text = json.dumps(parts, sort_keys=True, separators=(",", ":"),
+                      default=lambda o: dict(o) if isinstance(o, Mapping) else str(o))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def table_digest(table) -> str:
+    """Digest of a module table; a mall view is digested by its token, without decoding floors."""
+    token = table_token(table)
+    return data_digest(token if token is not None else table)
+
+def stage_table_digests() -> dict:
+    """
+    Digests of the module tables the position and route stages read, beyond
+    their upstream output. Render reads only the photo's floor, so its digest
+    is taken per floor (StagedPipeline.render_fingerprint).
+    """
+    return {
+        "position": data_digest(table_digest(ALL_STORES), STORE_NAME_TO_CODE, table_digest(FLOOR_FACILITIES),
+                                ELEVATOR_POSITIONS, ESCALATOR_POSITIONS, TOILET_POSITIONS, BEARING_SIGMAS,
+                                SOLVER_STEP, POSITION_BACKEND),
+        "route": data_digest(table_digest(WALKWAY_WAYPOINTS), table_digest(WALKWAY_CONNECTIONS),
+                             TOILET_POSITIONS, table_digest(FLOOR_FACILITIES), ELEVATOR_POSITIONS,
+                             ESCALATOR_POSITIONS, VERTICAL_COSTS, FLOOR_ORDER, table_digest(FLOOR_DATA),
+                             NAVIGATION_BACKEND),
+    }
+
+class StageStore:
+    """One JSON file per photo: {stage: {"fingerprint": ..., "output": ...}}."""
+
+    def __init__(self, root=None):
+        self.root = Path(root or STAGES_DIR)
+
+    def _path(self, photo) -> Path:
+        return self.root / f"{Path(photo).name}.json"
+
+    def load(self, photo) -> dict:
+        path = self._path(photo)
+        if not path.exists():
+            return {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def get(self, photo, stage, fingerprint):
+        entry = self.load(photo).get(stage)
+        if entry and entry.get("fingerprint") == fingerprint:
+            return entry["output"]
+        return None
+
+    def put(self, photo, stage, fingerprint, output):
+        entries = self.load(photo)
+        entries[stage] = {"fingerprint": fingerprint, "output": output}
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self._path(photo)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+class StagedPipeline:
+    """
+    analysis -> estimate_position() -> find_nearest_toilet() -> render, each
+    stage reused from the StageStore when its fingerprint matches. .counts
+    tracks how many times each stage was recomputed vs reused.
+    """
+
+    def __init__(self, store=None, batch=False):
+        self.store = store or StageStore()
+        self.batch = batch          # analyze through the batch endpoint
+        self.tables = stage_table_digests()
+        self.layers = {}            # floor -> floor_layer_digest, taken when a photo there is rendered
+        self.counts = {stage: {"run": 0, "reused": 0} for stage in STAGES}
+        self.failed = {}            # photo -> fallback analysis, not retried again in this run
+        self.posteriors = {}        # photo -> PositionPosterior from a fresh grid-backend position
+
+    def _count(self, stage, reused):
+        self.counts[stage]["reused" if reused else "run"] += 1
+
+    def analysis_fingerprint(self, photo) -> str:
+        if not OPENAI_API_KEY:
+            return data_digest("fallback", photo.name)
+        templates = get_prompt_templates()
+        two_stage = ANALYSIS_TWO_STAGE and not self.batch
+        mode = f"two-stage:{templates.fingerprint}:{FLOOR_CLASSIFIER_MODEL}" if two_stage else templates.fingerprint
+        return data_digest(file_sha256(photo), VISION_MODEL, mode, upload_settings())
+
+    def cached_analysis(self, photo) -> Optional[dict]:
+        return self.store.get(photo, "analysis", self.analysis_fingerprint(photo))
+
+    def analyses(self, photos) -> List[dict]:
+        """Stored analyses where still valid; only the rest are (concurrently) analyzed."""
+        results = [self.failed.get(photo) or self.cached_analysis(photo) for photo in photos]
+        stale = [i for i, result in enumerate(results) if result is None]
+        if stale:
+            if OPENAI_API_KEY and self.batch:
+                fresh = analyze_photos_batch([photos[i] for i in stale])
+            elif OPENAI_API_KEY:
+                fresh = analyze_photos([photos[i] for i in stale])
+            else:
+                fresh = [analyze_photo_fallback(photos[i]) for i in stale]
+            for i, analysis in zip(stale, fresh):
+                results[i] = analysis
+                # A failed AI call falls back; don't persist the stand-in
+                if "analysis_error" not in analysis:
+                    self.store.put(photos[i], "analysis", self.analysis_fingerprint(photos[i]), analysis)
+                else:
+                    self.failed[photos[i]] = analysis
+        for i in range(len(photos)):
+            self._count("analysis", i not in stale)
+        return results
+
+    def position(self, photo, analysis) -> LocationEstimate:
+        fingerprint = data_digest(analysis, self.tables["position"])
+        stored = self.store.get(photo, "position", fingerprint)
+        self._count("position", stored is not None)
+        if stored is not None:
+            return LocationEstimate(**stored)
+        if POSITION_BACKEND == "grid":
+            location, self.posteriors[photo] = locate_on_grid(analysis)
+        else:
+            location = estimate_position(analysis)
+        self.store.put(photo, "position", fingerprint, asdict(location))
+        return location
+
+    def posterior(self, photo, analysis) -> PositionPosterior:
+        """Grid posterior behind photo's position; only recomputed if the position was stored."""
+        posterior = self.posteriors.pop(photo, None)
+        return posterior if posterior is not None else locate_on_grid(analysis)[1]
+
+    def route(self, photo, location) -> dict:
+        """Route summary (render_payload of find_nearest_toilet) from the location."""
+        fingerprint = data_digest(location.floor, location.x, location.y, self.tables["route"])
+        stored = self.store.get(photo, "route", fingerprint)
+        self._count("route", stored is not None)
+        if stored is not None:
+            return stored
+        route = render_payload(find_nearest_toilet(location.floor, location.x, location.y))
+        # Stored as JSON, so hand back the same list-based shape on a fresh run
+        route = json.loads(json.dumps(route))
+        self.store.put(photo, "route", fingerprint, route)
+        return route
+
+    def render_fingerprint(self, location, route) -> str:
+        if location.floor not in self.layers:
+            self.layers[location.floor] = floor_layer_digest(location.floor)
+        return data_digest(asdict(location), route, self.layers[location.floor], OUTPUT_FORMAT,
+                           SVG_LAYER_FORMAT, RESOURCES.font_path())
+
+    def render_current(self, photo, fingerprint, outputs) -> bool:
+        """True when the stored render matches and all its files still exist."""
+        current = (self.store.get(photo, "render", fingerprint) is not None
+                   and all(Path(path).exists() for path in outputs))
+        self._count("render", current)
+        return current
+
+    def render_done(self, photo, fingerprint, outputs):
+        self.store.put(photo, "render", fingerprint, [str(path) for path in outputs])
+
+    def summary(self) -> str:
+        return ", ".join(f"{stage} {c['run']} run/{c['reused']} reused" for stage, c in self.counts.items())
+
+
+# =============================================================================
+# TRAJECTORY SMOOTHING
+# =============================================================================
+
+# Sequence mode (--sequence): photos from one visitor are ordered by the
+# capture time in their file names and located jointly. A Viterbi pass over
+# the multi-floor walkway graph trades each photo's own estimate against how
+# far anyone could have walked since the previous photo, so a misread floor
+# or corridor between two consistent neighbours gets pulled back.
+WALK_SPEED = float(os.getenv("WALK_SPEED", "0.012"))    # normalized units per second (1.2 m/s)
+WALK_SLACK = 0.05           # reach allowed even between near-simultaneous photos
+SEQUENCE_MAX_GAP = float(os.getenv("SEQUENCE_MAX_GAP", "1800"))  # seconds; longer gaps start a new sequence
+# Below this a photo gives no evidence. Bearing-solver confidences run about
+# 0.1 (a ~25m radius) to 0.4, grid-mode mode masses about 0.01 to 0.3.
+SEQUENCE_MIN_CONFIDENCE = float(os.getenv("SEQUENCE_MIN_CONFIDENCE", "0.1"))
+EMISSION_SIGMA = 0.05       # minimum spread of a photo's own estimate around a graph node
+
+# "Screenshot 2025-11-30 at 15.41.24.png", "IMG 2025-11-30 15-41-24 PM.jpg", ...
+PHOTO_TIME_PATTERN = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})\D{1,5}?(\d{1,2})[.:_-](\d{2})[.:_-](\d{2})(?:\s*([AaPp])[Mm])?")
+
+def photo_timestamp(photo) -> float:
+    """Capture time (epoch seconds) from the file name, else the file's mtime."""
+    match = PHOTO_TIME_PATTERN.search(Path(photo).stem)
+    if match:
+        year, month, day, hour, minute, second = map(int, match.groups()[:6])
+        meridiem = (match.group(7) or "").lower()
+        if meridiem:
+            hour = hour % 12 + (12 if meridiem == "p" else 0)
+        try:
+            return datetime(year, month, day, hour, minute, second).timestamp()
+        except ValueError:
+            pass
+    return Path(photo).stat().st_mtime
+
+@dataclass
+class Trajectory:
+    photos: List[str]
+    times: List[float]                  # epoch seconds
+    locations: List[LocationEstimate]   # smoothed, one per photo
+    inferred: List[bool]                # too uncertain to use: placed from its neighbours
+    corrected: List[bool]               # own estimate overruled by the sequence
+    path: List[dict]                    # walking legs [{"floor", "path"}] through the states
+    cost: float
+
+def emission_costs(graph, location, trusted) -> np.ndarray:
+    """(N,) -log p(photo | node). Zero everywhere for an untrusted photo."""
+    if not trusted:
+        return np.zeros(len(graph.coords))
+    coords = np.asarray(graph.coords, dtype=float)
+    floors = np.asarray(graph.floor)
+    sigma = max(EMISSION_SIGMA, (location.radius or 0.0) / 2)
+    # Confidence also reflects position spread, so even a vague photo keeps
+    # at least even odds on its own floor
+    confidence = 0.5 + 0.5 * min(max(location.confidence, 0.0), 0.98)
+    other = (1 - confidence) / max(len(set(graph.floor)) - 1, 1)
+    modes = location.modes or [{"floor": location.floor, "x": location.x, "y": location.y, "mass": 1.0}]
+    likelihood = np.zeros(len(coords))
+    for mode in modes:
+        d2 = ((coords - (mode["x"], mode["y"])) ** 2).sum(axis=1)
+        likelihood += mode["mass"] * np.where(floors == mode["floor"], confidence, other) * np.exp(-0.5 * d2 / sigma ** 2)
+    return -np.log(likelihood / sum(m["mass"] for m in modes) + 1e-300)
+
+def transition_costs(distances, elapsed) -> np.ndarray:
+    """(N, N) -log p(node j | node i, elapsed seconds): walking further than WALK_SPEED allows is expensive."""
+    reach = WALK_SPEED * max(elapsed, 0.0) + WALK_SLACK
+    return 0.5 * (distances / reach) ** 2
+
+def smooth_trajectory(photos, locations, trusted=None) -> Trajectory:
+    """
+    Viterbi over the multi-floor walkway graph for photos already in capture
+    order. Photos flagged untrusted (default: below SEQUENCE_MIN_CONFIDENCE)
+    contribute no evidence and take the node their neighbours imply. A run
+    with no trusted photo has nothing to smooth against and is left as is.
+    """
+    times = [photo_timestamp(photo) for photo in photos]
+    if trusted is None:
+        trusted = [loc.confidence >= SEQUENCE_MIN_CONFIDENCE for loc in locations]
+    if not any(trusted):
+        return Trajectory(photos=[Path(photo).name for photo in photos], times=times, locations=list(locations),
+                          inferred=[False] * len(photos), corrected=[False] * len(photos), path=[], cost=0.0)
+    graph = get_multi_floor_graph()
+    distances, _ = graph.shortest_paths()
+    
+    score = emission_costs(graph, locations[0], trusted[0])
+    back = []
+    for t in range(1, len(photos)):
+        total = score[:, None] + transition_costs(distances, times[t] - times[t - 1])
+        back.append(total.argmin(axis=0))
+        score = total.min(axis=0) + emission_costs(graph, locations[t], trusted[t])
+    states = [int(score.argmin())]
+    for pointers in reversed(back):
+        states.append(int(pointers[states[-1]]))
+    states.reverse()
+    
+    coords = np.asarray(graph.coords, dtype=float)
+    floors = np.asarray(graph.floor)
+    smoothed, inferred, corrected = [], [], []
+    for location, ok, node in zip(locations, trusted, states):
+        floor, (x, y) = graph.floor[node], graph.coords[node]
+        # A trusted estimate keeps its own, finer, position when the chosen node
+        # is about as close to it as the nearest node on its floor
+        agrees = False
+        if ok and floor == location.floor:
+            gaps = np.hypot(*(coords[floors == floor] - (location.x, location.y)).T)
+            sigma = max(EMISSION_SIGMA, (location.radius or 0.0) / 2)
+            agrees = distance((x, y), (location.x, location.y)) <= gaps.min() + 2 * sigma
+        inferred.append(not ok)
+        corrected.append(ok and not agrees)
+        if agrees:
+            smoothed.append(location)
+        else:
+            smoothed.append(LocationEstimate(
+                floor=floor, x=x, y=y, direction=location.direction, confidence=location.confidence,
+                detected_shops=location.detected_shops, store_codes=location.store_codes,
+                reasoning=location.reasoning))
+    
+    path = []
+    for start, goal in zip(states, states[1:]):
+        for leg in graph.legs(graph.path_between(start, goal) or [start, goal]):
+            if path and path[-1]["floor"] == leg["floor"]:
+                path[-1]["path"].extend(leg["path"][1:] if path[-1]["path"][-1] == leg["path"][0] else leg["path"])
+            else:
+                path.append({"floor": leg["floor"], "path": list(leg["path"])})
+    return Trajectory(
+        photos=[Path(photo).name for photo in photos],
+        times=times,
+        locations=smoothed,
+        inferred=inferred,
+        corrected=corrected,
+        path=path,
+        cost=float(score.min()),
+    )
+
+def smooth_sequences(photos, locations, trusted=None) -> List[Trajectory]:
+    """Order photos by capture time, split at gaps over SEQUENCE_MAX_GAP, and smooth each run."""
+    if trusted is None:
+        trusted = [loc.confidence >= SEQUENCE_MIN_CONFIDENCE for loc in locations]
+    items = sorted(zip(photos, locations, trusted), key=lambda item: photo_timestamp(item[0]))
+    runs = []
+    for item in items:
+        if runs and photo_timestamp(item[0]) - photo_timestamp(runs[-1][-1][0]) <= SEQUENCE_MAX_GAP:
+            runs[-1].append(item)
+        else:
+            runs.append([item])
+    return [smooth_trajectory(*map(list, zip(*run))) for run in runs]
+
+
+TRAJECTORY_JSON = "trajectory.json"
+
+def write_trajectories(trajectories, path):
+    """Smoothed sequences as JSON: per-photo positions plus the walking path through them."""
+    data = [{
+        "photos": [{"photo": name, "time": datetime.fromtimestamp(t).isoformat(), **location_fields(location),
+                    "inferred": inferred, "corrected": corrected}
+                   for name, t, location, inferred, corrected in zip(
+                       trajectory.photos, trajectory.times, trajectory.locations,
+                       trajectory.inferred, trajectory.corrected)],
+        "path": [{"floor": leg["floor"], "path": [[round(x, 3), round(y, 3)] for x, y in leg["path"]]}
+                 for leg in trajectory.path],
+        "cost": round(trajectory.cost, 3),
+    } for trajectory in trajectories]
+    Path(path).write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
+
+# =============================================================================
+# HTTP SERVICE
+# =============================================================================
+
+# Long-running mode (python mall_locator.py --serve): a small asyncio
+# HTTP/1.1 server that keeps graphs, prompts, fonts and static layers warm
+# across requests and runs blocking analysis and PIL work in a thread pool.
+#   POST /locate   photo as the raw body (image/*) or multipart field "photo";
+#                  ?image=png|svg adds the rendered result
+#   GET  /route    ?floor=GF&x=0.4&y=0.5 -> nearest toilet route
+#   GET  /health   uptime and latency stats
+SERVICE_HOST = os.getenv("SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.getenv("SERVICE_PORT", "8080"))
+SERVICE_WORKERS = int(os.getenv("SERVICE_WORKERS", "8"))
+SERVICE_MAX_UPLOAD = 20 * 1024 * 1024     # bytes
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 500: "Internal Server Error"}
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def route_summary(toilet_nav, floor) -> dict:
+    """JSON-friendly subset of a find_nearest_toilet() result for a start on floor."""
+    toilet = toilet_nav["toilet"]
+    return {
+        "toilet": dict({key: toilet.get(key) for key in ("name", "x", "y", "accessible")},
+                       floor=toilet.get("floor", floor)),
+        "distance_m": round(toilet_nav["distance_m"], 1),
+        "same_floor": toilet_nav.get("same_floor", True),
+        "instructions": toilet_nav.get("instructions", ""),
+        "path": [[round(x, 4), round(y, 4)] for x, y in toilet_nav.get("path", [])],
+        "legs": [{"floor": leg.get("floor"), "via": leg.get("via"),
+                  "path": [[round(x, 4), round(y, 4)] for x, y in leg.get("path", [])]}
+                 for leg in toilet_nav.get("legs", [])],
+    }
+
+def header_params(value) -> dict:
+    """'form-data; name="photo"; filename="a.jpg"' -> {"name": "photo", "filename": "a.jpg"}."""
+    params = {}
+    for item in value.split(";")[1:]:
+        key, _, val = item.strip().partition("=")
+        params[key.lower()] = val.strip('"')
+    return params
+
+def parse_upload(headers, body):
+    """(image bytes, filename) from a raw image body or a multipart "photo" field."""
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        # Split on the boundary directly; the email parser is far too slow for photos
+        boundary = header_params(content_type).get("boundary", "").encode("latin-1")
+        for part in body.split(b"--" + boundary)[1:-1] if boundary else []:
+            head, _, data = part.partition(b"\r\n\r\n")
+            for line in head.decode("latin-1").split("\r\n"):
+                name, _, value = line.partition(":")
+                if name.strip().lower() == "content-disposition":
+                    params = header_params(value)
+                    if params.get("name") == "photo":
+                        return data[:-2] if data.endswith(b"\r\n") else data, params.get("filename") or "upload.jpg"
+        raise HTTPError(400, 'multipart body has no "photo" field')
+    if not body:
+        raise HTTPError(400, "empty body; send the photo as image/* or multipart field \"photo\"")
+    subtype = content_type.partition("/")[2].split(";")[0].strip() or "jpg"
+    return body, headers.get("x-filename") or f"upload.{subtype}"
+
+class LocatorService:
+    """Request handlers plus the warm state and latency bookkeeping they share."""
+
+    def __init__(self, workers=SERVICE_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.started = time.time()
+        self.latencies = deque(maxlen=1000)    # (path, ms) of recent requests
+
+    def warm(self):
+        """Build everything requests would otherwise build lazily on first use."""
+        get_prompt_templates()
+        get_multi_floor_graph()
+        for floor in FLOOR_DATA:
+            get_floor_graph(floor)
+            get_toilet_field(floor)
+            get_shop_geometry(floor)
+            get_static_layer(floor, 800, 600, "floor")
+            get_static_layer(floor, 800, 600, "facilities")
+        for size in (10, 11, 12, 13, 14, 24):
+            get_font(size)
+
+    def stats(self) -> dict:
+        times = sorted(ms for _, ms in self.latencies)
+        pick = lambda q: round(times[min(len(times) - 1, int(q * len(times)))], 1) if times else None
+        return {"uptime_s": round(time.time() - self.started), "requests": len(times),
+                "recent_latency_ms": {"p50": pick(0.5), "p95": pick(0.95), "max": pick(1.0)}}
+
+    async def run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def locate(self, query, headers, body) -> dict:
+        data, filename = parse_upload(headers, body)
+        image_format = query.get("image", [""])[0]
+        # analyze_photo_with_ai works on files; the analysis cache keys on content
+        with tempfile.TemporaryDirectory() as tmp:
+            photo = Path(tmp) / Path(filename).name
+            photo.write_bytes(data)
+            analysis = await self.run_blocking(analyze_photo_with_ai, photo)
+        # Grid localization and grid routing take ~100 ms: keep them off the event loop
+        location = await self.run_blocking(estimate_position, analysis)
+        toilet_nav = await self.run_blocking(find_nearest_toilet, location.floor, location.x, location.y)
+        result = dict(location_fields(location), nearest_toilet=route_summary(toilet_nav, location.floor))
+        if image_format == "png":
+            img = await self.run_blocking(render_location_image, location, render_payload(toilet_nav))
+            buffer = io.BytesIO()
+            await self.run_blocking(img.save, buffer, "PNG")
+            result["image"] = "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+        elif image_format == "svg":
+            result["image"] = await self.run_blocking(render_location_svg, location, render_payload(toilet_nav))
+        return result
+
+    async def route(self, query) -> dict:
+        try:
+            floor = query["floor"][0]
+            x, y = float(query["x"][0]), float(query["y"][0])
+        except (KeyError, ValueError):
+            raise HTTPError(400, "expected ?floor=<floor>&x=<0-1>&y=<0-1>")
+        if floor not in FLOOR_DATA:
+            raise HTTPError(400, f"unknown floor {floor!r}")
+        toilet_nav = await self.run_blocking(find_nearest_toilet, floor, x, y)
+        return route_summary(toilet_nav, floor)
+
+    async def dispatch(self, method, path, query, headers, body):
+        if path == "/locate":
+            if method != "POST":
+                raise HTTPError(405, "use POST")
+            return await self.locate(query, headers, body)
+        if path == "/route":
+            if method not in ("GET", "POST"):
+                raise HTTPError(405, "use GET")
+            return await self.route(query)
+        if path == "/health":
+            return dict(self.stats(), status="ok")
+        raise HTTPError(404, f"no such endpoint {path}")
+
+    async def handle_connection(self, reader, writer):
+        """Serve HTTP/1.1 requests on one connection until the client closes it."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                started = time.perf_counter()
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                
+                url = urlsplit(target)
+                length = int(headers.get("content-length", "0") or 0)
+                try:
+                    if length > SERVICE_MAX_UPLOAD:
+                        raise HTTPError(413, f"uploads are limited to {SERVICE_MAX_UPLOAD} bytes")
+                    if length and headers.get("expect", "").lower() == "100-continue":
+                        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                        await writer.drain()
+                    body = await reader.readexactly(length) if length else b""
+                    status, payload = 200, await self.dispatch(method, url.path, parse_qs(url.query), headers, body)
+                except HTTPError as e:
+                    status, payload = e.status, {"error": str(e)}
+                except Exception as e:
+                    status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+                
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                self.latencies.append((url.path, elapsed_ms))
+                payload["latency_ms"] = round(elapsed_ms, 1)
+                print(f"{method} {url.path} {status} {elapsed_ms:.1f}ms")
+                
+                data = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+                keep_alive = headers.get("connection", "").lower() != "close" and status != 413
+                writer.write((f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                              f"Content-Type: application/json; charset=utf-8\r\n"
+                              f"Content-Length: {len(data)}\r\n"
+                              f"Server-Timing: total;dur={elapsed_ms:.1f}\r\n"
+                              f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode("latin-1") + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(host=SERVICE_HOST, port=SERVICE_PORT):
+    service = LocatorService()
+    started = time.perf_counter()
+    await asyncio.get_running_loop().run_in_executor(service.executor, service.warm)
+    print(f"Warm state ready in {(time.perf_counter() - started) * 1000:.0f}ms")
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    print(f"Serving on http://{host}:{port} (/locate, /route, /health)")
+    async with server:
+        await server.serve_forever()
+
+
+# =============================================================================
+# MAIN PROCESSING
+# =============================================================================
+
+def process_photo(photo_path, analysis=None, render=True):
+    """
+    Process a single photo and generate output. Pass analysis to skip the AI
+    call, render=False to leave the image to render_jobs() (img is None).
+    """
+    print(f"\n{'='*60}")
+    print(f"Processing: {photo_path.name}")
+    print(f"{'='*60}")
+    print(f"Reference: {TIMES_SQUARE_FLOOR_PLAN_URL}")
     
     # Analyze photo
-    if OPENAI_API_KEY:
+    if analysis is not None:
+        pass
+    elif OPENAI_API_KEY:
         print("Using GPT-4 Vision with floor plan reference...")
         analysis = analyze_photo_with_ai(photo_path)
     else:
@@ -1419,15 +5063,44 @@ def process_photo(photo_path):
     print(f"🚻 Nearest: {toilet_nav['toilet'].get('name')} ({toilet_nav['distance_m']:.0f}m)")
     
     # Create visualization
-    img = create_floor_plan_image(location.floor, location=location, toilet_nav=toilet_nav)
-    img = draw_position_marker(img, location)
-    img = draw_info_boxes(img, location, toilet_nav)
+    img = render_location_image(location, toilet_nav) if render else None
     
     return location, toilet_nav, img
 
 
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Estimate photo locations in Times Square HK.")
+    parser.add_argument("--resume", action="store_true",
+                        help=f"skip photos already in {OUTPUT_DIR}/{RESULTS_JSONL}")
+    parser.add_argument("--json", action="store_true",
+                        help=f"also write a compact {RESULTS_JSON} built from the JSONL stream")
+    parser.add_argument("--batch", action="store_true",
+                        help="submit vision analyses as one offline batch job and poll for it")
+    parser.add_argument("--mall", default=os.getenv("MALL_ID"),
+                        help=f"use the data package {MALLS_DIR}/<mall>/ instead of the built-in tables")
+    parser.add_argument("--export-mall", metavar="DIR",
+                        help="write the built-in tables as a mall data package and exit")
+    parser.add_argument("--sequence", action="store_true",
+                        help="treat the photos as one visitor's timed sequence and smooth their positions")
+    parser.add_argument("--serve", action="store_true",
+                        help="run the HTTP service (/locate, /route) instead of the batch")
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    return parser.parse_args(argv)
+
+def main(argv=None):
     """Main entry point."""
+    args = parse_args(argv)
+    if args.export_mall:
+        compile_mall_package(export_mall_package(args.export_mall))
+        print(f"✓ Mall data package written to {args.export_mall}")
+        return
+    if args.mall:
+        mall = activate_mall(args.mall)
+        print(f"Mall: {mall.manifest['mall']['name']} (data version {mall.manifest['version']})")
+    if args.serve:
+        asyncio.run(serve(args.host, args.port))
+        return
     print(f"""
 ╔══════════════════════════════════════════════════════════════╗
 ║   Times Square HK - AI Photo Location Estimator              ║
@@ -1437,57 +5110,147 @@ def main():
     """)
     
     OUTPUT_DIR.mkdir(exist_ok=True)
-    FLOOR_PLANS_DIR.mkdir(exist_ok=True)
+    plans_dir = Path(generated_plans_dir())
+    plans_dir.mkdir(parents=True, exist_ok=True)
     
     # Generate floor plan images
     for floor in FLOOR_DATA:
         img = create_floor_plan_image(floor)
-        img.save(FLOOR_PLANS_DIR / f"{floor}.png")
+        img.save(plans_dir / f"{floor}.png")
+    RESOURCES.invalidate_floor_plans()
+    if EXPORT_TILES:
+        export_tile_pyramids()
     
     # Find photos
     photos = sorted([p for p in PHOTOS_DIR.iterdir() 
                     if p.suffix.lower() in {".png", ".jpg", ".jpeg"}])
     print(f"Found {len(photos)} photos to process")
     
-    results = []
-    for photo in photos:
-        try:
-            location, toilet_nav, img = process_photo(photo)
-            output_path = OUTPUT_DIR / f"location_{photo.stem}.png"
-            img.save(output_path)
-            print(f"✓ Saved: {output_path.name}")
+    all_photos = photos
+    writer = ResultsWriter(OUTPUT_DIR / RESULTS_JSONL, resume=args.resume)
+    if args.resume:
+        # A photo counts as done once its record and its images are both on disk
+        photos = [p for p in photos
+                  if not (p.name in writer.done and all(path.exists() for path in photo_outputs(p)))]
+        print(f"Resuming: {len(writer.done)} already recorded, {len(photos)} to process")
+    
+    pipeline = StagedPipeline(batch=args.batch)
+    if OPENAI_API_KEY and args.batch:
+        print(f"Analyzing with GPT-4 Vision as batch jobs (polling every {BATCH_POLL_INTERVAL:g}s)...")
+    elif OPENAI_API_KEY:
+        print(f"Analyzing with GPT-4 Vision ({ANALYSIS_CONCURRENCY} concurrent requests)...")
+    else:
+        print("Using fallback analysis (set OPENAI_API_KEY for AI)")
+    
+    smoothed = {}           # photo -> (location, inferred, corrected) in sequence mode
+    if args.sequence and photos:
+        # Sequences span every photo, including ones a --resume skips below;
+        # their analyses and positions come back from the stage store
+        locations, trusted = [], []
+        for chunk in chunked(all_photos, PIPELINE_CHUNK):
+            for photo, analysis in zip(chunk, pipeline.analyses(chunk)):
+                try:
+                    location = pipeline.position(photo, analysis)
+                    # Failed or vague frames are placed from their neighbours, not re-analyzed
+                    ok = location.confidence >= SEQUENCE_MIN_CONFIDENCE and "analysis_error" not in analysis
+                except Exception as e:
+                    print(f"✗ Error locating {photo.name}: {e}")
+                    location = LocationEstimate(floor=analysis.get("floor_estimate", "GF"), x=0.5, y=0.5,
+                                                direction=0, confidence=0.0, detected_shops=[], store_codes=[],
+                                                reasoning="")
+                    ok = False
+                locations.append(location)
+                trusted.append(ok)
+            pipeline.posteriors.clear()     # only the main pass draws heatmaps
+        trajectories = smooth_sequences(all_photos, locations, trusted)
+        by_name = {photo.name: photo for photo in all_photos}
+        for trajectory in trajectories:
+            for name, *entry in zip(trajectory.photos, trajectory.locations, trajectory.inferred, trajectory.corrected):
+                smoothed[by_name[name]] = tuple(entry)
+        write_trajectories(trajectories, OUTPUT_DIR / TRAJECTORY_JSON)
+        print(f"✓ Smoothed {len(all_photos)} photos as {len(trajectories)} sequence(s) → {TRAJECTORY_JSON}")
+    
+    # Analyze, record and render PIPELINE_CHUNK photos at a time, so results
+    # stream out as the run goes and memory stays flat however many photos
+    # there are. Stored analyses are reused unless the photo, prompt or model changed.
+    pool = render_pool()
+    try:
+        for chunk in chunked(photos, PIPELINE_CHUNK):
+            analyses = pipeline.analyses(chunk)
+            jobs = []
+            pending_renders = {}    # photo -> [render fingerprint, outputs, outputs still to write]
+            job_photos = {}         # output path -> photo
+            for photo, analysis in zip(chunk, analyses):
+                try:
+                    if photo in smoothed:
+                        location = smoothed[photo][0]
+                    else:
+                        location = pipeline.position(photo, analysis)
+                    route = pipeline.route(photo, location)
+                    print(f"{photo.name}: {location.floor} ({location.x:.2f}, {location.y:.2f}) "
+                          f"→ 🚻 {route['toilet'].get('name')} ({route['distance_m']:.0f}m)")
+                    
+                    outputs = photo_outputs(photo)
+                    fingerprint = pipeline.render_fingerprint(location, route)
+                    if not pipeline.render_current(photo, fingerprint, outputs):
+                        pending_renders[photo] = [fingerprint, outputs, set(outputs)]
+                        for output_path in outputs:
+                            job_photos[output_path] = photo
+                            if output_path == heatmap_path(photo):
+                                localizer = get_grid_localizer()
+                                grid = pipeline.posterior(photo, analysis).grid[localizer.floors.index(location.floor)]
+                                jobs.append(("heatmap", output_path,
+                                             (location.floor, grid, localizer.xs, localizer.ys)))
+                            elif output_path.suffix == ".png":
+                                jobs.append(("photo", output_path, (location, route)))
+                            else:
+                                layer = write_static_svg(location.floor, 800, 600, OUTPUT_DIR / "layers")
+                                jobs.append(("photo_svg", output_path,
+                                             (location, route, 800, 600, f"layers/{layer}")))
+                    
+                    record = {
+                        "photo": photo.name,
+                        **location_fields(location),
+                        "nearest_toilet": {
+                            "name": route["toilet"].get("name"),
+                            "distance_m": round(route["distance_m"], 1)
+                        }
+                    }
+                    if photo in smoothed:
+                        record["inferred"], record["corrected"] = smoothed[photo][1:]
+                    writer.write(record)
+                except Exception as e:
+                    print(f"✗ Error processing {photo.name}: {e}")
+                    import traceback
+                    traceback.print_exc()
             
-            results.append({
-                "photo": photo.name,
-                "floor": location.floor,
-                "position": {"x": round(location.x, 3), "y": round(location.y, 3)},
-                "direction": location.direction,
-                "confidence": location.confidence,
-                "detected_shops": location.detected_shops,
-                "store_codes": location.store_codes,
-                "nearest_toilet": {
-                    "name": toilet_nav["toilet"].get("name"),
-                    "distance_m": round(toilet_nav["distance_m"], 1)
-                }
-            })
-        except Exception as e:
-            print(f"✗ Error processing {photo.name}: {e}")
-            import traceback
-            traceback.print_exc()
-    
-    # Save results JSON
-    with open(OUTPUT_DIR / "location_results.json", "w") as f:
-        json.dump(results, f, indent=2)
-    
-    # Create combined floor views
-    floors_with_photos = {}
-    for r in results:
-        floors_with_photos.setdefault(r["floor"], []).append(r)
-    
-    for floor, floor_results in floors_with_photos.items():
-        img = create_floor_plan_image(floor, 1000, 800)
-        for r in floor_results:
-            loc = LocationEstimate(
+            pipeline.posteriors.clear()
+            for (_, output_path, _), error in render_jobs(jobs, pool=pool):
+                if error is not None:
+                    print(f"✗ Error rendering {output_path.name}: {error}")
+                    continue
+                print(f"✓ Saved: {output_path.name}")
+                photo = job_photos.get(output_path)
+                if photo is not None:
+                    fingerprint, outputs, remaining = pending_renders[photo]
+                    remaining.discard(output_path)
+                    if not remaining:
+                        pipeline.render_done(photo, fingerprint, outputs)
+        
+        writer.close()
+        print(f"✓ Results streamed to {RESULTS_JSONL}")
+        if args.json:
+            write_results_json(OUTPUT_DIR / RESULTS_JSONL, OUTPUT_DIR / RESULTS_JSON)
+            print(f"✓ Saved: {RESULTS_JSON}")
+        
+        # Create combined floor views from the whole stream, including resumed records
+        floors_with_photos = {}
+        for r in latest_results(OUTPUT_DIR / RESULTS_JSONL):
+            floors_with_photos.setdefault(r["floor"], []).append(r)
+        
+        jobs = []
+        for floor, floor_results in floors_with_photos.items():
+            locations = [LocationEstimate(
                 floor=r["floor"],
                 x=r["position"]["x"],
                 y=r["position"]["y"],
@@ -1496,10 +5259,26 @@ def main():
                 detected_shops=r["detected_shops"],
                 store_codes=r.get("store_codes", []),
                 reasoning=""
-            )
-            img = draw_position_marker(img, loc, 50)
-        img.save(OUTPUT_DIR / f"combined_{floor}.png")
-        print(f"✓ Saved: combined_{floor}.png")
+            ) for r in floor_results]
+            if OUTPUT_FORMAT in ("png", "both"):
+                jobs.append(("combined", OUTPUT_DIR / f"combined_{floor}.png", (floor, locations)))
+            if OUTPUT_FORMAT in ("svg", "both"):
+                layer = write_static_svg(floor, 1000, 800, OUTPUT_DIR / "layers")
+                jobs.append(("combined_svg", OUTPUT_DIR / f"combined_{floor}.svg",
+                             (floor, locations, 1000, 800, f"layers/{layer}")))
+        for (_, output_path, _), error in render_jobs(jobs, pool=pool):
+            if error is not None:
+                print(f"✗ Error rendering {output_path.name}: {error}")
+            else:
+                print(f"✓ Saved: {output_path.name}")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    print(f"Stages: {pipeline.summary()}")
+    
+    if _ANALYSIS_CACHE is not None:
+        stats = _ANALYSIS_CACHE.stats()
+        print(f"Analysis cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries")
     
     print(f"\n{'='*60}")
     print(f"✓ Complete! Results saved to '{OUTPUT_DIR}/'")
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the batch endpoints mall_locator's --batch mode uses:
+POST /files, POST /batches, GET /batches/{id} and GET /files/{id}/content.
+
+Each request in an uploaded file gets a canned vision reply. A job reports
+in_progress for the first `polls` status checks, then completed.
+
+    python tests/batch_stub.py 8790
+    OPENAI_API_KEY=stub OPENAI_BATCH_BASE=http://127.0.0.1:8790/v1 \\
+        BATCH_POLL_INTERVAL=0.1 python mall_locator.py --batch
+"""
+
+import sys
+import json
+import email
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_REPLY = {
+    "detected_shops": ["Shake Shack"], "store_codes": ["b243"],
+    "floor_estimate": "B2", "floor_confidence": 0.9,
+    "estimated_x": 0.46, "estimated_y": 0.55, "estimated_direction_degrees": 0,
+    "position_reasoning": "batch stub",
+}
+
+
+class BatchStub:
+    """
+    In-process stub server. `replies` maps custom_id -> analysis dict, or
+    None for a request that fails with status 500; other ids get
+    DEFAULT_REPLY. `requests` keeps every uploaded request line.
+    """
+
+    def __init__(self, replies=None, polls=1, port=0):
+        self.replies = dict(replies or {})
+        self.polls = polls
+        self.files, self.batches, self.requests = {}, {}, []
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def completion(self, line) -> dict:
+        """Batch output record for one request line."""
+        custom_id = line["custom_id"]
+        reply = self.replies.get(custom_id, DEFAULT_REPLY)
+        if reply is None:
+            return {"custom_id": custom_id, "response": {"status_code": 500, "body": {}}, "error": None}
+        content = "```json\n" + json.dumps(reply) + "\n```"
+        return {"custom_id": custom_id, "error": None,
+                "response": {"status_code": 200,
+                             "body": {"choices": [{"message": {"role": "assistant", "content": content}}]}}}
+
+    def create_batch(self, request) -> dict:
+        lines = [json.loads(line) for line in self.files[request["input_file_id"]].decode().splitlines()
+                 if line.strip()]
+        self.requests.extend(lines)
+        output_id = self.add_file("\n".join(json.dumps(self.completion(line)) for line in lines).encode())
+        batch_id = f"batch_{len(self.batches)}"
+        self.batches[batch_id] = {"id": batch_id, "status": "validating", "output_file_id": None,
+                                  "request_counts": {"total": len(lines), "completed": 0},
+                                  "_output": output_id, "_polls": 0}
+        return self.public(batch_id)
+
+    def poll(self, batch_id) -> dict:
+        batch = self.batches[batch_id]
+        batch["_polls"] += 1
+        if batch["_polls"] > self.polls:
+            batch.update(status="completed", output_file_id=batch["_output"])
+            batch["request_counts"]["completed"] = batch["request_counts"]["total"]
+        else:
+            batch["status"] = "in_progress"
+        return self.public(batch_id)
+
+    def public(self, batch_id) -> dict:
+        return {k: v for k, v in self.batches[batch_id].items() if not k.startswith("_")}
+
+    def add_file(self, data: bytes) -> str:
+        file_id = f"file_{len(self.files)}"
+        self.files[file_id] = data
+        return file_id
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body: bytes, content_type="application/json"):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path.endswith("/files"):
+                    message = email.message_from_bytes(
+                        f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+                    for part in message.get_payload():
+                        if part.get_param("name", header="content-disposition") == "file":
+                            file_id = stub.add_file(part.get_payload(decode=True))
+                            return self.reply(200, json.dumps({"id": file_id, "purpose": "batch"}).encode())
+                    return self.reply(400, b'{"error": "no file part"}')
+                if self.path.endswith("/batches"):
+                    return self.reply(200, json.dumps(stub.create_batch(json.loads(body))).encode())
+                self.reply(404, b'{"error": "not found"}')
+
+            def do_GET(self):
+                parts = self.path.rstrip("/").split("/")
+                if parts[-2] == "batches" and parts[-1] in stub.batches:
+                    return self.reply(200, json.dumps(stub.poll(parts[-1])).encode())
+                if parts[-1] == "content" and parts[-2] in stub.files:
+                    return self.reply(200, stub.files[parts[-2]], "application/jsonl")
+                self.reply(404, b'{"error": "not found"}')
+
+        return Handler
+
+
+if __name__ == "__main__":
+    with BatchStub(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8790) as stub:
+        print(f"Batch stub on {stub.base}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,43 @@
+"""Shared fixtures: a throwaway working directory for end-to-end main() runs."""
+
+import sys
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mall_locator as ml
+
+
+class Sandbox:
+    """tmp_path as main()'s working directory, with a few solid test photos."""
+
+    def __init__(self, root):
+        self.root = root
+        self.photos_dir = root / ml.PHOTOS_DIR
+        self.output = root / ml.OUTPUT_DIR
+        self.photos_dir.mkdir()
+
+    def add_photo(self, name, color=(90, 90, 90)):
+        path = self.photos_dir / name
+        Image.new("RGB", (64, 48), color).save(path)
+        return path
+
+    def run(self, *argv):
+        ml.main(list(argv))
+
+    def records(self):
+        return list(ml.read_results(self.output / ml.RESULTS_JSONL))
+
+
+@pytest.fixture
+def sandbox(tmp_path, monkeypatch):
+    """Fallback analysis (no API key), in-process rendering, everything under tmp_path."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ml, "OPENAI_API_KEY", "")
+    monkeypatch.setattr(ml, "RENDER_WORKERS", 1)
+    box = Sandbox(tmp_path)
+    yield box
+    ml.RESOURCES.invalidate_floor_plans()
@@ -0,0 +1,96 @@
+"""Concurrent interactive analysis (analyze_photos) against the local vision stub."""
+
+import sys
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import mall_locator as ml
+from vision_stub import VisionStub
+
+
+def make_photos(directory, markers):
+    """Solid photos the stub recognises by marker."""
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for marker in markers:
+        path = directory / f"photo_{marker}.jpg"
+        Image.new("RGB", (64, 48), (20 * marker, 0, 0)).save(path, quality=95)
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def vision_env(monkeypatch):
+    """Interactive analysis pointed at a stub, uncached, with sleeps recorded instead of taken."""
+    sleeps = []
+
+    def connect(stub):
+        monkeypatch.setattr(ml, "OPENAI_API_URL", stub.url)
+        return stub
+
+    monkeypatch.setattr(ml, "OPENAI_API_KEY", "stub-key")
+    monkeypatch.setattr(ml, "ANALYSIS_CACHE_ENABLED", False)
+    monkeypatch.setattr(ml, "ANALYSIS_TWO_STAGE", False)
+    monkeypatch.setattr(ml, "ANALYSIS_BACKOFF", 0.5)
+    monkeypatch.setattr(ml, "_HTTP_SESSION", None)
+    monkeypatch.setattr(ml.random, "uniform", lambda a, b: 0.0)
+    monkeypatch.setattr(ml.time, "sleep", sleeps.append)
+    connect.sleeps = sleeps
+    return connect
+
+
+def test_results_in_input_order(tmp_path, vision_env):
+    markers = [7, 2, 9, 4, 1, 8, 3, 6, 5]
+    with vision_env(VisionStub(delay=0.02)):
+        results = ml.analyze_photos(make_photos(tmp_path, markers), concurrency=4)
+    assert [round(r["estimated_x"] * 100) for r in results] == markers
+    assert all("analysis_error" not in r for r in results)
+
+
+def test_retryable_statuses_back_off(tmp_path, vision_env):
+    failures = {1: [429, 503], 2: [(429, {"Retry-After": "3"})]}
+
+    def plan(marker, attempt):
+        planned = failures.get(marker, [])
+        return planned[attempt] if attempt < len(planned) else None
+
+    stub = VisionStub(plan=plan)
+    with vision_env(stub):
+        first, second = ml.analyze_photos(make_photos(tmp_path, [1, 2]), concurrency=1)
+    assert stub.attempts == {1: [429, 503, 200], 2: [429, 200]}
+    assert "analysis_error" not in first and "analysis_error" not in second
+    # Exponential backoff for marker 1, then the server's Retry-After for marker 2
+    assert vision_env.sleeps == [0.5, 1.0, 3.0]
+
+
+def test_non_retryable_status_falls_back(tmp_path, vision_env):
+    stub = VisionStub(plan=lambda marker, attempt: 400 if marker == 3 else None)
+    with vision_env(stub):
+        failed, ok = ml.analyze_photos(make_photos(tmp_path, [3, 4]), concurrency=2)
+    assert stub.attempts == {3: [400], 4: [200]}
+    assert "400" in failed["analysis_error"]
+    assert vision_env.sleeps == []
+    assert ok["estimated_x"] == pytest.approx(0.04)
+
+
+def test_retries_give_up_after_analysis_retries(tmp_path, vision_env, monkeypatch):
+    monkeypatch.setattr(ml, "ANALYSIS_RETRIES", 2)
+    stub = VisionStub(plan=lambda marker, attempt: 502)
+    with vision_env(stub):
+        (result,) = ml.analyze_photos(make_photos(tmp_path, [5]))
+    assert stub.attempts == {5: [502, 502, 502]}
+    assert "502" in result["analysis_error"]
+
+
+def test_in_flight_bounded_by_concurrency(tmp_path, vision_env, monkeypatch):
+    monkeypatch.setattr(ml, "ANALYSIS_CONCURRENCY", 3)
+    stub = VisionStub(delay=0.15)
+    with vision_env(stub):
+        results = ml.analyze_photos(make_photos(tmp_path, range(1, 10)))
+    assert len(results) == 9
+    assert 2 <= stub.max_in_flight <= 3
@@ -0,0 +1,80 @@
+"""analyze_photos_batch() end to end against the local batch stub."""
+
+import sys
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import mall_locator as ml
+from batch_stub import BatchStub, DEFAULT_REPLY
+
+
+@pytest.fixture
+def photos(tmp_path):
+    paths = []
+    for name, color in (("ahead.jpg", "red"), ("failing.jpg", "green")):
+        path = tmp_path / "photos" / name
+        path.parent.mkdir(exist_ok=True)
+        Image.new("RGB", (64, 48), color).save(path)
+        paths.append(path)
+    broken = tmp_path / "photos" / "broken.jpg"
+    broken.write_bytes(b"not a jpeg")
+    return paths + [broken]
+
+
+@pytest.fixture
+def batch_env(tmp_path, monkeypatch):
+    """Batch mode pointed at a stub, with its own cache directory."""
+    def connect(stub):
+        monkeypatch.setattr(ml, "OPENAI_BATCH_BASE", stub.base)
+        return stub
+
+    monkeypatch.setattr(ml, "OPENAI_API_KEY", "stub-key")
+    monkeypatch.setattr(ml, "BATCH_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(ml, "BATCH_DIR", tmp_path / "batches")
+    monkeypatch.setattr(ml, "ANALYSIS_CACHE_ENABLED", True)
+    monkeypatch.setattr(ml, "_ANALYSIS_CACHE", ml.AnalysisCache(tmp_path / "analysis.sqlite3"))
+    return connect
+
+
+def test_batch_end_to_end(photos, batch_env):
+    with batch_env(BatchStub(replies={"failing.jpg": None}, polls=2)) as stub:
+        results = ml.analyze_photos_batch(photos)
+
+        # The undecodable photo never reaches the request file
+        assert sorted(r["custom_id"] for r in stub.requests) == ["ahead.jpg", "failing.jpg"]
+        assert len(stub.batches) == 1
+        body = stub.requests[0]["body"]
+        assert body["messages"][0]["content"][1]["image_url"]["url"].startswith("data:image/")
+
+        ahead, failing, broken = results
+        assert ahead["floor_estimate"] == DEFAULT_REPLY["floor_estimate"]
+        assert ahead["location_reasoning"] == "batch stub"
+        assert "analysis_error" not in ahead
+        assert "status 500" in failing["analysis_error"]
+        assert "cannot prepare photo" in broken["analysis_error"]
+        assert not list(ml.BATCH_DIR.iterdir())
+
+        # Successful results land in the analysis cache; only failures are resubmitted
+        again = ml.analyze_photos_batch(photos)
+        assert again[0] == ahead
+        assert len(stub.batches) == 2
+        assert [r["custom_id"] for r in stub.requests[2:]] == ["failing.jpg"]
+
+
+def test_batch_resumes_submitted_job(photos, batch_env, monkeypatch):
+    with batch_env(BatchStub(polls=3)) as stub:
+        monkeypatch.setattr(ml, "BATCH_MAX_WAIT", 0.0)
+        with pytest.raises(TimeoutError):
+            ml.analyze_photos_batch(photos[:2])
+        assert len(stub.batches) == 1
+
+        # A re-run polls the job it already paid for instead of submitting another
+        monkeypatch.setattr(ml, "BATCH_MAX_WAIT", 60.0)
+        results = ml.analyze_photos_batch(photos[:2])
+        assert len(stub.batches) == 1
+        assert [r["floor_estimate"] for r in results] == ["B2", "B2"]
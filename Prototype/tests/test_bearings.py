@@ -0,0 +1,76 @@
+"""Bearing solver: recovering a known position from synthetic landmark bearings."""
+
+import sys
+import math
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mall_locator as ml
+
+FLOOR = "B2"
+RANGE = ml.LANDMARK_RANGE[0]
+
+
+def walkable_point(near=(0.5, 0.5)):
+    """The walkable lattice point closest to near."""
+    xs, ys, mask = ml.walkable_lattice(FLOOR)
+    rows, cols = np.nonzero(mask)
+    i = int(np.hypot(xs[cols] - near[0], ys[rows] - near[1]).argmin())
+    return float(xs[cols[i]]), float(ys[rows[i]])
+
+
+def landmarks_around(monkeypatch, x, y, heading):
+    """Place one landmark per field exactly at its bearing from (x, y) facing heading."""
+    placed = {}
+    for field, relative in (("directly_ahead", 0.0), ("left_side", -90.0), ("right_side", 90.0)):
+        compass = math.radians(heading + relative)      # 0 = up (-y), 90 = +x
+        placed[field] = np.array([[x + RANGE * math.sin(compass), y - RANGE * math.cos(compass)]])
+    monkeypatch.setattr(ml, "landmark_points",
+                        lambda text, floor: [placed[text]] if text in placed else [])
+    return {field: field for field in placed}
+
+
+@pytest.mark.parametrize("heading", [0.0, 90.0, 225.0])
+def test_recovers_known_point(monkeypatch, heading):
+    x, y = walkable_point()
+    analysis = dict(landmarks_around(monkeypatch, x, y, heading), floor_estimate=FLOOR,
+                    estimated_direction_degrees=heading)
+    solution = ml.solve_bearings(analysis, FLOOR)
+    assert math.hypot(solution.x - x, solution.y - y) <= ml.SOLVER_STEP + 1e-9
+    assert solution.landmarks == 3
+    assert math.hypot(solution.x - x, solution.y - y) <= solution.radius
+
+
+def test_recovers_heading_when_direction_missing(monkeypatch):
+    x, y = walkable_point((0.4, 0.55))
+    analysis = dict(landmarks_around(monkeypatch, x, y, 60.0), floor_estimate=FLOOR)
+    solution = ml.solve_bearings(analysis, FLOOR)
+    assert math.hypot(solution.x - x, solution.y - y) <= ml.SOLVER_STEP + 1e-9
+    assert abs((solution.heading - 60.0 + 180.0) % 360.0 - 180.0) <= ml.HEADING_STEP
+    # estimate_position reports the solved heading rather than 0
+    location = ml.estimate_position(analysis)
+    assert location.direction == solution.heading
+
+
+def test_more_landmarks_tighten_the_radius(monkeypatch):
+    x, y = walkable_point()
+    fields = landmarks_around(monkeypatch, x, y, 0.0)
+    one = ml.solve_bearings({"directly_ahead": fields["directly_ahead"], "estimated_direction_degrees": 0}, FLOOR)
+    three = ml.solve_bearings(dict(fields, estimated_direction_degrees=0), FLOOR)
+    assert three.radius < one.radius
+    assert three.confidence > one.confidence
+
+
+def test_no_landmarks_no_solution():
+    assert ml.solve_bearings({"floor_estimate": FLOOR}, FLOOR) is None
+
+
+def test_landmark_in_two_fields_counts_twice():
+    analysis = {"directly_ahead": "Shake Shack", "left_side": "Shake Shack", "detected_shops": ["Shake Shack"]}
+    observations = ml.bearing_observations(analysis, FLOOR)
+    # Once ahead, once to the left; the side-less detection adds nothing new
+    assert [relative for relative, _, _ in observations] == [0.0, -90.0]
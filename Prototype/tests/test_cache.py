@@ -0,0 +1,103 @@
+"""AnalysisCache: what reuses a stored vision result and what invalidates it."""
+
+import sys
+import copy
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import mall_locator as ml
+from vision_stub import VisionStub
+
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    """Vision stub behind a fresh on-disk analysis cache."""
+    monkeypatch.setattr(ml, "OPENAI_API_KEY", "stub-key")
+    monkeypatch.setattr(ml, "ANALYSIS_CACHE_ENABLED", True)
+    monkeypatch.setattr(ml, "ANALYSIS_TWO_STAGE", False)
+    monkeypatch.setattr(ml, "_ANALYSIS_CACHE", ml.AnalysisCache(tmp_path / "analysis.sqlite3"))
+    monkeypatch.setattr(ml, "_HTTP_SESSION", None)
+    with VisionStub() as server:
+        monkeypatch.setattr(ml, "OPENAI_API_URL", server.url)
+        yield server
+
+
+def photo(tmp_path, name="photo.jpg", marker=3):
+    path = tmp_path / name
+    Image.new("RGB", (64, 48), (20 * marker, 0, 0)).save(path, quality=95)
+    return path
+
+
+def requests_made(stub):
+    return sum(len(statuses) for statuses in stub.attempts.values())
+
+
+def test_same_photo_is_served_from_cache(tmp_path, stub):
+    first = ml.analyze_photo_with_ai(photo(tmp_path))
+    again = ml.analyze_photo_with_ai(photo(tmp_path))
+    assert again == first and requests_made(stub) == 1
+    # Content addressed: a renamed copy is the same photo
+    assert ml.analyze_photo_with_ai(photo(tmp_path, "copy.jpg")) == first
+    assert requests_made(stub) == 1
+    # use_cache=False always asks
+    ml.analyze_photo_with_ai(photo(tmp_path), use_cache=False)
+    assert requests_made(stub) == 2
+
+
+def test_prompt_change_invalidates(tmp_path, stub, monkeypatch):
+    ml.analyze_photo_with_ai(photo(tmp_path))
+    edited = copy.copy(ml.get_prompt_templates())
+    edited.full += "\n- Newly opened: Test Shop = b999"
+    monkeypatch.setattr(ml, "_PROMPT_TEMPLATES", edited)
+    ml.analyze_photo_with_ai(photo(tmp_path))
+    assert requests_made(stub) == 2
+
+
+@pytest.mark.parametrize("setting, value", [
+    ("VISION_MODEL", "gpt-4o-2024-11-20"),
+    ("UPLOAD_QUALITY", 60),
+    ("UPLOAD_MAX_EDGE", 512),
+    ("UPLOAD_DETAIL", "low"),
+])
+def test_model_and_upload_settings_invalidate(tmp_path, stub, monkeypatch, setting, value):
+    ml.analyze_photo_with_ai(photo(tmp_path))
+    monkeypatch.setattr(ml, setting, value)
+    ml.analyze_photo_with_ai(photo(tmp_path))
+    assert requests_made(stub) == 2
+
+
+def test_changed_photo_invalidates(tmp_path, stub):
+    ml.analyze_photo_with_ai(photo(tmp_path, marker=3))
+    result = ml.analyze_photo_with_ai(photo(tmp_path, marker=4))
+    assert requests_made(stub) == 2 and result["estimated_x"] == pytest.approx(0.04)
+
+
+def test_failed_analysis_is_not_cached(tmp_path, stub):
+    stub.plan = lambda marker, attempt: 400 if attempt == 0 else None
+    failed = ml.analyze_photo_with_ai(photo(tmp_path))
+    assert "analysis_error" in failed
+    ok = ml.analyze_photo_with_ai(photo(tmp_path))
+    assert "analysis_error" not in ok and requests_made(stub) == 2
+
+
+def test_entries_expire_and_least_recently_used_are_evicted(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ml.time, "time", lambda: now[0])
+    cache = ml.AnalysisCache(tmp_path / "lru.sqlite3", max_entries=2, ttl=100)
+    cache.put("a", {"v": 1})
+    now[0] += 1
+    cache.put("b", {"v": 2})
+    now[0] += 1
+    assert cache.get("a") == {"v": 1}           # a is now more recent than b
+    now[0] += 1
+    cache.put("c", {"v": 3})
+    assert cache.get("b") is None and cache.get("a") == {"v": 1} and len(cache) == 2
+    now[0] += 150
+    assert cache.get("c") is None
+    # Persistent across instances until it expires
+    assert ml.AnalysisCache(tmp_path / "lru.sqlite3", ttl=0).get("a") == {"v": 1}
@@ -0,0 +1,56 @@
+"""ShopGeometry obstruction tests and entry-waypoint selection."""
+
+import sys
+import math
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mall_locator as ml
+
+
+def test_endpoint_shops_do_not_block():
+    geometry = ml.ShopGeometry({"a": {"x": 0.5, "y": 0.5}, "b": {"x": 0.5, "y": 0.8}})
+    starts = [(0.2, 0.5), (0.5, 0.5), (0.5, 0.62)]
+    ends = [(0.5, 0.5), (0.2, 0.5), (0.5, 0.95)]
+    # Entering a, leaving a, and crossing b on the way out of nowhere
+    assert geometry.blocked(starts, ends).tolist() == [False, False, True]
+    assert geometry.blocked(starts, ends, ignore_endpoint_shops=False).all()
+
+
+def test_segment_hits_matches_sampling():
+    geometry = ml.ShopGeometry({"a": {"x": 0.4, "y": 0.4}, "b": {"x": 0.7, "y": 0.6}})
+    rng = np.random.default_rng(5)
+    starts, ends = rng.random((300, 2)), rng.random((300, 2))
+    t = np.linspace(0.0, 1.0, 2001)[:, None, None]
+    samples = starts[None] + t * (ends - starts)[None]                  # (T, M, 2)
+    sampled = geometry.contains(samples.reshape(-1, 2)).reshape(len(t), len(starts), -1).any(axis=0)
+    exact = geometry.segment_hits(starts, ends)
+    # Sampling can only miss a grazing hit, never invent one
+    assert not (sampled & ~exact).any()
+    assert (exact & ~sampled).sum() <= 2
+
+
+def test_waypoint_inside_shop_can_be_entry():
+    floor = "B2"
+    graph = ml.get_floor_graph(floor)
+    stores = ml.FLOOR_DATA[floor]["stores"]
+    geometry = ml.get_shop_geometry(floor, stores)
+    checked = 0
+    for node, (wx, wy) in enumerate(graph.coords):
+        own = geometry.contains([(wx, wy)])[0]
+        if not own.any():
+            continue
+        for angle in range(0, 360, 15):
+            for r in (0.05, 0.07, 0.09):
+                x, y = wx + r * math.cos(math.radians(angle)), wy + r * math.sin(math.radians(angle))
+                if geometry.contains([(x, y)]).any() or graph.spatial.nearest(x, y, 1) != [node]:
+                    continue
+                if (geometry.segment_hits([(x, y)], [(wx, wy)])[0] & ~own).any():
+                    continue
+                # Only the waypoint's own shop is touched: it is a valid entry
+                assert ml.find_best_entry_waypoint(floor, x, y, stores) == graph.names[node]
+                checked += 1
+    assert checked > 0
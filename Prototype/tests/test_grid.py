@@ -0,0 +1,85 @@
+"""GridLocalizer: MAP cell, modes, entropy and the confidence locate_on_grid() reports."""
+
+import sys
+import math
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mall_locator as ml
+
+TOILETS_AHEAD = {"floor_estimate": "B2", "floor_confidence": 0.99,
+                 "directly_ahead": "Toilets", "estimated_direction_degrees": 0}
+
+
+@pytest.fixture(scope="module")
+def localizer():
+    return ml.GridLocalizer(["B2"])
+
+
+def cell_xy(localizer, row, col):
+    return float(localizer.xs[col]), float(localizer.ys[row])
+
+
+def test_flat_posterior_map_is_centred(localizer):
+    estimate = localizer.estimate(localizer.log_prior)
+    walkable = localizer.points[localizer.walkable[0].ravel()]
+    mean_x, mean_y = walkable.mean(axis=0)
+    # Every walkable cell ties; the one nearest the floor's mean wins, not a corner
+    closest = np.hypot(walkable[:, 0] - mean_x, walkable[:, 1] - mean_y).min()
+    assert math.hypot(estimate.x - mean_x, estimate.y - mean_y) == pytest.approx(closest)
+    masses = [mode["mass"] for mode in estimate.modes]
+    assert masses == sorted(masses, reverse=True)
+
+
+def test_map_cell_and_top_mode_differ(localizer):
+    # One corridor is a single sharp cell; the other a broad plateau just below it
+    rows, cols = np.nonzero(localizer.walkable[0])
+    xy = np.column_stack([localizer.xs[cols], localizer.ys[rows]])
+    near = np.hypot(xy[:, None, 0] - xy[None, :, 0], xy[:, None, 1] - xy[None, :, 1]) <= ml.MODE_RADIUS
+    broad = int(near.sum(axis=1).argmax())
+    sharp = int(np.hypot(*(xy - xy[broad]).T).argmax())
+    p = np.zeros(localizer.walkable.shape)
+    p[0, rows[near[broad]], cols[near[broad]]] = 0.9
+    p[0, rows[sharp], cols[sharp]] = 1.0
+    with np.errstate(divide="ignore"):
+        estimate = localizer.estimate(localizer._normalized(np.log(p)))
+
+    assert (estimate.x, estimate.y) == cell_xy(localizer, rows[sharp], cols[sharp])
+    top = estimate.modes[0]
+    assert math.hypot(top["x"] - xy[broad, 0], top["y"] - xy[broad, 1]) <= ml.MODE_RADIUS
+    # Confidence belongs to the reported cell, not the top mode
+    assert estimate.mass == pytest.approx(1.0 / p.sum())
+    assert estimate.mass < top["mass"]
+
+
+def test_two_equal_landmarks_give_two_modes(localizer):
+    estimate = localizer.locate(TOILETS_AHEAD)
+    toilets = ml.landmark_points("Toilets", "B2")[0]
+    first, second = estimate.modes[:2]
+    masses = [mode["mass"] for mode in estimate.modes]
+    assert masses == sorted(masses, reverse=True)
+    assert first["mass"] == pytest.approx(second["mass"], rel=1e-6)
+    # One mode in front of each toilet block
+    nearest = {int(np.hypot(*(toilets - (mode["x"], mode["y"])).T).argmin()) for mode in (first, second)}
+    assert nearest == {0, 1}
+
+
+def test_entropy_drops_after_bearing_update():
+    localizer = ml.GridLocalizer(["B2"])
+    before = localizer.estimate().entropy
+    after = localizer.update({"floor_estimate": "B2", "floor_confidence": 0.9,
+                              "left_side": "The Body Shop (b217-218)", "right_side": "Shake Shack (b243)",
+                              "directly_ahead": "Central spiral escalators",
+                              "estimated_direction_degrees": 0}).entropy
+    assert after < before - 1.0
+
+
+def test_locate_on_grid_reports_map_mass():
+    location, posterior = ml.locate_on_grid(TOILETS_AHEAD)
+    assert (location.floor, location.x, location.y) == (posterior.floor, posterior.x, posterior.y)
+    assert location.confidence == posterior.mass
+    assert posterior.modes[0]["mass"] > posterior.mass
@@ -0,0 +1,49 @@
+"""Mall packages: mall.pack is only trusted by the interpreter that wrote it."""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mall_locator as ml
+
+
+@pytest.fixture
+def package(tmp_path):
+    directory = ml.export_mall_package(tmp_path / "ts")
+    ml.compile_mall_package(directory)
+    return directory
+
+
+def packed_by(monkeypatch, directory, interpreter):
+    """Rewrite the pack as if another Python/marshal version had written it."""
+    with monkeypatch.context() as m:
+        m.setattr(ml, "_pack_interpreter", lambda: interpreter)
+        ml.compile_mall_package(directory)
+    return ml.MallData._read_header(directory / "mall.pack")
+
+
+def test_pack_records_interpreter(package):
+    header = ml.MallData._read_header(package / "mall.pack")
+    assert header["interpreter"] == [*sys.version_info[:2], ml.marshal.version]
+
+
+def test_other_interpreter_pack_is_recompiled(package, monkeypatch):
+    assert packed_by(monkeypatch, package, [3, 0, 2])["interpreter"] == [3, 0, 2]
+    mall = ml.MallData(package)
+    assert ml.MallData._read_header(package / "mall.pack")["interpreter"] == ml._pack_interpreter()
+    assert mall.load_floor("B2")["stores"] == ml.FLOOR_DATA["B2"]["stores"]
+
+
+def test_other_interpreter_pack_without_sources_is_an_error(package, monkeypatch):
+    packed_by(monkeypatch, package, [3, 0, 2])
+    (package / "mall.json").unlink()
+    with pytest.raises(ml.MallDataError, match="marshal"):
+        ml.MallData(package)
+
+
+def test_current_pack_without_sources_still_loads(package):
+    (package / "mall.json").unlink()
+    assert ml.MallData(package).floors == list(ml.FLOOR_DATA)
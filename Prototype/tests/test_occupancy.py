@@ -0,0 +1,101 @@
+"""Occupancy-grid backend: Jump Point Search against plain 8-connected A*."""
+
+import sys
+import math
+import heapq
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mall_locator as ml
+
+
+def octile_length(cells):
+    total = 0.0
+    for (x1, y1), (x2, y2) in zip(cells, cells[1:]):
+        dx, dy = abs(x2 - x1), abs(y2 - y1)
+        total += max(dx, dy) + (math.sqrt(2) - 1) * min(dx, dy)
+    return total
+
+
+def reference_astar(free, start, goal):
+    """Cost of the shortest 8-connected path; diagonals only past two open sides."""
+    h, w = free.shape
+    open_ = lambda x, y: 0 <= x < w and 0 <= y < h and free[y, x]
+    g = {start: 0.0}
+    heap = [(0.0, start)]
+    while heap:
+        d, (x, y) = heapq.heappop(heap)
+        if (x, y) == goal:
+            return d
+        if d > g[(x, y)]:
+            continue
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                if not (dx or dy) or not open_(x + dx, y + dy):
+                    continue
+                if dx and dy and not (open_(x + dx, y) and open_(x, y + dy)):
+                    continue
+                nd = d + (math.sqrt(2) if dx and dy else 1.0)
+                if nd < g.get((x + dx, y + dy), float("inf")):
+                    g[(x + dx, y + dy)] = nd
+                    heapq.heappush(heap, (nd, (x + dx, y + dy)))
+    return None
+
+
+def assert_walkable(grid, cells):
+    """Every jump runs straight or diagonally over free cells without cutting corners."""
+    for (x1, y1), (x2, y2) in zip(cells, cells[1:]):
+        dx, dy = np.sign(x2 - x1), np.sign(y2 - y1)
+        assert abs(x2 - x1) == abs(y2 - y1) or x1 == x2 or y1 == y2
+        x, y = x1, y1
+        while (x, y) != (x2, y2):
+            if dx and dy:
+                assert grid.free[y, x + dx] and grid.free[y + dy, x]
+            x, y = x + dx, y + dy
+            assert grid.free[y, x]
+
+
+def check_pairs(grid, pairs):
+    for start, goal in pairs:
+        expected = reference_astar(grid.free, start, goal)
+        cells = grid.jps(start, goal)
+        if expected is None:
+            assert cells is None
+            continue
+        assert cells[0] == start and cells[-1] == goal
+        assert_walkable(grid, cells)
+        assert octile_length(cells) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("seed", range(6))
+def test_jps_matches_astar_on_random_grids(seed):
+    rng = np.random.default_rng(seed)
+    free = rng.random((40, 50)) > 0.3
+    grid = ml.OccupancyGrid("test", free)
+    ys, xs = np.nonzero(free)
+    picks = rng.integers(len(xs), size=(25, 2))
+    check_pairs(grid, [((int(xs[a]), int(ys[a])), (int(xs[b]), int(ys[b]))) for a, b in picks])
+
+
+def test_jps_matches_astar_on_floor_grids(tmp_path, monkeypatch):
+    monkeypatch.setattr(ml, "CACHE_DIR", tmp_path)
+    monkeypatch.setattr(ml, "_OCCUPANCY_GRIDS", {})
+    rng = np.random.default_rng(9)
+    for floor in ml.FLOOR_DATA:
+        grid = ml.get_occupancy_grid(floor)
+        ys, xs = np.nonzero(grid.free)
+        picks = rng.integers(len(xs), size=(4, 2))
+        check_pairs(grid, [((int(xs[a]), int(ys[a])), (int(xs[b]), int(ys[b]))) for a, b in picks])
+    # Rasterized once, then served from the on-disk cache
+    assert len(list((tmp_path / "occupancy").glob("*.npz"))) == len(ml.FLOOR_DATA)
+
+
+def test_packed_grid_round_trips(tmp_path):
+    free = np.random.default_rng(3).random((33, 47)) > 0.5
+    path = tmp_path / "grid.npz"
+    ml.OccupancyGrid("test", free).save(path)
+    assert (ml.OccupancyGrid.load("test", path).free == free).all()
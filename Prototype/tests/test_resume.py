@@ -0,0 +1,68 @@
+"""ResultsWriter and main() --resume: what counts as done and what is redone."""
+
+import sys
+import json
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mall_locator as ml
+
+
+def test_resume_drops_a_torn_last_record(tmp_path):
+    path = tmp_path / "results.jsonl"
+    with ml.ResultsWriter(path) as writer:
+        writer.write({"photo": "a.png"})
+        writer.write({"photo": "b.png"})
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"photo": "c.pn')
+    writer = ml.ResultsWriter(path, resume=True)
+    assert writer.done == {"a.png", "b.png"}
+    writer.write({"photo": "c.png"})
+    writer.close()
+    assert [r["photo"] for r in ml.read_results(path)] == ["a.png", "b.png", "c.png"]
+
+
+def test_without_resume_the_log_starts_over(tmp_path):
+    path = tmp_path / "results.jsonl"
+    with ml.ResultsWriter(path) as writer:
+        writer.write({"photo": "a.png"})
+    with ml.ResultsWriter(path) as writer:
+        assert writer.done == set()
+    assert path.read_bytes() == b""
+
+
+def test_latest_results_keep_the_last_record_per_photo(tmp_path):
+    path = tmp_path / "results.jsonl"
+    path.write_text("".join(json.dumps(r) + "\n" for r in (
+        {"photo": "a", "v": 1}, {"photo": "b", "v": 1}, {"photo": "a", "v": 2})))
+    assert ml.latest_results(path) == [{"photo": "b", "v": 1}, {"photo": "a", "v": 2}]
+
+
+def test_resume_needs_record_and_images(sandbox, capsys):
+    photos = [sandbox.add_photo(f"p{i}.png", (40 * i, 80, 120)) for i in range(3)]
+    sandbox.run("--json")
+    assert [r["photo"] for r in sandbox.records()] == [p.name for p in photos]
+    assert all(path.exists() for p in photos for path in ml.photo_outputs(p))
+
+    # Nothing missing: nothing to redo
+    capsys.readouterr()
+    sandbox.run("--resume")
+    assert "3 already recorded, 0 to process" in capsys.readouterr().out
+
+    # A recorded photo whose image is gone is redone
+    ml.photo_outputs(photos[1])[0].unlink()
+    sandbox.run("--resume")
+    out = capsys.readouterr().out
+    assert "1 to process" in out and f"{photos[1].name}:" in out and f"{photos[0].name}:" not in out
+    assert ml.photo_outputs(photos[1])[0].exists()
+
+    # An image without its record (crash after rendering, before the line was flushed) is redone
+    log = sandbox.output / ml.RESULTS_JSONL
+    lines = log.read_text().splitlines(keepends=True)
+    log.write_text("".join(line for line in lines if photos[2].name not in line) + lines[-1][:10])
+    sandbox.run("--resume", "--json")
+    out = capsys.readouterr().out
+    assert "1 to process" in out and f"{photos[2].name}:" in out
+    latest = json.loads((sandbox.output / ml.RESULTS_JSON).read_text())
+    assert sorted(r["photo"] for r in latest) == [p.name for p in photos]
@@ -0,0 +1,190 @@
+"""Walkway routing (graphs, toilet fields, multi-floor graph, spatial index) against plain reference implementations."""
+
+import sys
+import heapq
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mall_locator as ml
+
+FLOORS = list(ml.FLOOR_DATA)
+
+
+def reference_graph(floor):
+    """{name: [(neighbor, cost)]} straight from the waypoint tables, as before FloorGraph."""
+    waypoints = ml.WALKWAY_WAYPOINTS.get(floor, {})
+    graph = {name: [] for name in waypoints}
+    for a, b in ml.WALKWAY_CONNECTIONS.get(floor, []):
+        if a in waypoints and b in waypoints:
+            d = ml.distance(waypoints[a], waypoints[b])
+            graph[a].append((b, d))
+            graph[b].append((a, d))
+    return graph
+
+
+def reference_astar(floor, start, goal):
+    """The original name-keyed A* over a freshly built adjacency dict."""
+    waypoints = ml.WALKWAY_WAYPOINTS[floor]
+    graph = reference_graph(floor)
+    open_set = [(0, start)]
+    came_from = {}
+    g_score = {wp: float("inf") for wp in waypoints}
+    g_score[start] = 0
+    while open_set:
+        _, current = heapq.heappop(open_set)
+        if current == goal:
+            path = [current]
+            while current in came_from:
+                current = came_from[current]
+                path.append(current)
+            return path[::-1]
+        for neighbor, cost in graph[current]:
+            tentative = g_score[current] + cost
+            if tentative < g_score[neighbor]:
+                came_from[neighbor] = current
+                g_score[neighbor] = tentative
+                heapq.heappush(open_set, (tentative + ml.distance(waypoints[neighbor], waypoints[goal]), neighbor))
+    return [start, goal]
+
+
+def path_length(floor, names):
+    waypoints = ml.WALKWAY_WAYPOINTS[floor]
+    return sum(ml.distance(waypoints[a], waypoints[b]) for a, b in zip(names, names[1:]))
+
+
+@pytest.mark.parametrize("floor", FLOORS)
+def test_csr_astar_matches_reference(floor):
+    names = list(ml.WALKWAY_WAYPOINTS.get(floor, {}))
+    for start in names:
+        for goal in names:
+            expected = reference_astar(floor, start, goal)
+            path = ml.astar_path(floor, start, goal)
+            assert path_length(floor, path) == pytest.approx(path_length(floor, expected))
+            assert path == expected
+
+
+def test_floor_graph_follows_table_edits(monkeypatch):
+    floor = FLOORS[0]
+    waypoints = dict(ml.WALKWAY_WAYPOINTS[floor])
+    before = ml.get_floor_graph(floor)
+    waypoints["test_extra"] = (0.5, 0.5)
+    monkeypatch.setitem(ml.WALKWAY_WAYPOINTS, floor, waypoints)
+    after = ml.get_floor_graph(floor)
+    assert after is not before and "test_extra" in after.index
+    monkeypatch.undo()
+    assert "test_extra" not in ml.get_floor_graph(floor).index
+
+
+def reference_dijkstra(floor, source):
+    """Walking distance from one waypoint to every other, over the reference graph."""
+    graph = reference_graph(floor)
+    dist = {source: 0.0}
+    open_set = [(0.0, source)]
+    while open_set:
+        d, current = heapq.heappop(open_set)
+        if d > dist[current]:
+            continue
+        for neighbor, cost in graph[current]:
+            if d + cost < dist.get(neighbor, float("inf")):
+                dist[neighbor] = d + cost
+                heapq.heappush(open_set, (d + cost, neighbor))
+    return dist
+
+
+TOILET_FLOORS = [floor for floor in FLOORS if ml.get_floor_toilets(floor)]
+
+
+@pytest.mark.parametrize("floor", TOILET_FLOORS)
+def test_toilet_field_matches_per_toilet_dijkstra(floor):
+    field = ml.get_toilet_field(floor)
+    graph = ml.get_floor_graph(floor)
+    per_toilet = []
+    for toilet in field.toilets:
+        wp, pos = ml.find_nearest_waypoint(floor, toilet["x"], toilet["y"])
+        hop = ml.distance(pos, (toilet["x"], toilet["y"]))
+        per_toilet.append({name: d + hop for name, d in reference_dijkstra(floor, wp).items()})
+    for node, name in enumerate(graph.names):
+        best = min(distances.get(name, float("inf")) for distances in per_toilet)
+        assert field.dist[node] == pytest.approx(best)
+        if best < float("inf"):
+            assert per_toilet[field.target[node]][name] == pytest.approx(best)
+            # Following the next hops walks exactly that distance
+            toilet, positions = field.route(name)
+            walked = ml.path_length(positions + [(toilet["x"], toilet["y"])])
+            assert walked == pytest.approx(best)
+
+
+@pytest.mark.parametrize("floor", TOILET_FLOORS)
+def test_nearest_toilet_path_matches_per_toilet_search(floor):
+    for i in range(1, 20, 2):
+        for j in range(1, 20, 2):
+            x, y = i / 20, j / 20
+            expected, expected_length = None, float("inf")
+            for toilet in ml.get_floor_toilets(floor):
+                path = ml.find_path_to_toilet(floor, x, y, toilet)
+                if ml.path_length(path) < expected_length:
+                    expected, expected_length = path, ml.path_length(path)
+            route = ml.find_nearest_toilet(floor, x, y, backend="waypoints")
+            assert route["distance_m"] == pytest.approx(expected_length * 100)
+            assert [tuple(p) for p in route["path"]] == [tuple(p) for p in expected]
+
+
+def test_multi_floor_heuristic_is_admissible():
+    graph = ml.get_multi_floor_graph()
+    dist, _ = graph.shortest_paths()
+    for node in range(len(graph.coords)):
+        for goal in range(len(graph.coords)):
+            if np.isfinite(dist[node, goal]):
+                assert graph.heuristic(node, goal) <= dist[node, goal] + 1e-9
+
+
+@pytest.mark.parametrize("floor", FLOORS)
+def test_multi_floor_astar_matches_dijkstra(floor):
+    graph = ml.get_multi_floor_graph()
+    dist, _ = graph.shortest_paths()
+    goals = [n for n, kind in enumerate(graph.kind) if kind == "toilet" and graph.floor[n] != floor]
+    for name in ml.WALKWAY_WAYPOINTS.get(floor, {}):
+        start = graph.index[(floor, name)]
+        path, cost = graph.astar(start, goals)
+        assert cost == pytest.approx(dist[start, goals].min())
+        assert path[0] == start and path[-1] in goals
+        walked = sum(dict(graph.neighbors(a))[b] for a, b in zip(path, path[1:]))
+        assert walked == pytest.approx(cost)
+
+
+def test_floor_without_toilets_routes_through_a_lift_or_escalator():
+    floor = next(floor for floor in FLOORS if not ml.get_floor_toilets(floor))
+    route = ml.find_nearest_toilet(floor, 0.5, 0.5)
+    assert not route["same_floor"]
+    assert route["legs"][0]["floor"] == floor and route["legs"][-1]["floor"] == route["toilet"]["floor"]
+    vias = [leg["via"] for leg in route["legs"][:-1]]
+    assert all(via in ml.ELEVATOR_POSITIONS or via in ml.ESCALATOR_POSITIONS for via in vias)
+
+
+@pytest.mark.parametrize("floor", FLOORS)
+def test_waypoint_index_matches_brute_force(floor):
+    graph = ml.get_floor_graph(floor)
+    rng = np.random.default_rng(4)
+    # Points inside, around and well outside the waypoint cloud
+    for x, y in rng.uniform(-0.3, 1.3, size=(400, 2)):
+        ranked = sorted(range(len(graph)), key=lambda node: (ml.distance((x, y), graph.coords[node]), node))
+        for k in (1, 3, 5, len(graph) + 2):
+            assert graph.spatial.nearest(x, y, k) == ranked[:k]
+        for radius in (0.05, 0.15, 0.4):
+            assert graph.spatial.within(x, y, radius) == [
+                node for node in ranked if ml.distance((x, y), graph.coords[node]) <= radius]
+        name, pos = ml.find_nearest_waypoint(floor, x, y)
+        assert graph.index[name] == ranked[0] and pos == graph.coords[ranked[0]]
+
+
+def test_waypoint_index_edge_cases():
+    assert ml.WaypointIndex([]).nearest(0.5, 0.5, 3) == []
+    assert ml.WaypointIndex([]).within(0.5, 0.5, 1.0) == []
+    # Coincident points: ties resolve in table order
+    index = ml.WaypointIndex([(0.2, 0.2), (0.2, 0.2), (0.6, 0.6)])
+    assert index.nearest(0.2, 0.2, 2) == [0, 1]
+    assert index.nearest(0.9, 0.9, 3) == [2, 0, 1]
@@ -0,0 +1,97 @@
+"""Sequence smoothing: which frames are kept, corrected, or placed from their neighbours."""
+
+import sys
+import json
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mall_locator as ml
+
+FLOOR = "B2"
+
+
+def named(seconds, stem="Screenshot 2025-11-30 at 15.{:02d}.{:02d}.png"):
+    """Photo name captured `seconds` after 15:00:00."""
+    return stem.format(seconds // 60, seconds % 60)
+
+
+def at_waypoint(name, floor=FLOOR, confidence=0.4):
+    x, y = ml.WALKWAY_WAYPOINTS[floor][name]
+    return ml.LocationEstimate(floor=floor, x=x, y=y, direction=0, confidence=confidence,
+                               detected_shops=[], store_codes=[], reasoning="")
+
+
+@pytest.fixture(scope="module")
+def corridor():
+    """Three adjacent B2 waypoints."""
+    graph = ml.get_floor_graph(FLOOR)
+    for a in range(len(graph)):
+        for b, _ in graph.neighbors(a):
+            for c, _ in graph.neighbors(b):
+                if c != a:
+                    return [graph.names[a], graph.names[b], graph.names[c]]
+
+
+def test_photo_timestamp_formats():
+    base = datetime(2025, 11, 30, 15, 41, 24).timestamp()
+    assert ml.photo_timestamp("Screenshot 2025-11-30 at 15.41.24.png") == base
+    assert ml.photo_timestamp("IMG 2025-11-30 03-41-24 PM.jpg") == base
+    assert ml.photo_timestamp("PXL_2025-11-30_15_41_24.jpg") == base
+
+
+def test_untrusted_frame_is_placed_from_neighbours(corridor):
+    first, middle, last = (at_waypoint(name) for name in corridor)
+    vague = ml.LocationEstimate(floor="8F", x=0.9, y=0.2, direction=0, confidence=0.02,
+                                detected_shops=[], store_codes=[], reasoning="")
+    photos = [named(0), named(20), named(40)]
+    trajectory = ml.smooth_trajectory(photos, [first, vague, last])
+    assert trajectory.inferred == [False, True, False]
+    assert trajectory.corrected == [False, False, False]
+    # Trusted frames keep their own estimates; the vague one lands between them
+    assert trajectory.locations[0] is first and trajectory.locations[2] is last
+    placed = trajectory.locations[1]
+    assert placed.floor == FLOOR
+    assert ml.distance((placed.x, placed.y), (middle.x, middle.y)) <= \
+        ml.distance((first.x, first.y), (last.x, last.y))
+
+
+def test_misread_floor_between_consistent_neighbours_is_corrected(corridor):
+    first, middle, last = (at_waypoint(name) for name in corridor)
+    misread = ml.LocationEstimate(floor="8F", x=middle.x, y=middle.y, direction=0, confidence=0.3,
+                                  detected_shops=[], store_codes=[], reasoning="")
+    trajectory = ml.smooth_trajectory([named(0), named(10), named(20)], [first, misread, last])
+    assert trajectory.corrected == [False, True, False]
+    assert trajectory.locations[1].floor == FLOOR
+
+
+def test_run_without_trusted_frames_is_left_alone(corridor):
+    locations = [at_waypoint(name, confidence=0.01) for name in corridor]
+    trajectory = ml.smooth_trajectory([named(0), named(10), named(20)], locations)
+    assert trajectory.locations == locations
+    assert trajectory.inferred == [False] * 3 and trajectory.corrected == [False] * 3
+
+
+def test_sequences_sorted_and_split_at_gaps(corridor):
+    location = at_waypoint(corridor[0])
+    later = "IMG 2025-11-30 04-00-00 PM.jpg"         # 16:00, past SEQUENCE_MAX_GAP after 15:00:30
+    assert ml.photo_timestamp(later) - ml.photo_timestamp(named(30)) > ml.SEQUENCE_MAX_GAP
+    trajectories = ml.smooth_sequences([later, named(30), named(0)], [location] * 3)
+    assert [t.photos for t in trajectories] == [[named(0), named(30)], [later]]
+
+
+def test_sequence_spans_resumed_photos(sandbox, capsys):
+    for seconds in (0, 15, 30):
+        sandbox.add_photo(named(seconds))
+    sandbox.run("--sequence")
+    ml.photo_outputs(Path(named(15)))[0].unlink()
+    sandbox.run("--sequence", "--resume")
+    assert "1 to process" in capsys.readouterr().out
+    trajectories = json.loads((sandbox.output / ml.TRAJECTORY_JSON).read_text())
+    assert sum(len(t["photos"]) for t in trajectories) == 3
+    # The redone photo's record carries the sequence flags
+    redone = [r for r in sandbox.records() if r["photo"] == named(15)][-1]
+    assert "inferred" in redone and "corrected" in redone
@@ -0,0 +1,177 @@
+"""StagedPipeline: each stage is reused exactly while its fingerprint holds."""
+
+import sys
+import json
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mall_locator as ml
+
+ANALYSIS = {"floor_estimate": "B2", "floor_confidence": 0.9, "detected_shops": ["Shake Shack"],
+            "estimated_x": 0.46, "estimated_y": 0.55, "estimated_direction_degrees": 0}
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    monkeypatch.setattr(ml, "OPENAI_API_KEY", "")
+    return lambda: ml.StagedPipeline(store=ml.StageStore(tmp_path / "stages"))
+
+
+def counts(pipeline, stage):
+    return pipeline.counts[stage]["run"], pipeline.counts[stage]["reused"]
+
+
+def moved_waypoint(floor):
+    waypoints = dict(ml.WALKWAY_WAYPOINTS[floor])
+    name = next(iter(waypoints))
+    waypoints[name] = (waypoints[name][0] + 0.01, waypoints[name][1])
+    return waypoints
+
+
+def test_stage_store_matches_on_fingerprint(tmp_path):
+    store = ml.StageStore(tmp_path)
+    store.put("p.png", "route", "f1", {"d": 1})
+    store.put("p.png", "render", "f2", ["a.png"])
+    assert store.get("p.png", "route", "f1") == {"d": 1}
+    assert store.get("p.png", "route", "f2") is None
+    assert store.get("p.png", "render", "f2") == ["a.png"]
+    (tmp_path / "p.png.json").write_text("{torn")
+    assert store.get("p.png", "route", "f1") is None
+
+
+def test_analysis_reused_until_photo_changes(tmp_path, pipeline):
+    photo = tmp_path / "p.png"
+    photo.write_bytes(b"one")
+    first = pipeline()
+    first.analyses([photo])
+    second = pipeline()
+    second.analyses([photo])
+    assert counts(first, "analysis") == (1, 0) and counts(second, "analysis") == (0, 1)
+
+
+def test_analysis_key_follows_photo_prompt_and_model(tmp_path, pipeline, monkeypatch):
+    photo = tmp_path / "p.png"
+    photo.write_bytes(b"one")
+    monkeypatch.setattr(ml, "OPENAI_API_KEY", "key")
+    base = pipeline().analysis_fingerprint(photo)
+    monkeypatch.setattr(ml, "VISION_MODEL", "other-model")
+    assert pipeline().analysis_fingerprint(photo) != base
+    monkeypatch.undo()
+    monkeypatch.setattr(ml, "OPENAI_API_KEY", "key")
+    photo.write_bytes(b"two")
+    assert pipeline().analysis_fingerprint(photo) != base
+
+
+def test_position_follows_analysis_and_store_tables(pipeline, monkeypatch):
+    pipeline().position("p.png", ANALYSIS)
+    again = pipeline()
+    again.position("p.png", ANALYSIS)
+    again.position("p.png", dict(ANALYSIS, estimated_x=0.3))
+    assert counts(again, "position") == (1, 1)
+    # Editing a store the resolver reads invalidates every position
+    stores = dict(ml.ALL_STORES, b243=dict(ml.ALL_STORES["b243"], x=0.47))
+    monkeypatch.setattr(ml, "ALL_STORES", stores)
+    edited = pipeline()
+    edited.position("p.png", dict(ANALYSIS, estimated_x=0.3))
+    assert counts(edited, "position") == (1, 0)
+
+
+def test_waypoint_edit_reroutes_but_keeps_position(pipeline, monkeypatch):
+    location = pipeline().position("p.png", ANALYSIS)
+    pipeline().route("p.png", location)
+    monkeypatch.setitem(ml.WALKWAY_WAYPOINTS, "B2", moved_waypoint("B2"))
+    edited = pipeline()
+    edited.route("p.png", edited.position("p.png", ANALYSIS))
+    assert counts(edited, "position") == (0, 1)
+    assert counts(edited, "route") == (1, 0)
+
+
+def test_render_current_needs_fingerprint_and_files(tmp_path, pipeline, monkeypatch):
+    first = pipeline()
+    location = first.position("p.png", ANALYSIS)
+    route = first.route("p.png", location)
+    fingerprint = first.render_fingerprint(location, route)
+    output = tmp_path / "location_p.png"
+    assert not first.render_current("p.png", fingerprint, [output])
+    output.write_bytes(b"png")
+    first.render_done("p.png", fingerprint, [output])
+
+    assert pipeline().render_current("p.png", fingerprint, [output])
+    moved = ml.LocationEstimate(**dict(ml.asdict(location), x=location.x + 0.01))
+    assert pipeline().render_fingerprint(moved, route) != fingerprint
+    monkeypatch.setattr(ml, "OUTPUT_FORMAT", "svg")
+    assert pipeline().render_fingerprint(location, route) != fingerprint
+    monkeypatch.undo()
+    output.unlink()
+    assert not pipeline().render_current("p.png", fingerprint, [output])
+
+
+def test_rerun_reuses_and_waypoint_edit_reroutes(sandbox, capsys, monkeypatch):
+    for i in range(2):
+        sandbox.add_photo(f"p{i}.png", (60 * i, 90, 90))
+    sandbox.run()
+    assert "analysis 2 run/0 reused, position 2 run/0 reused, route 2 run/0 reused, render 2 run/0 reused" \
+        in capsys.readouterr().out
+    sandbox.run()
+    assert "analysis 0 run/2 reused, position 0 run/2 reused, route 0 run/2 reused, render 0 run/2 reused" \
+        in capsys.readouterr().out
+    # Only the route and render stages are redone after a walkway edit on the photos' floor
+    floor = sandbox.records()[0]["floor"]
+    monkeypatch.setitem(ml.WALKWAY_WAYPOINTS, floor, moved_waypoint(floor))
+    sandbox.run()
+    out = capsys.readouterr().out
+    same_floor = sum(r["floor"] == floor for r in sandbox.records()[-2:])
+    assert f"analysis 0 run/2 reused, position 0 run/2 reused, route {same_floor} run" in out
+
+
+def view_mall(monkeypatch, mall):
+    """Point the stage tables at a mall's lazy views, as activate_mall() does."""
+    for name, extract in (("FLOOR_DATA", lambda s: s), ("FLOOR_FACILITIES", lambda s: s["facilities"]),
+                          ("WALKWAY_WAYPOINTS", lambda s: s["waypoints"]),
+                          ("WALKWAY_CONNECTIONS", lambda s: s["connections"])):
+        monkeypatch.setattr(ml, name, ml.MallFloorTable(mall, extract))
+    monkeypatch.setattr(ml, "ALL_STORES", ml.MallStoreTable(mall))
+
+
+@pytest.fixture
+def package(tmp_path):
+    return ml.export_mall_package(tmp_path / "malls" / "ts")
+
+
+def lazy_pipeline(tmp_path, monkeypatch):
+    registry = ml.MallRegistry(tmp_path / "malls")
+    view_mall(monkeypatch, registry.get("ts"))
+    return ml.StagedPipeline(store=ml.StageStore(tmp_path / "stages")), registry
+
+
+def edit_floor(package, floor):
+    path = package / "floors" / f"{floor}.json"
+    doc = json.loads(path.read_text(encoding="utf-8"))
+    doc["color"] = "#123456"
+    path.write_text(json.dumps(doc), encoding="utf-8")
+
+
+def test_fingerprints_decode_only_the_rendered_floor(tmp_path, package, monkeypatch):
+    stages, registry = lazy_pipeline(tmp_path, monkeypatch)
+    assert registry.resident() == []
+    location = ml.LocationEstimate(floor="B2", x=0.46, y=0.55, direction=0, confidence=0.9,
+                                   detected_shops=[], store_codes=[], reasoning="")
+    stages.render_fingerprint(location, {})
+    assert registry.resident() == [("times_square", "B2")]
+
+
+def test_floor_edit_rerenders_only_that_floor(tmp_path, package, monkeypatch):
+    b2 = ml.LocationEstimate(floor="B2", x=0.46, y=0.55, direction=0, confidence=0.9,
+                             detected_shops=[], store_codes=[], reasoning="")
+    before, _ = lazy_pipeline(tmp_path, monkeypatch)
+    edit_floor(package, "8F")
+    other, _ = lazy_pipeline(tmp_path, monkeypatch)
+    assert other.render_fingerprint(b2, {}) == before.render_fingerprint(b2, {})
+    # Routes can cross floors, so any floor's walkway data re-routes
+    assert other.tables["route"] != before.tables["route"]
+    edit_floor(package, "B2")
+    same, _ = lazy_pipeline(tmp_path, monkeypatch)
+    assert same.render_fingerprint(b2, {}) != before.render_fingerprint(b2, {})
@@ -0,0 +1,67 @@
+"""StoreIndex: normalized, alias and fuzzy shop-name resolution scoped by floor."""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mall_locator as ml
+
+
+@pytest.mark.parametrize("name, floor, code", [
+    # Spelling variants named in the request
+    ("Bodyshop", "B2", "b217-218"),
+    ("SHAKE SHACK", "B2", "b243"),
+    # Case, punctuation, spacing and a leading "The"
+    ("BODY SHOP", None, "b217-218"),
+    ("Shake-Shack", None, "b243"),
+    ("City Super", None, "b1(a)"),
+    # Typos fall through to the trigram index
+    ("Shake Shak", "B2", "b243"),
+    ("Acca Kapa", "B2", "b225a"),
+    ("Fortres", "8F", "807-808"),
+    ("Lane Crawfurd", "GF", "Lane Crawford"),
+    # Store codes resolve like names
+    ("b243", None, "b243"),
+])
+def test_resolves_variants(name, floor, code):
+    entry = ml.STORE_INDEX.resolve(name, floor)
+    assert entry is not None and entry.code == code
+    assert (entry.x, entry.y) == (ml.ALL_STORES[code]["x"], ml.ALL_STORES[code]["y"])
+
+
+def test_scoped_by_floor():
+    assert ml.STORE_INDEX.resolve("Shake Shack", "B2").floor == "B2"
+    assert ml.STORE_INDEX.resolve("Shake Shack", "GF") is None
+
+
+@pytest.mark.parametrize("name", ["Starbucks", "", "   ", "zz"])
+def test_unknown_names_miss(name):
+    assert ml.STORE_INDEX.resolve(name) is None
+
+
+def test_normalization():
+    assert ml.normalize_store_name("The Body Shop") == ml.normalize_store_name("BODYSHOP") == "bodyshop"
+    assert ml.normalize_store_name("Célïne") == "celine"
+    assert ml.normalize_store_name("Marks & Spencer") == "marksandspencer"
+
+
+def test_floors_indexed_on_first_use():
+    index = ml.StoreIndex.from_tables(ml.FLOOR_DATA, ml.STORE_NAME_TO_CODE)
+    assert index.resolve("Fortress", "8F").code == "807-808"
+    assert "8F" not in index._pending and "B2" in index._pending
+    # An unscoped lookup needs every floor
+    assert index.resolve("Bodyshop").code == "b217-218"
+    assert not index._pending
+
+
+def test_fuzzy_lookup_among_thousands_of_stores():
+    floors = {f"F{f}": {"stores": {f"s{f}-{i}": {"x": i / 1000, "y": f / 10, "name": f"Boutique {f} {i:04d} Lumiere"}
+                                   for i in range(1000)}} for f in range(4)}
+    floors["F2"]["stores"]["target"] = {"x": 0.5, "y": 0.5, "name": "Harbour Noodle House"}
+    index = ml.StoreIndex.from_tables(floors)
+    assert index.resolve("Harbor Noodle House", "F2").code == "target"
+    assert index.resolve("harbour noodle", None).code == "target"
+    assert index.resolve("Harbour Noodle House", "F1") is None
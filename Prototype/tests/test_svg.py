@@ -0,0 +1,42 @@
+"""SVG output: referenced layer groups must be self-contained."""
+
+import re
+import sys
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mall_locator as ml
+
+SVG = "{http://www.w3.org/2000/svg}"
+
+
+def url_targets(element):
+    """Ids named by url(#...) anywhere under element."""
+    return {target for node in element.iter() for value in node.attrib.values()
+            for target in re.findall(r"url\(#([^)]+)\)", value)}
+
+
+def ids(element):
+    return {node.get("id") for node in element.iter() if node.get("id")}
+
+
+@pytest.mark.parametrize("group", ["floor", "facilities"])
+def test_layer_groups_carry_their_own_defs(group):
+    root = ET.fromstring(ml.svg_static_layer("B2"))
+    element = root.find(f".//{SVG}g[@id='{group}']")
+    assert element is not None
+    assert url_targets(element) <= ids(element)
+    if group == "floor":
+        assert {"bg", "grid"} <= url_targets(element)
+
+
+def test_referencing_svg_has_no_dangling_urls(tmp_path):
+    href = ml.write_static_svg("B2", 800, 600, tmp_path / "layers")
+    location = ml.LocationEstimate(floor="B2", x=0.46, y=0.55, direction=0, confidence=0.9,
+                                   detected_shops=[], store_codes=[], reasoning="")
+    root = ET.fromstring(ml.render_location_svg(location, {}, static_href=href))
+    assert url_targets(root) <= ids(root)
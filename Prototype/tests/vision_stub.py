@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the chat completions endpoint mall_locator's interactive
+analysis posts to (OPENAI_API_URL).
+
+A request is identified by the photo it carries: the marker is the mean red
+channel of the uploaded image divided by 20, so a solid (20 * i, 0, 0) photo
+has marker i. The reply puts the marker in estimated_x (as i / 100). `plan`
+can answer a request with an HTTP error instead.
+
+    python tests/vision_stub.py 8791
+    OPENAI_API_KEY=stub OPENAI_API_URL=http://127.0.0.1:8791/v1/chat/completions \\
+        python mall_locator.py
+"""
+
+import io
+import sys
+import json
+import base64
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from PIL import Image, ImageStat
+
+
+def photo_marker(body) -> int:
+    """Marker of the photo in a chat completions request body."""
+    url = body["messages"][0]["content"][1]["image_url"]["url"]
+    image = Image.open(io.BytesIO(base64.b64decode(url.split(",", 1)[1]))).convert("RGB")
+    return round(ImageStat.Stat(image).mean[0] / 20)
+
+
+class VisionStub:
+    """
+    In-process stub server. plan(marker, attempt) returns None to answer
+    normally, an HTTP status, or (status, headers) to fail that attempt
+    (attempt counts from 0 per marker). Each answer waits `delay` seconds,
+    so concurrent requests overlap; `max_in_flight` records the peak.
+    """
+
+    def __init__(self, plan=None, delay=0.0, port=0):
+        self.plan = plan or (lambda marker, attempt: None)
+        self.delay = delay
+        self.attempts = {}          # marker -> [status, ...] in arrival order
+        self.in_flight = self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1/chat/completions"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def answer(self, body):
+        """(status, headers, reply body) for one request."""
+        marker = photo_marker(body)
+        with self._lock:
+            attempt = len(self.attempts.setdefault(marker, []))
+            planned = self.plan(marker, attempt)
+            status, headers = planned if isinstance(planned, tuple) else (planned or 200, {})
+            self.attempts[marker].append(status)
+        if status != 200:
+            return status, headers, {"error": {"message": f"stub status {status}"}}
+        content = "```json\n" + json.dumps({
+            "detected_shops": ["Shake Shack"], "floor_estimate": "B2", "floor_confidence": 0.9,
+            "estimated_x": marker / 100, "estimated_y": 0.5, "estimated_direction_degrees": 0,
+            "position_reasoning": f"vision stub {marker}",
+        }) + "\n```"
+        return 200, {}, {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                with stub._lock:
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                try:
+                    threading.Event().wait(stub.delay)
+                    status, headers, reply = stub.answer(body)
+                finally:
+                    with stub._lock:
+                        stub.in_flight -= 1
+                out = json.dumps(reply).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+        return Handler
+
+
+if __name__ == "__main__":
+    with VisionStub(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8791) as stub:
+        print(f"Vision stub on {stub.url}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass